@@ -0,0 +1,140 @@
+"""Admission control for the Gradio pipeline: concurrency limits per stage and bounded queues.
+
+Each stage runs at most STAGE_LIMITS[stage] requests at once. Further requests
+wait in a first-come first-served queue of at most QUEUE_SIZE, and are told
+their position while waiting. A request is rejected at once when the queue is
+full, and after QUEUE_TIMEOUT seconds in the queue, so under a burst some users
+get a quick "busy" answer while the admitted ones keep their normal latency.
+
+Limits can be set without code changes, e.g.
+CFW_STAGE_LIMITS="analysis=4,chat=16" CFW_QUEUE_SIZE=64 CFW_QUEUE_TIMEOUT=30.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import admission_active, admission_queue_depth, admission_rejections, admission_wait_seconds
+
+STAGE_LIMITS = {'extraction': 8, 'analysis': 8, 'chat': 8, 'lookup': 4}
+QUEUE_SIZE = int(os.environ.get("CFW_QUEUE_SIZE", 32))
+QUEUE_TIMEOUT = float(os.environ.get("CFW_QUEUE_TIMEOUT", 60))
+# How often a waiting request is told its position
+POSITION_INTERVAL = 1.0
+
+for setting in filter(None, os.environ.get("CFW_STAGE_LIMITS", "").split(",")):
+    name, _, value = setting.partition("=")
+    STAGE_LIMITS[name.strip()] = int(value)
+
+
+class QueueFull(Exception):
+    """Raised when a request is not admitted: the queue of its stage is full or it waited too long."""
+
+
+class StageQueue:
+    def __init__(self, stage, limit, size):
+        self.stage = stage
+        self.limit = limit
+        self.size = size
+        self.active = 0
+        self.waiting = deque()
+        self.condition = threading.Condition()
+
+    def publish(self):
+        admission_active.set(self.active, stage=self.stage)
+        admission_queue_depth.set(len(self.waiting), stage=self.stage)
+
+
+stage_queues = {}
+stage_queues_lock = threading.Lock()
+
+
+def stage_queue(stage):
+    with stage_queues_lock:
+        if stage not in stage_queues:
+            stage_queues[stage] = StageQueue(stage, STAGE_LIMITS[stage], QUEUE_SIZE)
+        return stage_queues[stage]
+
+
+class Admission:
+    """A request's place in a stage: queued, then admitted until released."""
+
+    def __init__(self, stage):
+        self.queue = stage_queue(stage)
+        self.enqueued = time.perf_counter()
+        self.admitted = False
+        self.released = False
+
+    def wait(self):
+        """Wait for a slot, yielding the 1-based queue position every POSITION_INTERVAL.
+
+        Yields nothing when a slot is free. Raises QueueFull after QUEUE_TIMEOUT."""
+        queue = self.queue
+        deadline = self.enqueued + QUEUE_TIMEOUT
+        while True:
+            with queue.condition:
+                if self.admitted:
+                    return
+                if queue.waiting[0] is self and queue.active < queue.limit:
+                    queue.waiting.popleft()
+                    queue.active += 1
+                    self.admitted = True
+                    queue.publish()
+                    admission_wait_seconds.observe(time.perf_counter() - self.enqueued, stage=queue.stage)
+                    return
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self.release()
+                    admission_rejections.inc(stage=queue.stage, reason="timeout")
+                    raise QueueFull(f"Waited more than {QUEUE_TIMEOUT:g}s for a {queue.stage} slot")
+                position = queue.waiting.index(self) + 1
+            yield position
+            with queue.condition:
+                if not (queue.waiting[0] is self and queue.active < queue.limit):
+                    queue.condition.wait(min(POSITION_INTERVAL, remaining))
+
+    def release(self):
+        """Give the slot back, or leave the queue if not admitted yet. Safe to call more than once."""
+        queue = self.queue
+        with queue.condition:
+            if self.released:
+                return
+            self.released = True
+            if self.admitted:
+                queue.active -= 1
+            elif self in queue.waiting:
+                queue.waiting.remove(self)
+            queue.publish()
+            queue.condition.notify_all()
+
+
+def admit(stage):
+    """Take a slot of a stage or a place in its queue. Raises QueueFull at once when the queue is full.
+
+    Call wait() on the result before doing the work, and release() in a finally block."""
+    queue = stage_queue(stage)
+    admission = Admission(stage)
+    with queue.condition:
+        if queue.active < queue.limit and not queue.waiting:
+            queue.active += 1
+            admission.admitted = True
+            admission_wait_seconds.observe(0.0, stage=stage)
+        elif len(queue.waiting) >= queue.size:
+            admission_rejections.inc(stage=stage, reason="full")
+            raise QueueFull(f"The {stage} queue is full")
+        else:
+            queue.waiting.append(admission)
+        queue.publish()
+    return admission
+
+
+def thread_budget():
+    """Worker threads the Gradio app needs: every admitted and queued request holds one."""
+    return sum(limit + QUEUE_SIZE for limit in STAGE_LIMITS.values()) + 16
+
+
+def queue_message(position):
+    return f"⏳ Many people are using the Wizard right now. You are number {position} in the queue..."
+
+
+BUSY_MESSAGE = "🚦 The Wizard is too busy right now, please try again in a minute."
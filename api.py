@@ -0,0 +1,339 @@
+"""HTTP API exposing the Carbon Footprint Wizard pipeline as JSON endpoints.
+
+Runs the API and the Gradio UI (mounted at /ui) in one process, so both share
+the data store, vector database and encoder loaded by engine.get_engine().
+
+    python api.py
+"""
+import asyncio
+import contextvars
+import math
+from typing import Any, Literal
+
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
+
+import engine
+from metrics import http_requests, metrics_route, tracked
+from memory_report import memory_route
+from profiling import header_mode, run_profiled
+
+API_HOST = "0.0.0.0"
+API_PORT = 7860
+KEEP_ALIVE_SECONDS = 30
+# Maximum number of requests of each kind running at once, and how long a request may wait for a slot
+CONCURRENCY_LIMITS = {'llm': 8, 'cpu': 4}
+SLOT_TIMEOUT_SECONDS = 10
+MAX_BATCH_QUERIES = 100
+
+Source = Literal['BONSAI', 'Agribalyse', 'Big Climate Database']
+
+
+class ExtractRequest(BaseModel):
+    recipe: str
+
+
+class Ingredient(BaseModel):
+    name: str
+    quantity: float
+
+
+class ExtractResponse(BaseModel):
+    ingredients: list[Ingredient]
+
+
+class SearchRequest(BaseModel):
+    query: str
+    k: int = Field(3, ge=1, le=20)
+
+
+class Match(BaseModel):
+    product: str
+    similarity: float
+
+
+class SearchResponse(BaseModel):
+    query: str
+    results: dict[str, list[Match]]
+
+
+class BatchSearchRequest(BaseModel):
+    queries: list[str] = Field(..., min_length=1, max_length=MAX_BATCH_QUERIES)
+    k: int = Field(3, ge=1, le=20)
+
+
+class BatchSearchResponse(BaseModel):
+    results: list[SearchResponse]
+
+
+class LookupRequest(BaseModel):
+    source: Source
+    product: str
+    country: str
+    grams: float = Field(1000, gt=0)
+
+
+class LookupResponse(BaseModel):
+    records: list[dict[str, Any]]
+    impact_kg: float | None
+
+
+class ProductRef(BaseModel):
+    source: Source
+    product: str
+
+
+class AnalyseIngredient(BaseModel):
+    name: str
+    grams: float = Field(..., gt=0)
+    products: list[ProductRef] = []
+
+
+class AnalyseRequest(BaseModel):
+    country: str
+    ingredients: list[AnalyseIngredient] | None = None
+    recipe: str | None = Field(None, description="Extract the ingredients from this text when `ingredients` is not given")
+    narrative: bool = False
+
+
+class ImpactRange(BaseModel):
+    min_kg: float
+    max_kg: float
+    average_kg: float
+
+
+class IngredientImpact(BaseModel):
+    name: str
+    grams: float
+    records: list[dict[str, Any]]
+    impact: ImpactRange | None
+
+
+class Swap(BaseModel):
+    source: Source
+    product: str
+    similarity: float
+    per_kg: float
+    saving_kg: float = Field(..., description="kg CO2-eq saved for the ingredient's amount")
+    saving_share: float | None
+    estimated: bool = Field(..., description="The swap's data comes from other regions")
+
+
+class Substitutes(BaseModel):
+    grams: float
+    per_kg: float = Field(..., description="Per-kg impact of the selected products")
+    swaps: list[Swap]
+
+
+class AnalyseResponse(BaseModel):
+    country: str
+    ingredients: list[IngredientImpact]
+    total: ImpactRange | None
+    substitutes: dict[str, Substitutes]
+    context: str
+    analysis: str | None
+    visualization: dict[str, Any] | None
+
+
+class CompareRequest(BaseModel):
+    ingredients: list[AnalyseIngredient] = Field(..., min_length=1)
+    countries: list[str] | None = Field(None, description="Only rank these countries, all of them when not given")
+
+
+class CountryImpact(BaseModel):
+    country: str
+    total: ImpactRange | None
+    missing: list[str]
+    estimated: list[str] = Field(..., description="Ingredients whose data comes from other regions")
+
+
+class CompareResponse(BaseModel):
+    countries: list[CountryImpact]
+
+
+class SupplyChainRequest(BaseModel):
+    product: str
+    type: Literal['market', 'product'] = 'market'
+    country: str
+    grams: float = Field(1000, gt=0)
+    depth: int = Field(3, ge=0, le=8)
+    cutoff: float = Field(0.01, ge=0, le=1, description="Inputs below this share of their parent's footprint are not expanded")
+
+
+class SupplyChainResponse(BaseModel):
+    total_kg: float
+    depth: int
+    cutoff: float
+    flows: list[dict[str, Any]]
+    regions: list[dict[str, Any]]
+    contributors: list[dict[str, Any]]
+
+
+limiters = {}
+# Profiler requested for the current request with the X-Profile header ("cprofile" or "sample"),
+# together with X-Profile-Token matching CFW_PROFILE_TOKEN
+requested_profile = contextvars.ContextVar('requested_profile', default=None)
+
+
+async def run_limited(kind, fn, *args):
+    """Run a blocking pipeline step in the thread pool, within the concurrency limit of its kind."""
+    limiter = limiters.setdefault(kind, asyncio.Semaphore(CONCURRENCY_LIMITS[kind]))
+    try:
+        await asyncio.wait_for(limiter.acquire(), SLOT_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail=f"Too many concurrent {kind} requests, retry later")
+    try:
+        return await run_in_threadpool(run_profiled, f"api-{fn.__name__}", requested_profile.get(), fn, *args)
+    finally:
+        limiter.release()
+
+
+def clean(value):
+    """Make lookup records JSON safe: numpy scalars to Python numbers and NaN to None."""
+    if isinstance(value, dict):
+        return {key: clean(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [clean(item) for item in value]
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def to_range(impact):
+    if impact is None:
+        return None
+    return ImpactRange(min_kg=impact[0], max_kg=impact[1], average_kg=impact[2])
+
+
+def to_search_response(query, results):
+    return SearchResponse(query=query, results={
+        source: [Match(product=product, similarity=similarity) for product, similarity in matches]
+        for source, matches in results.items()
+    })
+
+
+app = FastAPI(title="The Carbon Footprint Wizard API")
+app.router.routes.append(metrics_route())
+app.router.routes.append(memory_route())
+
+
+@app.middleware("http")
+async def count_requests(request, call_next):
+    # Only label API paths, the UI serves an open-ended set of asset paths
+    path = request.url.path if request.url.path.startswith("/api/") else "other"
+    requested_profile.set(header_mode(request.headers.get("x-profile"), request.headers.get("x-profile-token")))
+    with tracked(path):
+        response = await call_next(request)
+    http_requests.inc(path=path, status=response.status_code)
+    return response
+
+
+@app.get("/api/health")
+async def health():
+    return {'status': 'ok'}
+
+
+@app.post("/api/extract", response_model=ExtractResponse)
+async def extract(request: ExtractRequest):
+    ingredients = await run_limited('llm', engine.extract, request.recipe)
+    return ExtractResponse(ingredients=ingredients)
+
+
+@app.post("/api/search", response_model=SearchResponse)
+async def search(request: SearchRequest):
+    results = await run_limited('cpu', engine.search, [request.query], request.k)
+    return to_search_response(request.query, results[0])
+
+
+@app.post("/api/search/batch", response_model=BatchSearchResponse)
+async def search_batch(request: BatchSearchRequest):
+    results = await run_limited('cpu', engine.search, request.queries, request.k)
+    return BatchSearchResponse(results=[to_search_response(query, result) for query, result in zip(request.queries, results)])
+
+
+@app.post("/api/lookup", response_model=LookupResponse)
+async def lookup(request: LookupRequest):
+    from data_handler import impact_range
+    records = await run_limited('cpu', engine.lookup, request.source, request.product, request.country)
+    impact = impact_range(records, request.grams)
+    return LookupResponse(records=clean(records), impact_kg=clean(impact[2]) if impact else None)
+
+
+@app.post("/api/analyse", response_model=AnalyseResponse)
+async def analyse(request: AnalyseRequest):
+    if request.ingredients is not None:
+        ingredients = [
+            {'name': item.name, 'grams': item.grams, 'products': [(ref.source, ref.product) for ref in item.products]}
+            for item in request.ingredients
+        ]
+    elif request.recipe:
+        extracted = await run_limited('llm', engine.extract, request.recipe)
+        ingredients = [{'name': item['name'], 'grams': item['quantity'], 'products': []} for item in extracted]
+    else:
+        raise HTTPException(status_code=422, detail="Either `ingredients` or `recipe` is required")
+
+    kind = 'llm' if request.narrative else 'cpu'
+    result = await run_limited(kind, engine.analyse, ingredients, request.country, request.narrative, request.recipe)
+
+    impacts = [item['impact'] for item in result['ingredients'] if item['impact'] is not None]
+    total = tuple(sum(values) for values in zip(*impacts)) if impacts else None
+    return AnalyseResponse(
+        country=request.country,
+        ingredients=[
+            IngredientImpact(name=item['name'], grams=item['grams'], records=clean(item['records']),
+                             impact=to_range(clean(item['impact'])))
+            for item in result['ingredients']
+        ],
+        total=to_range(clean(total)),
+        substitutes=clean(result['substitutes']),
+        context=result['context'],
+        analysis=result['analysis'],
+        visualization=result['visualization'],
+    )
+
+
+@app.post("/api/compare", response_model=CompareResponse)
+async def compare(request: CompareRequest):
+    ingredients = [
+        {'name': item.name, 'grams': item.grams, 'products': [(ref.source, ref.product) for ref in item.products]}
+        for item in request.ingredients
+    ]
+    ranked = await run_limited('cpu', engine.compare, ingredients, request.countries)
+    return CompareResponse(countries=[
+        CountryImpact(
+            country=row['country'],
+            total=to_range(clean((row['min_kg'], row['max_kg'], row['average_kg']))) if row['min_kg'] is not None else None,
+            missing=row['missing'],
+            estimated=row['estimated'],
+        )
+        for row in ranked
+    ])
+
+
+@app.post("/api/supply-chain", response_model=SupplyChainResponse)
+async def supply_chain(request: SupplyChainRequest):
+    result = await run_limited('cpu', engine.supply_chain, request.product, request.type, request.country,
+                               request.grams, request.depth, request.cutoff)
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"No BONSAI {request.type} recipe for '{request.product}' in {request.country}")
+    return SupplyChainResponse(**clean({key: result[key] for key in SupplyChainResponse.model_fields}))
+
+
+def create_app(with_ui=True):
+    """Load the engine and optionally mount the Gradio UI at /ui on the API app."""
+    if engine.get_engine() is None:
+        raise RuntimeError("Error in data preprocessing")
+    if with_ui:
+        import gradio as gr
+        from main import create_interface
+        # create_interface sets the queue and thread budget the admission stages need
+        gr.mount_gradio_app(app, create_interface(), path="/ui")
+    return app
+
+
+if __name__ == "__main__":
+    uvicorn.run(create_app(), host=API_HOST, port=API_PORT, timeout_keep_alive=KEEP_ALIVE_SECONDS)
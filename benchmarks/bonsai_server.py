@@ -0,0 +1,133 @@
+"""Local stand-in for the BONSAI API, for exercising the page fetcher without the real service.
+
+Serves synthetic data in both pagination styles of the real API:
+- /api/footprint/ and /api/locations/: {"count", "next", "previous", "results"} pages,
+  404 for a page past the end;
+- /api/recipes/: a plain list per ?page=N, 404 past the end;
+- /api/activity-names/: one plain list.
+
+Every response can be delayed and a share of them can fail with a 503 to exercise
+the retries:
+
+    python -m benchmarks.bonsai_server --port 8765 --latency 0.05 --failure-rate 0.05
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+def footprint(i):
+    return {'id': i, 'flow_code': f'C_{i % 500}', 'description': f'product {i % 500}',
+            'unit_reference': 'Meuro' if i % 7 == 0 else 'tonnes', 'region_code': f'R{i // 500}',
+            'value': (i % 97) / 10, 'version': 'v0.9.0' if i % 5 == 0 else 'v1.0.0'}
+
+
+def recipe(i):
+    return {'id': i, 'flow_reference': f'C_{i % 500}', 'region_reference': f'R{i % 50}', 'flow_input': f'C_{i % 37}',
+            'region_inflow': f'R{i % 11}', 'value_inflow': (i % 13) / 100, 'unit_inflow': 'tonnes',
+            'version': 'v0.9.0' if i % 5 == 0 else 'v1.0.0'}
+
+
+def location(i):
+    return {'id': i, 'code': f'R{i}', 'name': f'Region {i}'}
+
+
+def activity(i):
+    return {'id': i, 'code': f'A_{i}', 'name': f'activity {i}'}
+
+
+class BonsaiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    # Set by serve()
+    sizes = {}
+    page_size = 100
+    latency = 0.0
+    failure_rate = 0.0
+    rng = random.Random(0)
+    rng_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        with self.rng_lock:
+            failed = self.rng.random() < self.failure_rate
+        if failed:
+            return self.send_json(503, {'detail': 'Service unavailable'})
+
+        parts = urlsplit(self.path)
+        page = int(dict(parse_qsl(parts.query)).get('page', 1))
+        start, stop = (page - 1) * self.page_size, page * self.page_size
+
+        if parts.path == '/api/activity-names/':
+            return self.send_json(200, [activity(i) for i in range(self.sizes['activity-names'])])
+        if parts.path == '/api/recipes/':
+            if start >= self.sizes['recipes']:
+                return self.send_json(404, {'detail': 'Not found.'})
+            return self.send_json(200, [recipe(i) for i in range(start, min(stop, self.sizes['recipes']))])
+
+        make = {'/api/footprint/': ('footprint', footprint), '/api/locations/': ('locations', location)}.get(parts.path)
+        if make is None:
+            return self.send_json(404, {'detail': 'Not found.'})
+        name, row = make
+        count = self.sizes[name]
+        if page < 1 or (start >= count and page > 1):
+            return self.send_json(404, {'detail': 'Invalid page.'})
+        base = f"http://{self.headers['Host']}{parts.path}"
+        self.send_json(200, {
+            'count': count,
+            'next': f"{base}?page={page + 1}" if stop < count else None,
+            'previous': f"{base}?page={page - 1}" if page > 1 else None,
+            'results': [row(i) for i in range(start, min(stop, count))],
+        })
+
+
+def serve(port=0, footprints=20000, recipes=20000, locations=300, activities=2000, page_size=100,
+          latency=0.0, failure_rate=0.0, seed=0):
+    """Start the stand-in server in a background thread. Returns the server, its URL is server.url."""
+    handler = type('Handler', (BonsaiHandler,), {
+        'sizes': {'footprint': footprints, 'recipes': recipes, 'locations': locations, 'activity-names': activities},
+        'page_size': page_size, 'latency': latency, 'failure_rate': failure_rate, 'rng': random.Random(seed),
+        'rng_lock': threading.Lock(),
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rows', type=int, default=20000, help="footprint and recipe rows")
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of responses failing with 503")
+    args = parser.parse_args()
+
+    server = serve(args.port, args.rows, args.rows, page_size=args.page_size,
+                   latency=args.latency, failure_rate=args.failure_rate)
+    print(f"Stand-in BONSAI API at {server.url}, Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import os
+import resource
+import statistics
+
+
+def rss_mb():
+    """Current resident set size of this process in MB (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak / 2**20 if os.uname().sysname == 'Darwin' else peak / 2**10
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    k = (len(values) - 1) * q / 100
+    low, high = int(k), min(int(k) + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def summarize(name, seconds):
+    """Print count, mean and tail latencies of a list of durations in seconds."""
+    ms = [s * 1000 for s in seconds]
+    print(f"{name}: n={len(ms)} mean={statistics.mean(ms):.2f}ms "
+          f"p50={percentile(ms, 50):.2f}ms p95={percentile(ms, 95):.2f}ms p99={percentile(ms, 99):.2f}ms")
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process so the next peak_rss_mb() covers what follows.
+
+    Only Linux can reset it. Returns False elsewhere, where the peak is the peak since start."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, since start or the last reset_peak_rss()."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if os.uname().sysname == 'Darwin' else peak / 2**10
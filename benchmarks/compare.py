@@ -0,0 +1,74 @@
+"""All-countries comparison: one get_results run per country against the vectorized pass.
+
+Builds random recipes from the catalog's products, checks that both ways give the
+same totals and reports the time per recipe:
+
+    python -m benchmarks.compare --recipes 20 --ingredients 8
+"""
+import argparse
+import math
+import random
+import time
+
+from benchmarks.common import summarize
+from catalog import get_catalog
+from data_handler import compare_countries, get_results, impact_range
+
+
+def random_recipe(catalog, rng, ingredients):
+    products = {source: list(catalog.product_names(source)) for source in catalog.sources}
+    options, selections = {}, []
+    for n in range(ingredients):
+        sources = {source: rng.sample(names, min(2, len(names))) for source, names in products.items() if names}
+        options[f"ingredient {n}"] = {'amount': rng.choice([25, 100, 250, 500]), 'sources': sources}
+        selections.append([name for names in sources.values() for name in names if rng.random() < 0.6])
+    return options, selections
+
+
+def per_country(selections, options, countries):
+    ranked = []
+    for country in countries:
+        search_query, _ = get_results(selections, options, country)
+        impacts = [impact_range(item['records'], item['grams']) for item in search_query]
+        impacts = [impact for impact in impacts if impact is not None]
+        ranked.append((country, sum(impact[2] for impact in impacts) if impacts else None))
+    return ranked
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--recipes', type=int, default=20)
+    parser.add_argument('--ingredients', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    catalog = get_catalog()
+    start = time.perf_counter()
+    countries = catalog.impact_matrix()['countries']
+    print(f"impact matrix: {len(countries)} countries, built in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    rng = random.Random(args.seed)
+    loop_seconds, vectorized_seconds = [], []
+    for _ in range(args.recipes):
+        options, selections = random_recipe(catalog, rng, args.ingredients)
+
+        start = time.perf_counter()
+        expected = dict(per_country(selections, options, countries))
+        loop_seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        ranked = compare_countries(selections, options)
+        vectorized_seconds.append(time.perf_counter() - start)
+
+        for row in ranked:
+            if (row['average_kg'] is None) != (expected[row['country']] is None) or (
+                row['average_kg'] is not None and not math.isclose(row['average_kg'], expected[row['country']], rel_tol=1e-9)
+            ):
+                raise AssertionError(f"{row['country']}: {row['average_kg']} != {expected[row['country']]}")
+
+    summarize("get_results per country", loop_seconds)
+    summarize("compare_countries", vectorized_seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""Time and peak memory of the data pipeline on synthetic data at growing scales.
+
+Generates the synthetic input files of each scale (benchmarks/synthetic_data.py)
+once under --workdir, then runs every step in a fresh interpreter from that
+directory: load_data, the catalog compile, check_product_availability,
+get_bonsai_data, get_results, create_vector_database and search_top_k. Nothing
+is downloaded:
+
+    python -m benchmarks.data_scaling --scales 1 10 100 --workdir /tmp/cfw-scaling
+
+Peak memory is the peak RSS during each step on Linux, where it can be reset, and
+the peak of the process so far elsewhere. Without --encoder (a saved
+sentence-transformers model directory), the vector database is built with a
+character-trigram hashing encoder, which times FAISS and the pipeline around it
+but not the model. A scale that runs out of memory or time is reported as failed
+with the steps it finished.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import zlib
+from pathlib import Path
+
+from benchmarks.common import peak_rss_mb, reset_peak_rss, rss_mb, summarize
+
+ROOT = Path(__file__).resolve().parent.parent
+EMBEDDING_DIMENSION = 384
+
+
+class HashingEncoder:
+    """Offline stand-in for the sentence encoder: character trigrams hashed into a fixed dimension."""
+
+    def encode(self, texts):
+        import numpy as np
+
+        embeddings = np.zeros((len(texts), EMBEDDING_DIMENSION), dtype=np.float32)
+        for row, text in enumerate(texts):
+            text = f"  {text.lower()} "
+            for n in range(len(text) - 2):
+                embeddings[row, zlib.crc32(text[n:n + 3].encode()) % EMBEDDING_DIMENSION] += 1
+        return embeddings
+
+
+def report(step, seconds, peak_mb, **extra):
+    """One result line for the parent process."""
+    print(json.dumps({'step': step, 'seconds': seconds, 'peak_mb': peak_mb, 'rss_mb': rss_mb(), **extra}), flush=True)
+
+
+def measure(step, fn, calls=None):
+    """Run fn once, or once per item of calls, and report the time and peak RSS."""
+    reset_peak_rss()
+    seconds = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        if calls is None:
+            start = time.perf_counter()
+            result = fn()
+            seconds.append(time.perf_counter() - start)
+        else:
+            for args in calls:
+                start = time.perf_counter()
+                result = fn(*args)
+                seconds.append(time.perf_counter() - start)
+    report(step, seconds, peak_rss_mb())
+    return result
+
+
+def run_steps(queries, recipes, seed):
+    """The benchmark steps, run from the directory of one scale."""
+    rng = random.Random(seed)
+    if not Path("encoder_model").exists():
+        import product_search
+        product_search.initialize_encoder = HashingEncoder
+
+    from benchmarks.compare import random_recipe
+    from catalog import get_catalog
+    from data_handler import check_product_availability, get_bonsai_data, get_results, load_data
+    from product_search import create_vector_database, search_top_k
+
+    tables = measure("load_data", load_data)
+    report("rows", [], None, rows={name: len(table) for name, table in zip(
+        ['agribalyse', 'footprints', 'recipes', 'activities', 'locations', 'bigclimatedata'], tables)})
+    del tables
+
+    catalog = measure("catalog compile", get_catalog)
+    countries = catalog.countries()
+    names = [(source, name) for source in catalog.sources for name in catalog.product_names(source)]
+    bonsai = [(name, kind) for name in catalog.product_names('BONSAI') for kind in ('product', 'market')]
+
+    measure("check_product_availability", check_product_availability,
+            [(rng.choice(names)[1], rng.choice(countries)) for _ in range(queries)])
+    measure("get_bonsai_data", get_bonsai_data,
+            [(*rng.choice(bonsai), rng.choice(countries)) for _ in range(queries)])
+    recipe_calls = []
+    for _ in range(recipes):
+        options, selections = random_recipe(catalog, rng, 8)
+        recipe_calls.append((selections, options, rng.choice(countries)))
+    measure("get_results", get_results, recipe_calls)
+
+    encoder, vector_database = measure("create_vector_database", lambda: create_vector_database(
+        lambda: {source: catalog.product_names(source) for source in catalog.sources}, update=True))
+    measure("search_top_k", search_top_k,
+            [(encoder, vector_database, f"{rng.choice(names)[1]} {rng.choice(['', 'fresh', 'organic'])}")
+             for _ in range(queries)])
+
+
+def prepare(directory, scale, seed, encoder, regenerate):
+    """Generate the files of a scale unless they are there, and clear what the run builds."""
+    from benchmarks.synthetic_data import generate
+
+    if regenerate or not (directory / "Data" / "bigclimatedb.csv").exists():
+        start = time.perf_counter()
+        counts = generate(directory, scale, seed)
+        print(f"generated scale {scale:g} in {time.perf_counter() - start:.1f}s: "
+              + ", ".join(f"{count} {name}" for name, count in counts.items()))
+    for built in (directory / "Data" / "catalog.bin", directory / "vector_database.pkl"):
+        built.unlink(missing_ok=True)
+    model = directory / "encoder_model"
+    if model.is_symlink():
+        model.unlink()
+    if encoder:
+        model.symlink_to(encoder.resolve(), target_is_directory=True)
+
+
+def run_scale(directory, args):
+    """Run the steps in a fresh interpreter from the directory. Returns (results, error)."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT), os.environ.get('PYTHONPATH')])))
+    command = [sys.executable, "-m", "benchmarks.data_scaling", "--run", "--queries", str(args.queries),
+               "--recipes", str(args.recipes), "--seed", str(args.seed)]
+    try:
+        output = subprocess.run(command, cwd=directory, env=env, capture_output=True, text=True, timeout=args.timeout)
+    except subprocess.TimeoutExpired as e:
+        stdout = e.stdout.decode() if isinstance(e.stdout, bytes) else e.stdout or ""
+        return [json.loads(line) for line in stdout.splitlines() if line.startswith('{')], f"timed out after {args.timeout}s"
+    results = [json.loads(line) for line in output.stdout.splitlines() if line.startswith('{')]
+    if output.returncode != 0:
+        lines = output.stderr.strip().splitlines()
+        return results, lines[-1] if lines else f"exit status {output.returncode}"
+    return results, None
+
+
+def cell(result):
+    if result is None:
+        return f"{'-':>22}"
+    seconds = result['seconds']
+    if len(seconds) == 1:
+        timing = f"{seconds[0]:.2f}s"
+    else:
+        timing = f"{sum(seconds) / len(seconds) * 1000:.2f}ms/call"
+    return f"{timing:>13} {result['peak_mb']:>6.0f}MB"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--workdir', type=Path, default=Path("benchmark_data"))
+    parser.add_argument('--queries', type=int, default=200, help="calls of the per-query steps")
+    parser.add_argument('--recipes', type=int, default=20, help="get_results calls, 8 ingredients each")
+    parser.add_argument('--encoder', type=Path, help="saved sentence-transformers model, hashing encoder if unset")
+    parser.add_argument('--regenerate', action='store_true')
+    parser.add_argument('--timeout', type=float, default=3600, help="seconds per scale")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_steps(args.queries, args.recipes, args.seed)
+        return
+
+    print(f"encoder: {args.encoder or 'hashing (offline stand-in)'}")
+    by_scale = {}
+    for scale in args.scales:
+        directory = (args.workdir / f"scale-{scale:g}").resolve()
+        prepare(directory, scale, args.seed, args.encoder, args.regenerate)
+        results, error = run_scale(directory, args)
+        print(f"\nscale {scale:g}")
+        for result in results:
+            if result['step'] == 'rows':
+                print("  rows: " + ", ".join(f"{count} {name}" for name, count in result['rows'].items()))
+            elif len(result['seconds']) > 1:
+                summarize(f"  {result['step']}", result['seconds'])
+            else:
+                print(f"  {result['step']}: {result['seconds'][0]:.2f}s")
+        if error:
+            print(f"  failed: {error}")
+        by_scale[scale] = {result['step']: result for result in results if result['step'] != 'rows'}
+        by_scale[scale]['overall'] = {'seconds': [sum(sum(r['seconds']) for r in by_scale[scale].values())],
+                                      'peak_mb': max((r['peak_mb'] for r in by_scale[scale].values()), default=0)}
+
+    steps = ("load_data", "catalog compile", "check_product_availability", "get_bonsai_data", "get_results",
+             "create_vector_database", "search_top_k", "overall")
+    print(f"\n{'time and peak RSS':<28}" + "".join(f"{'scale ' + format(scale, 'g'):>22}" for scale in by_scale))
+    for step in steps:
+        print(f"{step:<28}" + "".join(cell(results.get(step)) for results in by_scale.values()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Throughput of the BONSAI page fetcher against the local stand-in API.
+
+Downloads both pagination styles with one worker (the old sequential behaviour)
+and with a pool of workers, checks that every item arrived once and in order,
+and reports pages/s:
+
+    python -m benchmarks.fetcher --workers 1 8 --latency 0.05 --failure-rate 0.02
+"""
+import argparse
+import contextlib
+import io
+import time
+
+import data_preprocessing
+from benchmarks.bonsai_server import serve
+
+
+def check(name, items, expected):
+    ids = [item['id'] for item in items]
+    if ids != list(range(expected)):
+        raise AssertionError(f"{name}: expected ids 0..{expected - 1} in order, got {len(ids)} items")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--failure-rate', type=float, default=0.02)
+    args = parser.parse_args()
+
+    server = serve(footprints=args.rows, recipes=args.rows, page_size=args.page_size,
+                   latency=args.latency, failure_rate=args.failure_rate)
+    # Keep the retries of injected failures short
+    data_preprocessing.BACKOFF_SECONDS = 0.01
+    pages = -(-args.rows // args.page_size)
+    print(f"{args.rows} rows per endpoint, {pages} pages, {args.latency * 1000:g} ms latency, "
+          f"{args.failure_rate:.0%} failures")
+
+    for workers in args.workers:
+        session = data_preprocessing.create_session(workers)
+        for name, fetch_all, path in [
+            ('next links', data_preprocessing.get_all_pages, '/api/footprint/'),
+            ('?page=N', data_preprocessing.get_all_non_page, '/api/recipes/'),
+        ]:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                items = fetch_all(f"{server.url}{path}", session, workers)
+            elapsed = time.perf_counter() - start
+            check(name, items, args.rows)
+            print(f"workers={workers:<3} {name:<11} {elapsed:6.2f}s  {pages / elapsed:7.1f} pages/s  "
+                  f"{len(items) / elapsed:9.0f} items/s")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
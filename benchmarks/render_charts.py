@@ -0,0 +1,64 @@
+"""Benchmark create_impact_plot: render time and RSS growth over many analyses.
+
+Run from the repository root:
+    python -m benchmarks.render_charts --analyses 1000 --repeat-ratio 0.3
+"""
+import argparse
+import gc
+import io
+import random
+import time
+
+from benchmarks.common import rss_mb, summarize
+from llm_loop import create_impact_plot, render_impact_charts
+
+INGREDIENTS = ['Tomato', 'Onion', 'Beef', 'Cheese', 'Pasta', 'Olive oil', 'Garlic', 'Basil',
+               'Chicken', 'Rice', 'Butter', 'Milk', 'Flour', 'Egg', 'Potato', 'Cooking']
+
+
+def random_analysis(rng):
+    ingredients = rng.sample(INGREDIENTS, rng.randint(3, 10))
+    impacts = [round(rng.uniform(0.001, 3.0), 3) for _ in ingredients]
+    return {'visualization_data': {'ingredients': ingredients, 'impacts': impacts}}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--analyses', type=int, default=1000)
+    parser.add_argument('--repeat-ratio', type=float, default=0.3,
+                        help="share of analyses that repeat an earlier one and can hit the cache")
+    parser.add_argument('--format', default='webp', help="image format Gradio encodes gr.Plot figures to")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    seen = []
+    timings = []
+    start_rss = rss_mb()
+
+    for n in range(args.analyses):
+        if seen and rng.random() < args.repeat_ratio:
+            data = rng.choice(seen)
+        else:
+            data = random_analysis(rng)
+            seen.append(data)
+
+        start = time.perf_counter()
+        figures = create_impact_plot(data)
+        for figure in figures:
+            # Encode the figure the way gr.Plot does before sending it to the browser
+            figure.savefig(io.BytesIO(), format=args.format)
+        timings.append(time.perf_counter() - start)
+
+        if (n + 1) % 100 == 0:
+            gc.collect()
+            print(f"{n + 1} analyses, RSS {rss_mb():.1f} MB")
+
+    gc.collect()
+    summarize("render + encode", timings)
+    print(f"cache: {render_impact_charts.cache_info()}")
+    print(f"RSS growth over {args.analyses} analyses: {rss_mb() - start_rss:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
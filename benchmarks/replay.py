@@ -0,0 +1,174 @@
+"""Replay a recorded trace (recorder.py) through the Gradio pipeline, offline.
+
+Every recorded recipe submission and product selection is run again through the
+main.py handlers, in order and in their sessions, with the LLM outputs served
+from the trace, so no OpenAI key or network is needed. The replay is recorded to
+its own trace, which gives the latency percentiles per handler and stage, and its
+options, impacts and data context are diffed with the recorded ones:
+
+    python -m benchmarks.replay traces/requests.jsonl --output traces/replay.jsonl
+
+The LLM outputs are served at once, so the latencies are those of the pipeline
+around the LLM. --llm-latency spreads the recorded LLM time over the streamed
+chunks instead.
+"""
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from benchmarks.common import summarize
+
+CHUNK_SIZE = 20
+SHOW_DIFFS = 5
+
+
+class ReplayClient:
+    """Serves the recorded LLM outputs of one request, in order, in the shape of the OpenAI client."""
+
+    def __init__(self, outputs, latency=False):
+        self.outputs = list(outputs)
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, stream=False, **kwargs):
+        if not self.outputs:
+            raise RuntimeError("No recorded LLM output left for this request")
+        output = self.outputs.pop(0)
+        if not stream:
+            if self.latency:
+                time.sleep(output['seconds'])
+            function_call = SimpleNamespace(arguments=output['arguments']) if output['arguments'] is not None else None
+            message = SimpleNamespace(content=output['content'], function_call=function_call)
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+        return self.stream(output)
+
+    def stream(self, output):
+        content, arguments = output['content'] or "", output['arguments'] or ""
+        chunks = max(1, math.ceil(len(content) / CHUNK_SIZE) + math.ceil(len(arguments) / CHUNK_SIZE))
+        for field, text in (('content', content), ('arguments', arguments)):
+            for start in range(0, len(text), CHUNK_SIZE):
+                if self.latency:
+                    time.sleep(output['seconds'] / chunks)
+                piece = text[start:start + CHUNK_SIZE]
+                delta = SimpleNamespace(
+                    content=piece if field == 'content' else None,
+                    function_call=SimpleNamespace(arguments=piece) if field == 'arguments' else None,
+                )
+                yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=delta)])
+
+
+def new_records(path, offset):
+    """Records appended to a trace since offset, and the new offset."""
+    if not path.exists():
+        return [], offset
+    with open(path) as f:
+        f.seek(offset)
+        lines = f.read()
+        offset = f.tell()
+    return [json.loads(line) for line in lines.splitlines() if line.strip()], offset
+
+
+def same_value(a, b):
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(same_value(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) or isinstance(b, float):
+        return a is not None and b is not None and math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-12)
+    return a == b
+
+
+DIFF_FIELDS = {
+    'recipe': ['error', 'ingredients', 'options'],
+    'selection': ['error', 'what_if', 'changed', 'impacts', 'total', 'context'],
+}
+
+
+def diff(recorded, replayed):
+    """The fields of a record whose replayed value differs from the recorded one."""
+    return [field for field in DIFF_FIELDS[recorded['event']]
+            if not same_value(recorded.get(field), replayed.get(field))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trace', type=Path)
+    parser.add_argument('--output', type=Path, help="trace of the replay, a temporary file if unset")
+    parser.add_argument('--repeat', type=int, default=1, help="replay the trace this many times")
+    parser.add_argument('--llm-latency', action='store_true', help="wait the recorded LLM time while streaming")
+    parser.add_argument('--show', type=int, default=SHOW_DIFFS, help="differences printed per field")
+    args = parser.parse_args()
+
+    with open(args.trace) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    output = args.output or Path(tempfile.mkdtemp()) / "replay.jsonl"
+    output.unlink(missing_ok=True)
+    os.environ["CFW_RECORD"] = str(output)
+
+    # The LLM outputs come from the trace, so no OpenAI client is needed
+    import extraction
+    extraction.get_openai_client = lambda: None
+    import main as app
+    from engine import get_engine
+    from session_store import open_session
+
+    engine = get_engine()
+    if engine is None:
+        raise SystemExit("Error in data preprocessing")
+
+    replayed, skipped, offset = [], 0, 0
+    for _ in range(args.repeat):
+        sessions = {}
+        for record in records:
+            engine['client'] = ReplayClient(record['llm'], args.llm_latency)
+            with contextlib.redirect_stdout(io.StringIO()):
+                if record['event'] == 'recipe':
+                    session_id = sessions[record['session']] = open_session()
+                    for _ in app.process_recipe(record['recipe'], record['country'], session_id):
+                        pass
+                elif record['session'] in sessions:
+                    selections = record['selections'] + [None] * (app.MAX_INGREDIENTS - len(record['selections']))
+                    for _ in app.process_form(*selections, sessions[record['session']], [], record['country']):
+                        pass
+                else:
+                    skipped += 1
+                    continue
+            new, offset = new_records(output, offset)
+            replayed.append((record, new[-1] if new else {'error': "not recorded"}))
+
+    print(f"{len(replayed)} requests replayed from {args.trace}, {skipped} selections without their recipe skipped, "
+          f"replay trace in {output}")
+    for event in ('recipe', 'selection'):
+        pairs = [(recorded, new) for recorded, new in replayed if recorded['event'] == event]
+        if not pairs:
+            continue
+        print(f"\n{event} ({len(pairs)})")
+        summarize("  recorded", [recorded['seconds'] for recorded, _ in pairs])
+        summarize("  replayed", [new['seconds'] for _, new in pairs if 'seconds' in new])
+        first = [new['first_output_seconds'] for _, new in pairs if 'first_output_seconds' in new]
+        if first:
+            summarize("  replayed, first output", first)
+        stages = sorted({stage for _, new in pairs for stage in new.get('stages', {})})
+        for stage in stages:
+            summarize(f"  stage {stage}", [new['stages'][stage] for _, new in pairs if stage in new.get('stages', {})])
+
+        differences = {}
+        for recorded, new in pairs:
+            for field in diff(recorded, new):
+                differences.setdefault(field, []).append((recorded, new))
+        if not differences:
+            print("  outputs: no differences")
+        for field, examples in differences.items():
+            print(f"  outputs: {field} differs in {len(examples)} of {len(pairs)}")
+            for recorded, new in examples[:args.show]:
+                print(f"    session {recorded['session']}: recorded {json.dumps(recorded.get(field))[:200]}")
+                print(f"    {' ' * len('session ' + str(recorded['session']))}  replayed {json.dumps(new.get(field))[:200]}")
+
+
+if __name__ == '__main__':
+    main()
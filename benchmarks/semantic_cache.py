@@ -0,0 +1,124 @@
+"""Hit rate, latency and reuse errors of the get_similar_items semantic cache per threshold.
+
+Runs a stream of ingredient queries through get_similar_items: common
+ingredients, popular ones more often, written in varying ways ("red onion",
+"Red onions", "onion, red", "chopped red onion"). The stream is first run with
+the cache off, which gives the reference options of every query. Then it is run
+again from an empty cache at each threshold, reporting the hit rate, the hits
+whose options differ from the reference and the latency per query:
+
+    python -m benchmarks.semantic_cache --queries 500 --thresholds 0.85 0.9 0.95 0.98
+
+A lower threshold gives more hits and more reuse of options that a search would
+not have returned. Run it from a directory with the data and the vector
+database. Without a saved encoder_model, the character-trigram encoder of
+benchmarks/data_scaling.py is used, whose similarities are much higher for
+spelling variants than those of the sentence encoder; the thresholds it
+suggests do not carry over.
+"""
+import argparse
+import contextlib
+import io
+import random
+import time
+from pathlib import Path
+
+import semantic_cache
+from benchmarks.common import summarize
+from data_handler import get_similar_items
+
+INGREDIENTS = [
+    "red onion", "garlic", "olive oil", "tomato", "chicken breast", "beef mince", "whole milk", "butter",
+    "cheddar cheese", "white rice", "pasta", "potato", "carrot", "egg", "wheat flour", "sugar", "salmon",
+    "green beans", "tomato paste", "mozzarella", "bell pepper", "lentils", "chickpeas", "greek yogurt",
+    "pork sausage", "spinach", "mushrooms", "cream", "bread", "lemon",
+]
+PREFIXES = ["chopped", "fresh", "sliced", "organic"]
+
+
+def variant(name, rng):
+    """The ingredient as someone might write it in a recipe."""
+    words = name.split()
+    forms = [name, name.capitalize(), name + "s", f"{rng.choice(PREFIXES)} {name}"]
+    if len(words) > 1:
+        forms.append(f"{words[-1]}, {' '.join(words[:-1])}")
+    return rng.choice(forms)
+
+
+def workload(queries, seed):
+    rng = random.Random(seed)
+    weights = [1 / rank for rank in range(1, len(INGREDIENTS) + 1)]
+    return [variant(rng.choices(INGREDIENTS, weights)[0], rng) for _ in range(queries)]
+
+
+def options_of(result):
+    return {(source, item) for data in result.values() for source, items in data['sources'].items() for item in items}
+
+
+def run(stream, encoder, vector_database, country):
+    """Options and seconds per query, and whether each query was served from the cache."""
+    from product_search import search_top_k
+
+    options, seconds, hits = [], [], []
+    for query in stream:
+        cached = len(semantic_cache.entries)
+        start = time.perf_counter()
+        result = get_similar_items(search_top_k, [{'name': query, 'grams': 100}], encoder, vector_database, country)
+        seconds.append(time.perf_counter() - start)
+        options.append(options_of(result))
+        hits.append(semantic_cache.MAX_ENTRIES > 0 and len(semantic_cache.entries) == cached)
+    return options, seconds, hits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0.8, 0.85, 0.9, 0.95, 0.98, 1.0])
+    parser.add_argument('--country', default="Netherlands")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from catalog import get_catalog
+    import product_search
+    if not Path("encoder_model").exists():
+        from benchmarks.data_scaling import HashingEncoder
+        print("No encoder_model, using the character-trigram encoder")
+        product_search.initialize_encoder = HashingEncoder
+
+    catalog = get_catalog()
+    with contextlib.redirect_stdout(io.StringIO()):
+        encoder, vector_database = product_search.create_vector_database(
+            lambda: {source: catalog.product_names(source) for source in catalog.sources}
+        )
+
+    stream = workload(args.queries, args.seed)
+    print(f"{len(stream)} queries, {len(set(stream))} distinct, from {len(INGREDIENTS)} ingredients, "
+          f"country {args.country}")
+
+    max_entries = semantic_cache.MAX_ENTRIES
+    semantic_cache.MAX_ENTRIES = 0
+    run(stream[:10], encoder, vector_database, args.country)  # warm-up
+    reference, reference_seconds, _ = run(stream, encoder, vector_database, args.country)
+    summarize("no cache", reference_seconds)
+
+    # Large enough that nothing is evicted, so a query is a hit exactly when it adds no entry
+    semantic_cache.MAX_ENTRIES = max(max_entries, len(stream))
+    for threshold in args.thresholds:
+        semantic_cache.clear()
+        semantic_cache.SIMILARITY_THRESHOLD = threshold
+        options, seconds, hits = run(stream, encoder, vector_database, args.country)
+        hit_count = sum(hits)
+        different = sum(1 for hit, got, expected in zip(hits, options, reference) if hit and got != expected)
+        print(f"\nthreshold {threshold:g}: hit rate {hit_count / len(stream):.1%}, "
+              f"{different} hits ({different / max(hit_count, 1):.1%}) with other options than a search, "
+              f"{len(semantic_cache.entries)} queries cached")
+        summarize("  all", seconds)
+        if hit_count:
+            summarize("  hits", [s for s, hit in zip(seconds, hits) if hit])
+        if hit_count < len(stream):
+            summarize("  misses", [s for s, hit in zip(seconds, hits) if not hit])
+        print(f"  speedup {sum(reference_seconds) / sum(seconds):.2f}x over no cache")
+
+
+if __name__ == '__main__':
+    main()
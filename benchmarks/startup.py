@@ -0,0 +1,74 @@
+"""Startup-time benchmark: module import time, catalog open and compile time and encoder-load time.
+
+Every measurement runs in a fresh interpreter so nothing is cached between
+runs (apart from the OS page cache, so the first repeat may be slower):
+
+    python -m benchmarks.startup --repeats 5
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+IMPORTS = ['data_preprocessing', 'catalog', 'data_handler', 'product_search', 'extraction', 'llm_loop', 'engine', 'main', 'api']
+
+PHASES = {
+    'catalog open': ("import catalog", "catalog.get_catalog()"),
+    'catalog compile': ("import catalog", "catalog.build_catalog(catalog.CATALOG_PATH.with_suffix('.bench'))"),
+    'encoder load': ("import product_search", "product_search.initialize_encoder()"),
+    'vector database load': (
+        "import pickle, faiss",
+        "pickle.load(open('vector_database.pkl', 'rb'))"
+    ),
+    'full engine': ("import engine", "engine.get_engine()"),
+}
+
+TIMER = """
+import time, json, contextlib, io
+{setup}
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    {statement}
+print(json.dumps(time.perf_counter() - start))
+"""
+
+
+def measure(setup, statement):
+    output = subprocess.run(
+        [sys.executable, "-c", TIMER.format(setup=setup, statement=statement)],
+        capture_output=True, text=True
+    )
+    if output.returncode != 0:
+        raise RuntimeError(output.stderr.strip().splitlines()[-1] if output.stderr.strip() else "failed")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def report(name, setup, statement, repeats):
+    try:
+        seconds = [measure(setup, statement) for _ in range(repeats)]
+    except RuntimeError as e:
+        print(f"{name:<28} failed: {e}")
+        return
+    print(f"{name:<28} median {statistics.median(seconds):7.3f}s  min {min(seconds):7.3f}s  max {max(seconds):7.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--skip-phases', action='store_true', help="only measure import times")
+    args = parser.parse_args()
+
+    print("Import time (fresh interpreter per run)")
+    for module in IMPORTS:
+        report(f"import {module}", "", f"import {module}", args.repeats)
+
+    if args.skip_phases:
+        return
+    print("\nStartup phases (fresh interpreter per run, imports excluded)")
+    for name, (setup, statement) in PHASES.items():
+        report(name, setup, statement, args.repeats)
+
+
+if __name__ == '__main__':
+    main()
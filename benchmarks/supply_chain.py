@@ -0,0 +1,82 @@
+"""Supply-chain contribution analysis over the full BONSAI recipe table.
+
+Builds the recipe graph and analyses every node with a recipe (or a sample) at
+each depth: cold, memoised, and, up to --naive-depth, by expanding every path
+separately, which is what the tier-by-tier expansion avoids. Checks that the
+naive expansion gives the same totals:
+
+    python -m benchmarks.supply_chain --depths 1 2 3 4 --cutoff 0.01 --nodes 500
+"""
+import argparse
+import math
+import random
+import time
+
+import numpy as np
+
+from benchmarks.common import rss_mb, summarize
+import supply_chain
+
+
+def expand_paths(graph, node, depth, cutoff, scale=1.0):
+    """Total emissions of a node by walking every path separately."""
+    start, stop = graph['offsets'][node], graph['offsets'][node + 1]
+    total = 0.0
+    for edge in range(start, stop):
+        emission, child = graph['emission'][edge], graph['child'][edge]
+        if (depth > 0 and child >= 0 and emission != 0 and abs(emission) >= cutoff * abs(graph['total'][node])
+                and graph['total'][child] != 0):
+            total += expand_paths(graph, child, depth - 1, cutoff, scale * emission / graph['total'][child])
+        else:
+            total += scale * emission
+    return total
+
+
+def timed_calls(fn, nodes):
+    seconds = []
+    for node in nodes:
+        start = time.perf_counter()
+        fn(node)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 2, 3, 4])
+    parser.add_argument('--cutoff', type=float, default=supply_chain.DEFAULT_CUTOFF)
+    parser.add_argument('--nodes', type=int, default=0, help="analyse a random sample of nodes, all of them when 0")
+    parser.add_argument('--naive-depth', type=int, default=2, help="deepest depth also expanded path by path")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from data_handler import get_tables
+    recipes = get_tables()['recipes']
+    before = rss_mb()
+    start = time.perf_counter()
+    graph = supply_chain.build_graph(recipes)
+    print(f"graph: {len(recipes)} recipe rows, {len(graph['nodes'])} nodes, {len(graph['leaves'])} contributors, "
+          f"built in {time.perf_counter() - start:.2f}s, +{rss_mb() - before:.0f} MB")
+
+    nodes = list(range(len(graph['nodes'])))
+    if args.nodes:
+        nodes = random.Random(args.seed).sample(nodes, min(args.nodes, len(nodes)))
+    supply_chain.MEMO_SIZE = max(supply_chain.MEMO_SIZE, len(nodes))
+
+    for depth in args.depths:
+        graph['memo'].clear()
+        print(f"\ndepth {depth}, cutoff {args.cutoff:g}, {len(nodes)} nodes")
+        summarize("  cold", timed_calls(lambda node, depth=depth: supply_chain.contributions(graph, node, depth, args.cutoff), nodes))
+        summarize("  memoised", timed_calls(lambda node, depth=depth: supply_chain.contributions(graph, node, depth, args.cutoff), nodes))
+        if depth <= args.naive_depth:
+            summarize("  path by path", timed_calls(lambda node, depth=depth: expand_paths(graph, node, depth, args.cutoff), nodes))
+            for node in nodes[:50]:
+                expected = expand_paths(graph, node, depth, args.cutoff)
+                total = np.sum(supply_chain.contributions(graph, node, depth, args.cutoff)[1])
+                if not math.isclose(total, expected, rel_tol=1e-9, abs_tol=1e-12):
+                    raise AssertionError(f"node {node}: {total} != {expected}")
+        print(f"  RSS {rss_mb():.0f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""Synthetic input files in the layout and schema of the real ones, at any scale.
+
+Writes Data/BONSAI/bonsai_{footprints,recipes,locations,activity-names}.json,
+Data/agribalyse_data.csv and Data/bigclimatedb.csv under a directory, so the app,
+the catalog and the benchmarks run against them from that directory without any
+download:
+
+    python -m benchmarks.synthetic_data /tmp/synthetic-10 --scale 10
+
+Scale 1 is about the size of the downloaded data. The number of products, and so of
+footprints, recipe rows, Agribalyse rows and BigClimateDB foods, grows with the
+scale; the countries do not. Some footprint and recipe rows have another version or
+unit, like in the API, and are dropped by the download filters. The files are
+written row by row, so generating them takes little memory at any scale.
+"""
+import argparse
+import csv
+import json
+import random
+from pathlib import Path
+
+# Rows at scale 1
+BONSAI_PRODUCTS = 150
+AGRIBALYSE_PRODUCTS = 2500
+BIGCLIMATE_FOODS = 500
+# Share of the locations a product has a footprint in, recipe inputs per footprint
+# and share of rows with another version or unit
+FOOTPRINT_COVERAGE = 0.6
+RECIPE_INPUTS = 8
+FILTERED_SHARE = 0.15
+
+LOCATIONS = {
+    'AT': "Austria", 'AU': "Australia", 'BE': "Belgium", 'BG': "Bulgaria", 'BR': "Brazil", 'CA': "Canada",
+    'CH': "Switzerland", 'CN': "China", 'CY': "Cyprus", 'CZ': "Czechia", 'DE': "Germany", 'DK': "Denmark",
+    'EE': "Estonia", 'ES': "Spain", 'FI': "Finland", 'FR': "France", 'GB': "United Kingdom", 'GR': "Greece",
+    'HR': "Croatia", 'HU': "Hungary", 'ID': "Indonesia", 'IE': "Ireland", 'IN': "India", 'IT': "Italy",
+    'JP': "Japan", 'KR': "South Korea", 'LT': "Lithuania", 'LU': "Luxembourg", 'LV': "Latvia", 'MT': "Malta",
+    'MX': "Mexico", 'NL': "Netherlands", 'NO': "Norway", 'PL': "Poland", 'PT': "Portugal", 'RO': "Romania",
+    'RU': "Russia", 'SE': "Sweden", 'SI': "Slovenia", 'SK': "Slovakia", 'TR': "Turkey", 'TW': "Taiwan",
+    'US': "United States", 'ZA': "South Africa",
+    # Rest-of-world regions, with a footprint but no country
+    'WA': "RoW Asia and Pacific", 'WE': "RoW Europe", 'WF': "RoW Africa", 'WL': "RoW America", 'WM': "RoW Middle East",
+}
+BIGCLIMATE_COUNTRIES = ["Denmark", "United Kingdom", "France", "Netherlands", "Spain"]
+
+FOODS = [
+    "wheat", "rice", "maize", "barley", "oats", "rye", "potatoes", "sugar beet", "sugar cane", "soybeans",
+    "rapeseed", "sunflower seeds", "olives", "tomatoes", "onions", "carrots", "cabbage", "lettuce", "cucumbers",
+    "peppers", "apples", "pears", "oranges", "lemons", "bananas", "grapes", "strawberries", "peaches", "cherries",
+    "almonds", "walnuts", "hazelnuts", "peanuts", "lentils", "chickpeas", "beans", "peas", "coffee", "cocoa",
+    "tea", "beef", "veal", "pork", "lamb", "chicken", "turkey", "duck", "eggs", "milk", "butter", "cheese",
+    "yoghurt", "cream", "salmon", "tuna", "cod", "shrimps", "mussels", "honey", "mushrooms",
+]
+PREPARATIONS = [
+    "raw", "fresh", "frozen", "dried", "canned", "cooked", "roasted", "smoked", "organic", "processed",
+    "peeled", "sliced", "ground", "whole", "refined", "fermented", "salted", "pasteurised", "powdered", "concentrated",
+]
+AGRIBALYSE_GROUPS = {
+    "fruits, vegetables, legumes and oilseeds": ["vegetables", "fruits", "legumes", "nuts and oilseeds"],
+    "meat, eggs, fish": ["raw meats", "cooked meats", "eggs", "fish-based products and seafood"],
+    "milk and dairy products": ["milks", "cheeses", "fresh dairy products"],
+    "cereal products": ["pasta, rice, and cereals", "breads and bakery products", "flours and doughs"],
+    "sugar and confectionery": ["sugars, honeys, and similar products", "chocolates and cocoa products"],
+}
+AGRIBALYSE_PHASES = ['agriculture', 'processing', 'packaging', 'transportation', 'retail', 'consumption']
+BIGCLIMATE_PHASES = ["Agriculture", "iLUC", "Food processing", "Packaging", "Transport", "Retail"]
+BIGCLIMATE_CATEGORIES = ["Fruits and vegetables", "Meat", "Dairy", "Fish and seafood", "Cereals", "Beverages", "Sweets"]
+UNITS = ['tonnes', 'Meuro', 'TJ', 'items', 'ha*year']
+
+
+def product_names(count, rng, style):
+    """`count` distinct food names, numbered variants once the word combinations run out."""
+    combinations = [(food, preparation) for food in FOODS for preparation in PREPARATIONS]
+    rng.shuffle(combinations)
+    names = []
+    for n in range(count):
+        food, preparation = combinations[n % len(combinations)]
+        variant = n // len(combinations)
+        if style == 'bonsai':
+            name = f"{preparation} {food}"
+        else:
+            name = f"{food.capitalize()}, {preparation}"
+        names.append(f"{name}, variant {variant}" if variant else name)
+    return names
+
+
+def write_json_rows(path, rows):
+    """Write an iterable of dicts as a JSON list, one row at a time."""
+    with open(path, 'w') as f:
+        f.write('[')
+        for n, row in enumerate(rows):
+            if n:
+                f.write(', ')
+            f.write(json.dumps(row))
+        f.write(']')
+
+
+def write_csv_rows(path, columns, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def bonsai_activities(products):
+    """Product and market activities of every product, as in the activity-names endpoint."""
+    return [
+        {'code': f"{prefix}_{n}", 'flow_type': flow_type, 'description': name}
+        for n, name in enumerate(products)
+        for prefix, flow_type in (('C', 'product'), ('M', 'market'))
+    ]
+
+
+def bonsai_footprints(activities, rng):
+    """Footprint rows of the activities in a share of the locations, plus rows the filters drop."""
+    row_id = 0
+    for activity in activities:
+        for code in LOCATIONS:
+            if rng.random() > FOOTPRINT_COVERAGE:
+                continue
+            row_id += 1
+            yield {'id': row_id, 'flow_code': activity['code'], 'description': activity['description'],
+                   'unit_reference': 'tonnes', 'region_code': code, 'value': round(rng.lognormvariate(0.5, 1.0), 4),
+                   'version': 'v1.0.0'}
+            if rng.random() < FILTERED_SHARE:
+                row_id += 1
+                yield {'id': row_id, 'flow_code': activity['code'], 'description': activity['description'],
+                       'unit_reference': rng.choice(['Meuro', 'tonnes']), 'region_code': code,
+                       'value': round(rng.lognormvariate(0.5, 1.0), 4), 'version': 'v0.9.0'}
+
+
+def bonsai_recipes(keys, activities, rng):
+    """A recipe per (flow code, region code, footprint): direct emissions, inputs from other
+    activities and the remainder."""
+    codes = [activity['code'] for activity in activities]
+    regions = list(LOCATIONS)
+    row_id = 0
+    for flow_code, region_code, value in keys:
+        reference = {'flow_reference': flow_code, 'region_reference': region_code, 'unit_reference': 'tonnes'}
+        # The emissions of a recipe add up to its footprint
+        weights = [rng.random() for _ in range(RECIPE_INPUTS + 2)]
+        scale = value / sum(weights)
+        inputs = ['direct'] + [rng.choice(codes) for _ in range(RECIPE_INPUTS)] + ['other']
+        for flow, weight in zip(inputs, weights):
+            row_id += 1
+            yield {'id': row_id, **reference, 'flow_input': flow,
+                   'region_inflow': None if flow in ('direct', 'other') else rng.choice(regions),
+                   'value_inflow': None if flow in ('direct', 'other') else round(rng.random(), 4),
+                   'unit_inflow': None if flow in ('direct', 'other') else rng.choice(UNITS),
+                   'value_emission': round(weight * scale, 6), 'version': 'v1.0.0'}
+        if rng.random() < FILTERED_SHARE:
+            row_id += 1
+            yield {'id': row_id, **reference, 'flow_input': rng.choice(codes), 'region_inflow': rng.choice(regions),
+                   'value_inflow': round(rng.random(), 4), 'unit_inflow': 'tonnes',
+                   'value_emission': round(rng.random(), 6), 'version': 'v0.9.0'}
+
+
+def agribalyse_rows(count, rng):
+    """Rows in the columns process_agribalyse writes, with the total the sum of the phases."""
+    groups = [(group, subgroup) for group, subgroups in AGRIBALYSE_GROUPS.items() for subgroup in subgroups]
+    for name in product_names(count, rng, 'agribalyse'):
+        phases = [round(rng.lognormvariate(-1.5, 1.0), 5) for _ in AGRIBALYSE_PHASES]
+        yield [*rng.choice(groups), name, round(rng.uniform(1, 5), 2), *phases, round(sum(phases), 5)]
+
+
+def bigclimate_rows(count, rng):
+    """Rows in the columns process_bigclimate writes: every food in each of its countries."""
+    for name in product_names(count, rng, 'bigclimate'):
+        category = rng.choice(BIGCLIMATE_CATEGORIES)
+        base = [rng.lognormvariate(-1.0, 1.0) for _ in BIGCLIMATE_PHASES]
+        for region in BIGCLIMATE_COUNTRIES:
+            phases = [round(value * rng.uniform(0.8, 1.2), 4) for value in base]
+            yield [name.capitalize(), category, round(sum(phases), 4), *phases, region]
+
+
+def generate(directory, scale=1, seed=0):
+    """Write the synthetic input files of a scale under directory/Data. Returns their row counts."""
+    rng = random.Random(seed)
+    bonsai_dir = Path(directory) / "Data" / "BONSAI"
+    bonsai_dir.mkdir(parents=True, exist_ok=True)
+
+    activities = bonsai_activities(product_names(int(BONSAI_PRODUCTS * scale), rng, 'bonsai'))
+    counts = {'activity-names': len(activities), 'locations': len(LOCATIONS)}
+    write_json_rows(bonsai_dir / "bonsai_activity-names.json", activities)
+    write_json_rows(bonsai_dir / "bonsai_locations.json",
+                    ({'id': n, 'code': code, 'name': name} for n, (code, name) in enumerate(LOCATIONS.items())))
+
+    # Recipes are written for the footprints kept by the download filters
+    keys = []
+    def footprint_rows():
+        for row in bonsai_footprints(activities, rng):
+            counts['footprints'] = counts.get('footprints', 0) + 1
+            if row['version'] == 'v1.0.0':
+                keys.append((row['flow_code'], row['region_code'], row['value']))
+            yield row
+    write_json_rows(bonsai_dir / "bonsai_footprints.json", footprint_rows())
+
+    def recipe_rows():
+        for row in bonsai_recipes(keys, activities, rng):
+            counts['recipes'] = counts.get('recipes', 0) + 1
+            yield row
+    write_json_rows(bonsai_dir / "bonsai_recipes.json", recipe_rows())
+
+    agribalyse = list(agribalyse_rows(int(AGRIBALYSE_PRODUCTS * scale), rng))
+    counts['agribalyse'] = len(agribalyse)
+    write_csv_rows(Path(directory) / "Data" / "agribalyse_data.csv",
+                   ['group', 'subgroup', 'product_name', 'dqr', *AGRIBALYSE_PHASES, 'total'], agribalyse)
+
+    bigclimate = list(bigclimate_rows(int(BIGCLIMATE_FOODS * scale), rng))
+    counts['bigclimatedb'] = len(bigclimate)
+    write_csv_rows(Path(directory) / "Data" / "bigclimatedb.csv",
+                   ["Name", "Category", "Total kg CO2-eq/kg", *BIGCLIMATE_PHASES, "region"], bigclimate)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic input files under a directory.")
+    parser.add_argument('directory', type=Path)
+    parser.add_argument('--scale', type=float, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    counts = generate(args.directory, args.scale, args.seed)
+    print(f"scale {args.scale:g} in {args.directory / 'Data'}: "
+          + ", ".join(f"{count} {name}" for name, count in counts.items()))
+
+
+if __name__ == '__main__':
+    main()
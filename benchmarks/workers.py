@@ -0,0 +1,132 @@
+"""Per-worker memory and aggregate throughput of serve.py compared with a single process.
+
+Starts `serve.py --workers N` for every N given, drives /api/search and /api/search/batch
+with keep-alive connections from concurrent clients, and reads the workers'
+memory from /proc/<pid>/smaps_rollup (Linux):
+
+    python -m benchmarks.workers --workers 1 4 --duration 30 --clients 16
+
+RSS counts shared pages in every worker, PSS splits them between the processes
+sharing them and USS is the memory private to one worker, i.e. what each extra
+worker really costs.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+from benchmarks.common import summarize
+
+QUERIES = ['red onion', 'tomato', 'beef mince', 'cheddar cheese', 'olive oil', 'spaghetti', 'garlic',
+           'basil', 'chicken breast', 'white rice', 'butter', 'whole milk', 'wheat flour', 'egg', 'potato']
+
+
+def children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def memory_mb(pid):
+    """RSS, PSS and USS of a process in MB."""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    uss = fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    return fields.get('Rss', 0), fields.get('Pss', 0), uss
+
+
+def wait_until_ready(port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/api/health')
+            if connection.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(1)
+    return False
+
+
+def client_loop(port, stop_at, latencies, errors, seed):
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    while time.time() < stop_at:
+        if rng.random() < 0.5:
+            path, body = '/api/search', {'query': rng.choice(QUERIES), 'k': 3}
+        else:
+            path, body = '/api/search/batch', {'queries': rng.sample(QUERIES, 5), 'k': 3}
+        start = time.perf_counter()
+        try:
+            connection.request('POST', path, json.dumps(body), {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException):
+            errors.append('connection')
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+def run(workers, args):
+    server = subprocess.Popen([sys.executable, 'serve.py', '--workers', str(workers), '--port', str(args.port)])
+    try:
+        if not wait_until_ready(args.port, args.startup_timeout):
+            print(f"workers={workers}: server did not become ready")
+            return
+
+        latencies, errors = [], []
+        stop_at = time.time() + args.duration
+        threads = [threading.Thread(target=client_loop, args=(args.port, stop_at, latencies, errors, n))
+                   for n in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        print(f"\nworkers={workers}: {len(latencies) / args.duration:.1f} requests/s, {len(errors)} errors")
+        summarize("latency", latencies)
+        parent = memory_mb(server.pid)
+        print(f"parent: RSS {parent[0]:.0f} MB, PSS {parent[1]:.0f} MB, USS {parent[2]:.0f} MB")
+        worker_pids = children(server.pid)
+        for pid in worker_pids:
+            rss, pss, uss = memory_mb(pid)
+            print(f"worker {pid}: RSS {rss:.0f} MB, PSS {pss:.0f} MB, USS {uss:.0f} MB")
+        total_pss = parent[1] + sum(memory_mb(pid)[1] for pid in worker_pids)
+        print(f"total PSS: {total_pss:.0f} MB")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count()])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=int, default=30)
+    parser.add_argument('--port', type=int, default=7870)
+    parser.add_argument('--startup-timeout', type=int, default=600)
+    args = parser.parse_args()
+
+    for workers in args.workers:
+        run(workers, args)
+
+
+if __name__ == '__main__':
+    main()
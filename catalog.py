@@ -0,0 +1,621 @@
+"""Compiled ingredient catalog: all the data sources in one normalized, memory-mapped file.
+
+Every source is compiled into the same schema:
+- products: source, kind ('product'/'market' for BONSAI, 'food' otherwise), name and code;
+- entries: one per product and region, with the per-kg total, data quality rating,
+  lifecycle phase shares and, for BONSAI, the direct emissions and market links;
+- links: the first-tier recipe inputs of an entry, already in display order.
+
+The file is an 8-byte magic, the length of a JSON header, the header and then the
+arrays it lists, each 64-byte aligned. Opening it maps the file and reads the
+header, so startup does not depend on the size of the data and forked workers
+share the pages. The catalog is rebuilt when its input files change:
+
+    python catalog.py build
+    python catalog.py info
+"""
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from metrics import timed
+
+DATA_DIR = Path("Data")
+CATALOG_PATH = DATA_DIR / "catalog.bin"
+INPUT_FILES = [
+    DATA_DIR / "BONSAI" / "bonsai_footprints.json",
+    DATA_DIR / "BONSAI" / "bonsai_recipes.json",
+    DATA_DIR / "BONSAI" / "bonsai_activity-names.json",
+    DATA_DIR / "BONSAI" / "bonsai_locations.json",
+    DATA_DIR / "agribalyse_data.csv",
+    DATA_DIR / "bigclimatedb.csv",
+]
+FORMAT_VERSION = 1
+MAGIC = b"CFWCAT\x00\x01"
+ALIGNMENT = 64
+FOOD = 'food'
+
+# Entry flags
+HAS_RECIPE = 1
+HAS_PHASES = 2
+
+
+class StringPool:
+    """Collects strings for a string table, giving each distinct string an id. None is -1."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def add(self, value):
+        if value is None or value != value:
+            return -1
+        return self.ids.setdefault(str(value), len(self.ids))
+
+    def add_many(self, values):
+        import pandas as pd
+
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        ids = np.array([self.add(value) for value in uniques] + [-1], dtype=np.int32)
+        return ids[codes]
+
+    def arrays(self, prefix):
+        encoded = [value.encode() for value in self.ids]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(value) for value in encoded])
+        return {f'{prefix}_blob': np.frombuffer(b"".join(encoded), dtype=np.uint8), f'{prefix}_offsets': offsets}
+
+
+class StringTable:
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            return None
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+
+def empty_links():
+    return {'flow': [], 'region': [], 'share': np.empty(0), 'unit': [], 'per_kg': np.empty(0),
+            'start': np.empty(0, dtype=np.int64), 'stop': np.empty(0, dtype=np.int64)}
+
+
+def compile_bonsai(tables):
+    """BONSAI products and markets with their per-region footprints and first-tier recipes."""
+    import pandas as pd
+
+    activities, footprints, recipes = tables['activities'], tables['footprints'], tables['recipes']
+    activity_dict, region_dict = tables['activity_dict'], tables['region_dict']
+    unit_dict = tables.get('unit_dict') or {}
+    locations = tables['locations'].dropna(subset=['name']).drop_duplicates('name')
+
+    # Lookups find the first activity of a description and flow type
+    products = activities.dropna(subset=['description', 'flow_type']).drop_duplicates(['description', 'flow_type'])
+    code_to_product = pd.Series(np.arange(len(products)), index=products['code'].to_numpy())
+    code_to_product = code_to_product[~code_to_product.index.duplicated()]
+
+    rows = footprints[footprints['flow_code'].isin(code_to_product.index)]
+    keys = rows[['flow_code', 'region_code']].drop_duplicates()
+
+    # Recipe rows of the footprint keys, in file order within each (flow, region) block
+    recipe_rows = recipes.merge(keys, left_on=['flow_reference', 'region_reference'],
+                                right_on=['flow_code', 'region_code'], how='inner')
+    recipe_rows['block'] = recipe_rows.groupby(['flow_reference', 'region_reference'], sort=False).ngroup()
+    recipe_rows = recipe_rows[recipe_rows['block'] >= 0]
+    blocks = recipe_rows.drop_duplicates('block')[['flow_reference', 'region_reference', 'block']]
+
+    flow_names = {
+        flow: activity_dict[flow].capitalize() if flow in activity_dict else flow
+        for flow in pd.unique(recipe_rows['flow_input'])
+    }
+    flow = recipe_rows['flow_input'].map(flow_names).to_numpy(dtype=object)
+    value = recipe_rows['value_emission'].to_numpy(dtype=float)
+    block = recipe_rows['block'].to_numpy()
+    is_direct = flow == 'direct'
+    is_other = flow == 'other'
+
+    # The first direct emission of a block is reported separately, not as an input
+    direct = np.full(len(blocks), np.nan)
+    first_direct = recipe_rows[is_direct & ~np.isnan(value)].groupby('block')['value_emission'].first()
+    direct[first_direct.index.to_numpy()] = first_direct.to_numpy()
+
+    # Inputs by decreasing impact, unknown impacts after them and 'other' last
+    inputs = np.flatnonzero(~is_direct)
+    order = inputs[np.lexsort((np.where(np.isnan(value[inputs]), np.inf, -value[inputs]), is_other[inputs], block[inputs]))]
+    counts = np.bincount(block[order], minlength=len(blocks))
+    stop = np.cumsum(counts)
+    region_inflow = recipe_rows['region_inflow'].to_numpy(dtype=object)[order]
+    unit_inflow = recipe_rows['unit_inflow'].to_numpy(dtype=object)[order]
+    links = {
+        'flow': flow[order],
+        'region': [region_dict.get(region, region) if region == region else None for region in region_inflow],
+        'share': recipe_rows['value_inflow'].to_numpy(dtype=float)[order],
+        'unit': [unit_dict.get(unit, unit) if unit == unit else None for unit in unit_inflow],
+        'per_kg': value[order],
+        'start': stop - counts,
+        'stop': stop,
+    }
+
+    entry_block = rows[['flow_code', 'region_code']].merge(
+        blocks, left_on=['flow_code', 'region_code'], right_on=['flow_reference', 'region_reference'], how='left'
+    )['block'].fillna(-1).to_numpy(dtype=np.int64)
+    has_recipe = entry_block >= 0
+    entry_count = len(rows)
+    return {
+        'meta': {
+            'name': 'BONSAI', 'availability_kind': 'market', 'phases': [],
+            # Entries are stored by region code. A country is the first location with its name
+            'region_codes': {str(name): str(code) for name, code in zip(locations['name'], locations['code'])},
+            'region_names': {str(code): str(name) for code, name in region_dict.items()},
+        },
+        'products': {
+            'kind': products['flow_type'].astype(str).tolist(),
+            'name': products['description'].astype(str).tolist(),
+            'code': products['code'].tolist(),
+        },
+        'entries': {
+            'product': code_to_product.loc[rows['flow_code']].to_numpy(),
+            'region': rows['region_code'].tolist(),
+            'per_kg': rows['value'].to_numpy(dtype=float),
+            'dqr': np.full(entry_count, np.nan),
+            'phases': np.empty((entry_count, 0)),
+            'flags': np.where(has_recipe, HAS_RECIPE, 0).astype(np.uint8),
+            'direct': np.where(has_recipe, direct[np.maximum(entry_block, 0)] if len(blocks) else np.nan, np.nan),
+            'link': entry_block,
+        },
+        'links': links,
+    }
+
+
+AGRIBALYSE_PHASES = {
+    'agriculture': 'Agriculture', 'processing': 'Processing', 'packaging': 'Packaging',
+    'transportation': 'Transportation', 'retail': 'Retail', 'consumption': 'Consumption',
+}
+
+
+def compile_agribalyse(tables):
+    """Agribalyse foods: French data with lifecycle stage shares and a data quality rating."""
+    import pandas as pd
+
+    rows = tables['agribalyse'].dropna(subset=['product_name'])
+    product, names = pd.factorize(rows['product_name'])
+    return {
+        'meta': {'name': 'Agribalyse', 'availability_kind': FOOD, 'phases': list(AGRIBALYSE_PHASES.values())},
+        'products': {'kind': [FOOD] * len(names), 'name': [str(name) for name in names], 'code': [None] * len(names)},
+        'entries': {
+            'product': product,
+            'region': ['France'] * len(rows),
+            'per_kg': rows['total'].to_numpy(dtype=float),
+            'dqr': rows['dqr'].to_numpy(dtype=float),
+            'phases': rows[list(AGRIBALYSE_PHASES)].to_numpy(dtype=float),
+            'flags': np.full(len(rows), HAS_PHASES, dtype=np.uint8),
+            'direct': np.full(len(rows), np.nan),
+            'link': np.full(len(rows), -1),
+        },
+        'links': empty_links(),
+    }
+
+
+BIGCLIMATE_PHASES = {
+    'Agriculture': 'Agriculture', 'iLUC': 'Indirect Land Use Change', 'Food processing': 'Food processing',
+    'Packaging': 'Packaging', 'Transport': 'Transport', 'Retail': 'Retail',
+}
+
+
+def compile_bigclimate(tables):
+    """BigClimateDB foods per country, with phase shares of the total."""
+    import pandas as pd
+
+    rows = tables['bigclimatedata'].dropna(subset=['Name'])
+    product, names = pd.factorize(rows['Name'])
+    total = rows['Total kg CO2-eq/kg'].to_numpy(dtype=float)
+    columns = [column for column in BIGCLIMATE_PHASES if column in rows.columns]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        phases = rows[columns].to_numpy(dtype=float) / total[:, None]
+    return {
+        'meta': {'name': 'Big Climate Database', 'availability_kind': FOOD,
+                 'phases': [BIGCLIMATE_PHASES[column] for column in columns]},
+        'products': {'kind': [FOOD] * len(names), 'name': [str(name) for name in names], 'code': [None] * len(names)},
+        'entries': {
+            'product': product,
+            'region': rows['region'].astype(str).tolist(),
+            'per_kg': total,
+            'dqr': np.full(len(rows), np.nan),
+            'phases': phases,
+            # Phase shares are undefined for a zero total
+            'flags': np.where(total == 0, 0, HAS_PHASES).astype(np.uint8),
+            'direct': np.full(len(rows), np.nan),
+            'link': np.full(len(rows), -1),
+        },
+        'links': empty_links(),
+    }
+
+
+# Adding a source means adding its compiler here, the lookups work from the catalog
+SOURCE_COMPILERS = [compile_bonsai, compile_agribalyse, compile_bigclimate]
+
+
+def compile_catalog(tables, inputs_hash=None):
+    """Compile the loaded tables (as data_handler.build_tables returns them) into an in-memory Catalog."""
+    parts = [compile_source(tables) for compile_source in SOURCE_COMPILERS]
+    sources = [part['meta'] for part in parts]
+    phases = list(dict.fromkeys(phase for part in parts for phase in part['meta']['phases']))
+    kinds = sorted(set(kind for part in parts for kind in part['products']['kind']))
+    kind_ids = {kind: n for n, kind in enumerate(kinds)}
+
+    strings, regions = StringPool(), StringPool()
+    product_source, product_kind, product_name, product_code = [], [], [], []
+    entry = {name: [] for name in ('product', 'region', 'per_kg', 'dqr', 'phases', 'flags', 'direct',
+                                   'link_start', 'link_stop')}
+    link = {name: [] for name in ('flow', 'region', 'share', 'unit', 'per_kg')}
+    product_offset = link_offset = 0
+
+    for source_id, part in enumerate(parts):
+        products, entries, links = part['products'], part['entries'], part['links']
+        product_source.append(np.full(len(products['name']), source_id, dtype=np.uint8))
+        product_kind.append(np.array([kind_ids[kind] for kind in products['kind']], dtype=np.uint8))
+        product_name.append(strings.add_many(products['name']))
+        product_code.append(strings.add_many(products['code']))
+
+        count = len(entries['per_kg'])
+        entry['product'].append(np.asarray(entries['product'], dtype=np.int64) + product_offset)
+        entry['region'].append(regions.add_many(entries['region']))
+        entry['per_kg'].append(entries['per_kg'])
+        entry['dqr'].append(entries['dqr'])
+        source_phases = np.full((count, len(phases)), np.nan)
+        for column, phase in enumerate(part['meta']['phases']):
+            source_phases[:, phases.index(phase)] = entries['phases'][:, column]
+        entry['phases'].append(source_phases)
+        entry['flags'].append(entries['flags'])
+        entry['direct'].append(entries['direct'])
+        has_link = entries['link'] >= 0
+        block = np.maximum(entries['link'], 0)
+        entry['link_start'].append(np.where(has_link, links['start'][block] + link_offset, 0) if len(links['start'])
+                                   else np.zeros(count, dtype=np.int64))
+        entry['link_stop'].append(np.where(has_link, links['stop'][block] + link_offset, 0) if len(links['stop'])
+                                  else np.zeros(count, dtype=np.int64))
+
+        link['flow'].append(strings.add_many(links['flow']))
+        link['region'].append(strings.add_many(links['region']))
+        link['share'].append(links['share'])
+        link['unit'].append(strings.add_many(links['unit']))
+        link['per_kg'].append(links['per_kg'])
+        product_offset += len(products['name'])
+        link_offset += len(links['per_kg'])
+
+    arrays = {
+        'product_source': np.concatenate(product_source),
+        'product_kind': np.concatenate(product_kind),
+        'product_name': np.concatenate(product_name).astype(np.int32),
+        'product_code': np.concatenate(product_code).astype(np.int32),
+    }
+
+    # Entries grouped by product, keeping the source order within a product
+    order = np.argsort(np.concatenate(entry['product']), kind='stable')
+    entry_product = np.concatenate(entry['product'])[order]
+    arrays['product_entries'] = np.searchsorted(entry_product, np.arange(product_offset + 1)).astype(np.int64)
+    arrays['entry_region'] = np.concatenate(entry['region'])[order].astype(np.int32)
+    for name, dtype in (('per_kg', np.float64), ('dqr', np.float64), ('flags', np.uint8), ('direct', np.float64),
+                        ('link_start', np.int64), ('link_stop', np.int64)):
+        arrays[f'entry_{name}'] = np.concatenate(entry[name]).astype(dtype)[order]
+    arrays['entry_phases'] = np.concatenate(entry['phases'])[order]
+    for name, dtype in (('flow', np.int32), ('region', np.int32), ('unit', np.int32),
+                        ('share', np.float64), ('per_kg', np.float64)):
+        arrays[f'link_{name}'] = np.concatenate(link[name]).astype(dtype)
+
+    # Name index: product ids sorted by (source, kind, name)
+    names = list(strings.ids)
+    arrays['product_order'] = np.array(sorted(
+        range(product_offset),
+        key=lambda n: (arrays['product_source'][n], arrays['product_kind'][n], names[arrays['product_name'][n]])
+    ), dtype=np.int32)
+
+    arrays.update(strings.arrays('strings'))
+    arrays.update(regions.arrays('regions'))
+
+    locations = tables.get('locations')
+    header = {
+        'format': FORMAT_VERSION,
+        'version': (inputs_hash or "in-memory")[:12],
+        'inputs_hash': inputs_hash,
+        'built_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'sources': sources,
+        'kinds': kinds,
+        'phases': phases,
+        'countries': sorted(set(locations['name'].dropna())) if locations is not None else [],
+    }
+    return Catalog(header, arrays)
+
+
+def inputs_hash(paths=INPUT_FILES):
+    """Fingerprint of the input files and the ingestion filters the catalog was compiled from."""
+    from data_preprocessing import BONSAI_FILTERS
+
+    fingerprint = [FORMAT_VERSION, BONSAI_FILTERS]
+    for path in paths:
+        stat = Path(path).stat()
+        fingerprint.append([str(path), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def write_catalog(catalog, path=CATALOG_PATH):
+    specs, offset = {}, 0
+    for name, array in catalog.arrays.items():
+        array = np.ascontiguousarray(array)
+        specs[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps(dict(catalog.header, arrays=specs)).encode()
+
+    temp_path = Path(path).with_suffix('.tmp')
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC + len(header).to_bytes(8, 'little') + header)
+        f.write(b"\0" * (-f.tell() % ALIGNMENT))
+        for name, array in catalog.arrays.items():
+            data = np.ascontiguousarray(array).tobytes()
+            f.write(data + b"\0" * (-len(data) % ALIGNMENT))
+    os.replace(temp_path, path)
+
+
+def read_header(f):
+    if f.read(8) != MAGIC:
+        raise ValueError("not a catalog file")
+    length = int.from_bytes(f.read(8), 'little')
+    header = json.loads(f.read(length))
+    return header, 16 + length + (-(16 + length) % ALIGNMENT)
+
+
+def open_catalog(path=CATALOG_PATH):
+    """Map a catalog file. The arrays are views of the mapping, nothing is read until used."""
+    with open(path, 'rb') as f:
+        header, data_start = read_header(f)
+        if header['format'] != FORMAT_VERSION:
+            raise ValueError(f"catalog format {header['format']}, expected {FORMAT_VERSION}")
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays = {}
+    for name, spec in header.pop('arrays').items():
+        count = int(np.prod(spec['shape']))
+        if count == 0:
+            arrays[name] = np.empty(spec['shape'], dtype=spec['dtype'])
+        else:
+            arrays[name] = np.frombuffer(mapping, dtype=spec['dtype'], count=count,
+                                         offset=data_start + spec['offset']).reshape(spec['shape'])
+    return Catalog(header, arrays, mapping)
+
+
+def catalog_is_current(path=CATALOG_PATH):
+    try:
+        with open(path, 'rb') as f:
+            header, _ = read_header(f)
+        return header['format'] == FORMAT_VERSION and header['inputs_hash'] == inputs_hash()
+    except (OSError, ValueError):
+        return False
+
+
+def build_catalog(path=CATALOG_PATH):
+    """Compile the catalog from the data files and write it to path."""
+    from data_handler import build_tables
+
+    print("Compiling the ingredient catalog...")
+    start = time.perf_counter()
+    catalog = compile_catalog(build_tables(), inputs_hash())
+    write_catalog(catalog, path)
+    print(f"Catalog {catalog.version} written to {path} in {time.perf_counter() - start:.1f}s: {catalog.summary()}")
+    return open_catalog(path)
+
+
+catalog = None
+catalog_lock = threading.Lock()
+
+
+def get_catalog(path=CATALOG_PATH):
+    """The catalog of this process, compiled first if it is missing or older than its input files."""
+    global catalog
+    with catalog_lock:
+        if catalog is None:
+            with timed("startup_catalog"):
+                catalog = open_catalog(path) if catalog_is_current(path) else build_catalog(path)
+    return catalog
+
+
+class Catalog:
+    def __init__(self, header, arrays, mapping=None):
+        self.header = header
+        self.arrays = arrays
+        self.mapping = mapping
+        self.version = header['version']
+        self.sources = [source['name'] for source in header['sources']]
+        self.source_ids = {name: n for n, name in enumerate(self.sources)}
+        self.kind_ids = {kind: n for n, kind in enumerate(header['kinds'])}
+        self.source_phases = {
+            source['name']: [(phase, header['phases'].index(phase)) for phase in source['phases']]
+            for source in header['sources']
+        }
+        self.availability_kinds = {source['name']: source['availability_kind'] for source in header['sources']}
+        self.region_codes = {source['name']: source.get('region_codes') for source in header['sources']}
+        self.region_names = {source['name']: source.get('region_names') for source in header['sources']}
+        self.strings = StringTable(arrays['strings_blob'], arrays['strings_offsets'])
+        self.regions = StringTable(arrays['regions_blob'], arrays['regions_offsets'])
+        self.region_ids = {self.regions[n]: n for n in range(len(self.regions))}
+        self.matrix = None
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    def summary(self):
+        return (f"{len(self.product_source)} products, {len(self.entry_per_kg)} entries, "
+                f"{len(self.link_per_kg)} market links, {len(self.regions)} regions")
+
+    def key(self, product):
+        return (self.product_source[product], self.product_kind[product], self.strings[self.product_name[product]])
+
+    def find(self, source, name, kind=FOOD):
+        """Product id of a source's product by name and kind, or None. Binary search over the name index."""
+        if source not in self.source_ids or kind not in self.kind_ids or not isinstance(name, str):
+            return None
+        target = (self.source_ids[source], self.kind_ids[kind], name)
+        low, high = 0, len(self.product_order)
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(self.product_order[middle]) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.product_order) and self.key(self.product_order[low]) == target:
+            return int(self.product_order[low])
+        return None
+
+    def product_names(self, source):
+        """The distinct product names of a source, in source order."""
+        source_id = self.source_ids[source]
+        ids = self.product_name[self.product_source == source_id]
+        return np.array([self.strings[n] for n in dict.fromkeys(ids.tolist())], dtype=object)
+
+    def countries(self):
+        return self.header['countries']
+
+    def match(self, product, region, use_fallback=True):
+        """The entry of a product in a region: {'entry', 'per_kg', 'fallback_regions'} or None.
+
+        Without data for the region, and with use_fallback, the per-kg value is the
+        average over all the product's entries, and the entry is the first one."""
+        start, stop = self.product_entries[product], self.product_entries[product + 1]
+        if start == stop:
+            return None
+        source = self.sources[self.product_source[product]]
+        codes = self.region_codes[source]
+        region_id = self.region_ids.get(codes.get(region) if codes is not None else region)
+        if region_id is not None:
+            hits = np.flatnonzero(self.entry_region[start:stop] == region_id)
+            if hits.size:
+                entry = start + hits[0]
+                return {'entry': entry, 'per_kg': self.entry_per_kg[entry], 'fallback_regions': None}
+        if not use_fallback:
+            return None
+        values = self.entry_per_kg[start:stop]
+        values = values[~np.isnan(values)]
+        return {
+            'entry': start,
+            'per_kg': values.mean() if values.size else np.nan,
+            'fallback_regions': [self.region_name(source, n) for n in self.entry_region[start:stop]],
+        }
+
+    def impact_matrix(self):
+        """Per-kg values of every product with entries in every country, computed once per process.
+
+        Returns {'countries', 'rows', 'present', 'per_kg', 'mean'}: `rows` maps a product
+        id to its matrix row (-1 without entries), `present` marks the cells with an entry
+        of their own and `per_kg` holds the value of the entry `match` would pick. `mean` is
+        the average over all the product's entries, which `match` falls back to."""
+        if self.matrix is not None:
+            return self.matrix
+        has_entries = np.diff(self.product_entries) > 0
+        rows = np.full(len(self.product_source), -1, dtype=np.int64)
+        rows[has_entries] = np.arange(int(has_entries.sum()))
+        entry_product = np.repeat(np.arange(len(rows)), np.diff(self.product_entries))
+        entry_row = rows[entry_product]
+
+        # Countries with a name in the catalog, plus the regions of the sources stored by name
+        entry_source = self.product_source[entry_product]
+        named = [n for n, source in enumerate(self.sources) if self.region_codes[source] is None]
+        countries = sorted(set(self.countries()) | {
+            self.regions[n] for n in np.unique(self.entry_region[np.isin(entry_source, named)]).tolist()
+        })
+
+        # First entry of every product and region, as match picks it, keyed by row and region
+        regions = len(self.regions) + 1
+        with_region = np.flatnonzero(self.entry_region >= 0)
+        keys, first = np.unique(entry_row[with_region] * regions + self.entry_region[with_region], return_index=True)
+        first = with_region[first]
+
+        matrix_rows = int(has_entries.sum())
+        row_source = self.product_source[has_entries]
+        entries = np.full((matrix_rows, len(countries)), -1, dtype=np.int64)
+        for source_id, source in enumerate(self.sources):
+            codes = self.region_codes[source]
+            # Columns without a region in this source get a region id no entry has
+            columns = np.array([
+                self.region_ids.get(codes.get(country) if codes is not None else country, regions - 1)
+                for country in countries
+            ], dtype=np.int64)
+            source_rows = np.flatnonzero(row_source == source_id)
+            wanted = source_rows[:, None] * regions + columns[None, :]
+            found = np.minimum(np.searchsorted(keys, wanted), max(len(keys) - 1, 0))
+            hit = keys[found] == wanted if len(keys) else np.zeros(wanted.shape, dtype=bool)
+            entries[source_rows] = np.where(hit, first[found] if len(keys) else -1, -1)
+
+        present = entries >= 0
+        values = self.entry_per_kg
+        known = ~np.isnan(values)
+        totals = np.bincount(entry_row[known], weights=values[known], minlength=matrix_rows)
+        counts = np.bincount(entry_row[known], minlength=matrix_rows)
+        with np.errstate(invalid='ignore'):
+            mean = totals / counts
+        self.matrix = {
+            'countries': countries,
+            'rows': rows,
+            'present': present,
+            'per_kg': np.where(present, values[np.maximum(entries, 0)], np.nan),
+            'mean': mean,
+        }
+        return self.matrix
+
+    def region_name(self, source, region_id):
+        region = self.regions[region_id]
+        names = self.region_names[source]
+        return region if names is None else names.get(region, "Unknown")
+
+    def entry_region_name(self, entry, source):
+        return self.region_name(source, self.entry_region[entry])
+
+    def phases(self, entry, source):
+        """Phase shares of an entry as {phase: share}, empty when the source or entry has none."""
+        if not self.entry_flags[entry] & HAS_PHASES:
+            return {}
+        return {phase: self.entry_phases[entry, column] for phase, column in self.source_phases[source]}
+
+    def has_recipe(self, entry):
+        return bool(self.entry_flags[entry] & HAS_RECIPE)
+
+    def direct(self, entry):
+        value = self.entry_direct[entry]
+        return None if np.isnan(value) else value
+
+    def links(self, entry):
+        """The market inputs of an entry as {flow, region, share, unit, per_kg} rows in display order."""
+        return [
+            {
+                'flow': self.strings[self.link_flow[n]],
+                'region': self.strings[self.link_region[n]],
+                'share': None if np.isnan(self.link_share[n]) else self.link_share[n],
+                'unit': self.strings[self.link_unit[n]],
+                'per_kg': None if np.isnan(self.link_per_kg[n]) else self.link_per_kg[n],
+            }
+            for n in range(self.entry_link_start[entry], self.entry_link_stop[entry])
+        ]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compile or inspect the ingredient catalog.")
+    parser.add_argument('command', choices=['build', 'info'])
+    parser.add_argument('--path', type=Path, default=CATALOG_PATH)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_catalog(args.path)
+    else:
+        current = open_catalog(args.path)
+        print(f"Catalog {current.version} built {current.header['built_at']}"
+              f"{'' if catalog_is_current(args.path) else ' (stale)'}: {current.summary()}")
+        for source in current.sources:
+            print(f"  {source}: {int((current.product_source == current.source_ids[source]).sum())} products")
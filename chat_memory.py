@@ -0,0 +1,111 @@
+from context_builder import count_message_tokens
+from metrics import timed, record_usage, chat_memory_compactions, chat_memory_folded_turns, chat_memory_tokens
+
+MEMORY_TOKEN_CEILING = 4000
+RECENT_TURNS = 3  # user/assistant pairs kept verbatim
+
+pinned_prompt = """You are the assistant of The Carbon Footprint Wizard. You already gave the user an initial carbon footprint analysis of their recipe. Answer their follow-up questions directly, without function format.
+
+The data is a compact table. Each "## Ingredient (amount g)" heading is followed by one row per selected product:
+source|product|type|region|kg CO2-eq|notes
+kg CO2-eq is already scaled to the ingredient amount. A region starting with "avg of" means data averaged over other regions.
+
+Here is the information from our sources:
+{results_text}
+
+Your initial analysis:
+{initial_answer}"""
+
+no_analysis_prompt = """You are the assistant of The Carbon Footprint Wizard. No recipe has been analysed yet, so help the user with general questions about the carbon footprint of food and ask them to submit a recipe for a detailed analysis."""
+
+summary_prompt = """Update the running summary of a conversation about the carbon footprint of a recipe.
+Keep the facts, numbers and user preferences that later questions may refer to. Use at most 150 words.
+
+Current summary:
+{summary}
+
+New turns:
+{turns}"""
+
+
+def create_memory(results_text=None, initial_answer=None):
+    """Create the conversation memory: pinned data context, rolling summary and recent turns."""
+    if results_text is None:
+        pinned = no_analysis_prompt
+    else:
+        pinned = pinned_prompt.format(results_text=results_text, initial_answer=initial_answer)
+    return {'pinned': pinned, 'summary': "", 'turns': []}
+
+
+def refresh_memory(memory, results_text, initial_answer):
+    """Replace the pinned data context of an existing memory, keeping the summary and recent turns."""
+    refreshed = create_memory(results_text, initial_answer)
+    if memory is not None:
+        refreshed['summary'] = memory['summary']
+        refreshed['turns'] = memory['turns']
+    return refreshed
+
+
+def build_messages(memory, user_input=None):
+    """Assemble the request messages for the next turn from the memory."""
+    messages = [{"role": "system", "content": memory['pinned']}]
+    if memory['summary']:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{memory['summary']}"})
+    messages.extend(memory['turns'])
+    if user_input is not None:
+        messages.append({"role": "user", "content": user_input})
+    return messages
+
+
+def add_turn(memory, user_input, assistant_response):
+    memory['turns'].append({"role": "user", "content": user_input})
+    memory['turns'].append({"role": "assistant", "content": assistant_response})
+    return memory
+
+
+def compaction_trigger(memory, ceiling=MEMORY_TOKEN_CEILING, recent_turns=RECENT_TURNS):
+    """Why the memory has to be compacted: 'turns', 'tokens', or None when it does not.
+
+    Turns are folded in batches, once there are more than twice recent_turns pairs, so
+    the summary call runs every recent_turns replies rather than after each one."""
+    # Two messages per pair
+    if len(memory['turns']) > recent_turns * 4:
+        return 'turns'
+    if count_message_tokens(build_messages(memory)) > ceiling:
+        return 'tokens'
+    return None
+
+
+@timed("chat_summary")
+def summarise_turns(client, summary, turns):
+    transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": summary_prompt.format(summary=summary or "(none)", turns=transcript)}],
+        temperature=1e-7,
+    )
+    record_usage("chat_summary", response.usage)
+    return response.choices[0].message.content
+
+
+def compact_memory(client, memory, ceiling=MEMORY_TOKEN_CEILING, recent_turns=RECENT_TURNS):
+    """Fold the oldest turns into the rolling summary so the next request stays under the token ceiling.
+
+    Folds down to recent_turns pairs at once, then further while over the ceiling."""
+    trigger = compaction_trigger(memory, ceiling, recent_turns)
+    if trigger is None:
+        return memory
+
+    folded = []
+    # Always keep the latest pair verbatim, even if it alone exceeds the ceiling
+    while len(memory['turns']) > 2 and (len(memory['turns']) > recent_turns * 2
+                                        or count_message_tokens(build_messages(memory)) > ceiling):
+        folded.extend(memory['turns'][:2])
+        memory['turns'] = memory['turns'][2:]
+
+    if folded:
+        memory['summary'] = summarise_turns(client, memory['summary'], folded)
+        chat_memory_compactions.inc(trigger=trigger)
+        chat_memory_folded_turns.inc(len(folded) // 2)
+        chat_memory_tokens.observe(count_message_tokens(build_messages(memory)))
+    return memory
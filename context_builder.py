@@ -0,0 +1,129 @@
+import math
+from metrics import timed, context_tokens, context_detail_levels
+from data_handler import impact_range
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+CONTEXT_TOKEN_BUDGET = 1500
+MIN_INPUT_SHARE = 0.02  # market inputs below 2% of the market impact are folded into "other"
+
+SOURCE_LABELS = {'BONSAI': 'BONSAI', 'Agribalyse': 'Agribalyse', 'Big Climate Database': 'BigClimate'}
+
+# Ordered from most to least detailed, the first one that fits the budget is used
+DETAIL_LEVELS = [
+    {'max_inputs': 5, 'phases': True},
+    {'max_inputs': 3, 'phases': True},
+    {'max_inputs': 1, 'phases': False},
+    {'max_inputs': 0, 'phases': False},
+]
+
+CONTEXT_HEADER = "source|product|type|region|kg CO2-eq|notes"
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Count tokens locally, using tiktoken when available and a 4 characters per token estimate otherwise."""
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        try:
+            _encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / 4)
+
+
+def count_message_tokens(messages):
+    """Count the prompt tokens of a chat message list, including the per-message overhead."""
+    return sum(count_tokens(message.get('content') or "") + 4 for message in messages)
+
+
+def fmt(value):
+    return f"{value:.3g}"
+
+
+def format_region(record, country):
+    if record['source'] == 'Agribalyse':
+        return "France" if country == "France" else "France (not target)"
+    if record.get('fallback_regions'):
+        return f"avg of {len(record['fallback_regions'])} regions (not {country})"
+    return record['region']
+
+
+def format_inputs(record, grams, max_inputs):
+    """Keep the largest market inputs and fold the low-impact ones into a single 'other' value."""
+    inputs = [row for row in record['inputs'] if row['per_kg'] is not None]
+    kept = [
+        row for row in inputs
+        if row['flow'] != 'other' and abs(row['per_kg']) >= MIN_INPUT_SHARE * abs(record['per_kg'])
+    ][:max_inputs]
+    other = sum(row['per_kg'] for row in inputs if row not in kept)
+
+    parts = [f"{row['region']} {fmt(row['share'])} {row['unit']}={fmt(row['per_kg']*grams/1000)}"
+             for row in kept if row['share'] is not None]
+    if other:
+        parts.append(f"other={fmt(other*grams/1000)}")
+    return "shares: " + ", ".join(parts) if parts else ""
+
+
+def format_row(record, grams, country, level):
+    source = SOURCE_LABELS[record['source']]
+    kind = record.get('type', '-')
+    if 'missing' in record:
+        return f"{source}|{record['product']}|{kind}|-|n/a|no data"
+
+    notes = []
+    if record['source'] == 'BONSAI':
+        if record['direct'] is not None:
+            notes.append(f"direct={fmt(record['direct']*grams/1000)}")
+        if kind == 'market' and level['max_inputs'] and record['inputs']:
+            notes.append(format_inputs(record, grams, level['max_inputs']))
+    else:
+        if record['source'] == 'Agribalyse':
+            notes.append(f"dqr={record['dqr']}")
+        if level['phases'] and record['phases']:
+            notes.append(", ".join(f"{name} {share*100:.0f}%" for name, share in record['phases'].items()))
+
+    notes = "; ".join(note for note in notes if note)
+    return f"{source}|{record['product']}|{kind}|{format_region(record, country)}|{fmt(record['per_kg']*grams/1000)}|{notes}"
+
+
+def format_ingredient(ingredient, country, level):
+    lines = [f"## {ingredient['query']} ({ingredient['grams']} g)"]
+    if not ingredient['records']:
+        lines.append("no product selected")
+    for record in ingredient['records']:
+        lines.append(format_row(record, ingredient['grams'], country, level))
+    return "\n".join(lines)
+
+
+def format_ranges(ingredient):
+    """Coarsest form: the impact range of an ingredient, as impact_range gives it to the UI."""
+    impact = impact_range(ingredient['records'], ingredient['grams'])
+    if impact is None:
+        return f"## {ingredient['query']} ({ingredient['grams']} g): no data"
+    sources = sorted(set(SOURCE_LABELS[record['source']] for record in ingredient['records'] if 'missing' not in record))
+    return f"## {ingredient['query']} ({ingredient['grams']} g): {fmt(impact[0])}-{fmt(impact[1])} kg CO2-eq from {', '.join(sources)}"
+
+
+@timed("context")
+def build_context(search_query, country, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Pack the lookup results of get_results into a compact table that fits the token budget."""
+    for n, level in enumerate(DETAIL_LEVELS):
+        text = CONTEXT_HEADER + "\n" + "\n".join(format_ingredient(ingredient, country, level) for ingredient in search_query)
+        tokens = count_tokens(text)
+        if tokens <= token_budget:
+            break
+    else:
+        n = len(DETAIL_LEVELS)
+        text = "\n".join(format_ranges(ingredient) for ingredient in search_query)
+        tokens = count_tokens(text)
+
+    context_detail_levels.inc(level=str(n))
+    context_tokens.observe(tokens)
+    return text
@@ -1,7 +1,14 @@
 import numpy as np
 import pandas as pd
 import json
+import threading
+from collections import OrderedDict
 from copy import deepcopy
+from functools import lru_cache
+from metrics import timed
+import semantic_cache
+from data_preprocessing import BONSAI_FILTERS, filter_mask
+from catalog import FOOD, compile_catalog, get_catalog
 
 def load_data():
     with open('Data/BONSAI/bonsai_footprints.json', 'r') as f:
@@ -16,13 +23,9 @@ def load_data():
     with open('Data/BONSAI/bonsai_locations.json', 'r') as f:
         locations = pd.DataFrame(json.load(f))
 
-    version = 'v1.0.0'
-
-    mask = (footprints['version']==version) & (footprints['unit_reference']=='tonnes')
-    footprints = footprints[mask]
-
-    mask = (recipes['version']==version)
-    recipes = recipes[mask]
+    # A no-op for files filtered at download time, needed for files downloaded before that
+    footprints = footprints[filter_mask(footprints, BONSAI_FILTERS['footprints'])]
+    recipes = recipes[filter_mask(recipes, BONSAI_FILTERS['recipes'])]
 
     agribalyse = pd.read_csv('Data/agribalyse_data.csv')
     bigclimatedata = pd.read_csv('Data/bigclimatedb.csv')
@@ -30,202 +33,287 @@ def load_data():
     return agribalyse, footprints, recipes, activities, locations, bigclimatedata
 
 
-agribalyse, footprints, recipes, activities, locations, bigclimatedata = load_data()
-activity_dict = {activities.iloc[i,0]:activities.iloc[i,2] for i in range(activities.shape[0])}
-region_dict = {locations.iloc[i,0]:locations.iloc[i,1] for i in range(locations.shape[0])}
-unit_dict = {'Meuro':'Million EUR', 'tonnes': 'Tonnes', 'items':'Units', 'TJ':'Trillion Joules', 'ha*year':'Hectare per year'}
+# Lower-impact swaps: FAISS neighbours searched per source, the lowest similarity
+# offered and the number of swaps shown per ingredient
+SUBSTITUTE_CANDIDATES = 10
+SUBSTITUTE_SIMILARITY = 0.5
+SUBSTITUTES_PER_INGREDIENT = 3
+IMPACT_TABLE_CACHE_SIZE = 64
 
+unit_dict = {'Meuro':'Million EUR', 'tonnes': 'Tonnes', 'items':'Units', 'TJ':'Trillion Joules', 'ha*year':'Hectare per year'}
 
+TABLE_NAMES = ('agribalyse', 'footprints', 'recipes', 'activities', 'locations', 'bigclimatedata', 'activity_dict', 'region_dict')
+tables = None
+tables_lock = threading.Lock()
+OVERRIDE_CATALOGS = 4
+override_catalogs = OrderedDict()
+override_catalogs_lock = threading.Lock()
+
+
+def build_tables():
+    """Load the data tables along with the code to name dicts of activities and regions."""
+    agribalyse, footprints, recipes, activities, locations, bigclimatedata = load_data()
+    return {
+        'agribalyse': agribalyse,
+        'footprints': footprints,
+        'recipes': recipes,
+        'activities': activities,
+        'locations': locations,
+        'bigclimatedata': bigclimatedata,
+        'activity_dict': {activities.iloc[i,0]:activities.iloc[i,2] for i in range(activities.shape[0])},
+        'region_dict': {locations.iloc[i,0]:locations.iloc[i,1] for i in range(locations.shape[0])},
+        'unit_dict': unit_dict,
+    }
+
+
+def get_tables():
+    """Load the data tables on first use rather than at import time.
+
+    The lookups use the compiled catalog, the tables are only for code that needs the raw data."""
+    global tables
+    with tables_lock:
+        if tables is None:
+            with timed("startup_data_load"):
+                tables = build_tables()
+    return tables
+
+
+def table_defaults(**overrides):
+    """The loaded tables for the given names, except those passed explicitly (not None)."""
+    loaded = get_tables()
+    return [loaded[name] if value is None else value for name, value in overrides.items()]
+
+
+def catalog_for(**overrides):
+    """The compiled catalog, or a catalog compiled in memory when tables are passed explicitly.
+
+    Compiling is slow, so the catalogs of explicit tables are kept for the last
+    OVERRIDE_CATALOGS sets of table objects. A table changed in place after a
+    lookup is not seen by the next one: pass a new object instead."""
+    overrides = {name: value for name, value in overrides.items() if value is not None}
+    if not overrides:
+        return get_catalog()
+    key = tuple(sorted((name, id(value)) for name, value in overrides.items()))
+    with override_catalogs_lock:
+        if key in override_catalogs:
+            override_catalogs.move_to_end(key)
+            return override_catalogs[key]['catalog']
+    loaded = dict(get_tables())
+    loaded.update(overrides)
+    catalog = compile_catalog(loaded)
+    with override_catalogs_lock:
+        # The tables are kept with their catalog so their ids are not reused while cached
+        override_catalogs[key] = {'tables': overrides, 'catalog': catalog}
+        while len(override_catalogs) > OVERRIDE_CATALOGS:
+            override_catalogs.popitem(last=False)
+    return catalog
+
+
+def __getattr__(name):
+    # Keeps `data_handler.activities` and `from data_handler import locations` working, loading on first access
+    if name in TABLE_NAMES:
+        return get_tables()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@timed("availability")
 def check_product_availability(product_name, country):
-    """Check if a product has MARKET data for a specific country."""
-    # ONLY check BONSAI MARKET data
-    try:
-        product_code = activities[(activities['description'] == product_name) & 
-                            (activities['flow_type'] == 'market')]['code'].iloc[0]
-        region_code = locations[locations['name'] == country]['code'].iloc[0]
-        filtered_footprints = footprints[(footprints['flow_code'] == product_code) & 
-                                    (footprints['region_code'] == region_code)]
-        if filtered_footprints.shape[0] > 0:
-            return True
-    except:
-        pass
-    
-    # Check BigClimateDB
-    filtered_data = bigclimatedata[bigclimatedata['Name'] == product_name]
-    if filtered_data.shape[0] > 0:
-        filtered_data = filtered_data[filtered_data['region'] == country]
-        if filtered_data.shape[0] > 0:
+    """Check if a product has data for a specific country in any source.
+
+    For BONSAI only MARKET data counts, and Agribalyse only has data for France."""
+    catalog = get_catalog()
+    for source, kind in catalog.availability_kinds.items():
+        product = catalog.find(source, product_name, kind)
+        if product is not None and catalog.match(product, country, use_fallback=False) is not None:
             return True
-    
-    # Agribalyse is only for France, so if country is France, check Agribalyse
-    if country == "France":
-        try:
-            filtered_data = agribalyse[agribalyse['product_name'] == product_name]
-            if filtered_data.shape[0] > 0:
-                return True
-        except:
-            pass
-    
     return False
 
 
-def get_bonsai_data(target_description, target_type, target_region, grams=1000,
-                    footprints=footprints, recipes=recipes, activities=activities, locations=locations,
-                    activity_dict=activity_dict, region_dict=region_dict, unit_dict=unit_dict,
-                    use_fallback=True):
-    
-    try:
-        product_code = activities[(activities['description'] == target_description) & 
-                            (activities['flow_type'] == target_type)]['code'].iloc[0]
-    except:
-        return f"No {'production' if target_type=='product' else target_type} data available for '{target_description}' in BONSAI database\n"
-
-    try:
-        region_code = locations[locations['name'] == target_region]['code'].iloc[0]
-        filtered_footprints = footprints[(footprints['flow_code'] == product_code) & 
-                                    (footprints['region_code'] == region_code)]
-        if filtered_footprints.shape[0]==0:
-            raise Exception("No data for this region")
-        
-        # Use the specific region's data
-        impact = filtered_footprints['value'].iloc[0]
+def lookup_bonsai(target_description, target_type, target_region,
+                  footprints=None, recipes=None, activities=None, locations=None,
+                  activity_dict=None, region_dict=None, unit_dict=None,
+                  use_fallback=True):
+    """Look up the per-kg BONSAI footprint and first-tier recipe of a product as a record."""
+    catalog = catalog_for(footprints=footprints, recipes=recipes, activities=activities, locations=locations,
+                          activity_dict=activity_dict, region_dict=region_dict, unit_dict=unit_dict)
+    record = {'source': 'BONSAI', 'product': target_description, 'type': target_type, 'region': target_region}
+
+    product = catalog.find('BONSAI', target_description, target_type)
+    if product is None:
+        record['missing'] = f"No {'production' if target_type=='product' else target_type} data available for '{target_description}' in BONSAI database\n"
+        return record
+
+    # Only market data falls back to the average over all regions
+    fallback = use_fallback and target_type == 'market'
+    match = catalog.match(product, target_region, use_fallback=fallback)
+    if match is None:
+        where = f"in {target_region}" if not fallback else "in any region"
+        record['missing'] = f"No {target_type} data available for '{target_description}' {where} in BONSAI database\n"
+        return record
+
+    entry = match['entry']
+    record['per_kg'] = match['per_kg']
+    record['fallback_regions'] = match['fallback_regions']
+    record['recipe_region'] = catalog.entry_region_name(entry, 'BONSAI')
+    record['has_recipe'] = catalog.has_recipe(entry)
+    record['direct'] = catalog.direct(entry)
+    record['inputs'] = catalog.links(entry)
+    return record
+
+
+def format_bonsai(record, grams=1000):
+    """Render a BONSAI record as the prose used in the analysis prompt."""
+    if 'missing' in record:
+        return record['missing']
+
+    target_description, target_type, target_region = record['product'], record['type'], record['region']
+    if record['fallback_regions'] is None:
         result_final = f"BONSAI database results for '{target_description}' in {target_region}:\n"
-        result_final += f"Impact for {grams} grams: {round_to_sig_figs(impact*grams/1000)} kg co2-eq\n"
-    except Exception as e:
-        # For product data, don't do fallback
-        if target_type == 'product' or not use_fallback:
-            return f"No {target_type} data available for '{target_description}' in {target_region} in BONSAI database\n"
+    else:
+        region_names = record['fallback_regions']
+        region_str = ", ".join(region_names[:3])
+        if len(region_names) > 3:
+            region_str += f" and {len(region_names)-3} other regions"
         
-        # Only do fallback for market data
-        if target_type == 'market':
-            # Get all available regions for this market
-            all_footprints = footprints[footprints['flow_code'] == product_code]
-            if all_footprints.shape[0] > 0:
-                # Calculate average impact across all regions
-                avg_impact = all_footprints['value'].mean()
-                region_names = [region_dict.get(code, "Unknown") for code in all_footprints['region_code'].tolist()]
-                region_str = ", ".join(region_names[:3])
-                if len(region_names) > 3:
-                    region_str += f" and {len(region_names)-3} other regions"
-                
-                # Clearly indicate using average data from multiple regions
-                result_final = f"BONSAI database results for '{target_description}' (AVERAGE DATA FROM MULTIPLE REGIONS: {region_str}, NOT {target_region}):\n"
-                result_final += f"Impact for {grams} grams: {round_to_sig_figs(avg_impact*grams/1000)} kg co2-eq\n"
-                
-                # Use the first available region's code for recipe lookup
-                filtered_footprints = pd.DataFrame([{
-                    'region_code': all_footprints['region_code'].iloc[0],
-                    'value': avg_impact
-                }])
-            else:
-                return f"No {target_type} data available for '{target_description}' in any region in BONSAI database\n"
+        # Clearly indicate using average data from multiple regions
+        result_final = f"BONSAI database results for '{target_description}' (AVERAGE DATA FROM MULTIPLE REGIONS: {region_str}, NOT {target_region}):\n"
+    result_final += f"Impact for {grams} grams: {round_to_sig_figs(record['per_kg']*grams/1000)} kg co2-eq\n"
 
-    filtered_recipes = recipes[(recipes['flow_reference'] == product_code) & 
-                            (recipes['region_reference'] == filtered_footprints['region_code'].iloc[0])]
-    recipe_details = filtered_recipes[['flow_input', 'region_inflow', 'value_inflow', 'value_emission', 'unit_inflow']]
+    if not record['has_recipe']:
+        return result_final + f"No {target_type} recipe available for '{target_description}' in {record['recipe_region']} in BONSAI database\n"
 
-    if recipe_details.shape[0]==0:
-        recipe_results = f"No {target_type} recipe available for '{target_description}' in {region_dict.get(filtered_footprints['region_code'].iloc[0], 'Unknown')} in BONSAI database\n"
+    recipe_results = ""
+    if record['direct'] is not None:
+        recipe_results += f"Direct process emissions: {round_to_sig_figs(record['direct']*grams/1000)} kg co2-eq\n"
     else:
-        recipe_details.loc[:,'value_emission'] = recipe_details['value_emission'].apply(lambda x: x*grams/1000)
-        recipe_details = recipe_details.map(lambda x: round_to_sig_figs(x) if isinstance(x, (int, float)) else x)
-        recipe_details['unit_inflow'] = recipe_details['unit_inflow'].apply(lambda x: unit_dict[x] if x in unit_dict.keys() else x)
-        recipe_details['value_inflow'] = recipe_details['value_inflow'].astype(str) + ' ' + recipe_details['unit_inflow']
-        recipe_details = recipe_details.drop('unit_inflow',axis=1)
-
-        recipe_details['flow_input'] = recipe_details['flow_input'].apply(lambda x: activity_dict[x].capitalize() if x in activity_dict.keys() else x)
-        recipe_details['region_inflow'] = recipe_details['region_inflow'].apply(lambda x: region_dict[x] if x in region_dict.keys() else x)
-
-        try:
-            direct_process_emissions = recipe_details[[item=='direct' for item in recipe_details['flow_input']]]['value_emission'].iloc[0]
-            recipe_details = recipe_details[[item!='direct' for item in recipe_details['flow_input']]]
-        except:
-            direct_process_emissions = None
-
-        other_row = recipe_details[[item=='other' for item in recipe_details['flow_input']]]
-        recipe_details = recipe_details[[item!='other' for item in recipe_details['flow_input']]]
-        recipe_details = recipe_details.sort_values('value_emission',ascending=False)
-        recipe_details = pd.concat([recipe_details, other_row])
-        recipe_details = recipe_details.replace({np.nan: None}).to_dict('records')
-
-        recipe_results = ""
-        if direct_process_emissions is not None:
-            recipe_results += f"Direct process emissions: {direct_process_emissions} kg co2-eq\n"
-        else:
-            recipe_results += "No direct process emissions\n"
-        if target_type=='market':
-            for rcp  in recipe_details:
-                flow_inp,region_inf,value_inf,value_ems = rcp.values()
-                if flow_inp=='other':
-                    recipe_results += f"Other Market Impact for {grams} grams: {value_ems} kg co2-eq\n"
-                else:
-                    recipe_results += f"Market share for {region_inf}: {value_inf}, Impact for {grams} grams: {value_ems} kg co2-eq\n"
+        recipe_results += "No direct process emissions\n"
+    if target_type=='market':
+        for rcp in record['inputs']:
+            value_ems = None if rcp['per_kg'] is None else round_to_sig_figs(rcp['per_kg']*grams/1000)
+            if rcp['flow']=='other':
+                recipe_results += f"Other Market Impact for {grams} grams: {value_ems} kg co2-eq\n"
+            else:
+                value_inf = f"{round_to_sig_figs(rcp['share'])} {rcp['unit']}"
+                recipe_results += f"Market share for {rcp['region']}: {value_inf}, Impact for {grams} grams: {value_ems} kg co2-eq\n"
 
     return result_final+recipe_results
 
 
-def get_agribalyse_data(product, agribalyse=agribalyse, grams=100):
-    try:
-        filtered_data = agribalyse[agribalyse['product_name'] == product]
-        result = filtered_data.iloc[0].to_dict()
-    except:
-        return f"No data available for '{product}' in Agribalyse database"
+def get_bonsai_data(target_description, target_type, target_region, grams=1000,
+                    footprints=None, recipes=None, activities=None, locations=None,
+                    activity_dict=None, region_dict=None, unit_dict=None,
+                    use_fallback=True):
+    record = lookup_bonsai(target_description, target_type, target_region,
+                           footprints=footprints, recipes=recipes, activities=activities, locations=locations,
+                           activity_dict=activity_dict, region_dict=region_dict, unit_dict=unit_dict,
+                           use_fallback=use_fallback)
+    return format_bonsai(record, grams=grams)
+
+
+def lookup_agribalyse(product, agribalyse=None):
+    """Look up the per-kg Agribalyse footprint and lifecycle shares of a product as a record."""
+    record = lookup_source('Agribalyse', product, 'France', catalog=catalog_for(agribalyse=agribalyse))
+    if 'missing' in record:
+        record['missing'] = f"No data available for '{product}' in Agribalyse database"
+    else:
+        del record['fallback_regions']
+        record.setdefault('dqr', np.nan)
+        record['phases'] = record.pop('phases')
+    return record
+
+
+def format_agribalyse(record, grams=100):
+    """Render an Agribalyse record as the prose used in the analysis prompt."""
+    if 'missing' in record:
+        return record['missing']
 
-    total_impact = result['total']*grams/1000
+    total_impact = record['per_kg']*grams/1000
 
     # Always clearly indicate this is French data
-    result_final = f"Agribalyse database results for '{product}' (DATA FROM FRANCE):\n"
+    result_final = f"Agribalyse database results for '{record['product']}' (DATA FROM FRANCE):\n"
     result_final += f"Impact for {grams} grams: {round_to_sig_figs(total_impact)} kg co2-eq\n"
-    result_final += f"Data quality rating: {result['dqr']}\n"
-    phases = ['agriculture', 'processing', 'packaging', 'transportation', 'retail', 'consumption']
-    for phase in phases:
-        result_final += f"{phase.title()} impact for {grams} grams: {round_to_sig_figs(result[phase]*total_impact)} kq co2-eq, Percentage: {result[phase]*100:.1f}%\n"
+    result_final += f"Data quality rating: {record['dqr']}\n"
+    for phase, share in record['phases'].items():
+        result_final += f"{phase} impact for {grams} grams: {round_to_sig_figs(share*total_impact)} kq co2-eq, Percentage: {share*100:.1f}%\n"
 
     return result_final
 
 
-def get_bigclimate_data(product, region, bigclimatedata=bigclimatedata, grams=1000, use_fallback=True):
-    filtered_data = bigclimatedata[bigclimatedata['Name'] == product]
-    if filtered_data.shape[0]==0:
-        return f"No data available for '{product}' in BigClimateDatabase"
-    
-    filtered_by_region = filtered_data[filtered_data['region'] == region]
-    if filtered_by_region.shape[0]==0:
-        if use_fallback:
-            # Use average of all available regions as fallback
-            avg_impact = filtered_data['Total kg CO2-eq/kg'].mean()
-            region_list = filtered_data['region'].unique().tolist()
-            region_str = ", ".join(region_list[:3])
-            if len(region_list) > 3:
-                region_str += f" and {len(region_list)-3} other regions"
-                
-            result_final = f"BigClimateDatabase results for '{product}' (AVERAGE DATA FROM MULTIPLE REGIONS: {region_str}, NOT {region}):\n"
-            result_final += f"Impact for {grams} grams: {round_to_sig_figs(avg_impact*grams/1000)} kg co2-eq\n"
+def get_agribalyse_data(product, agribalyse=None, grams=100):
+    return format_agribalyse(lookup_agribalyse(product, agribalyse=agribalyse), grams=grams)
+
+
+def lookup_bigclimate(product, region, bigclimatedata=None, use_fallback=True):
+    """Look up the per-kg BigClimateDatabase footprint and phase shares of a product as a record."""
+    record = lookup_source('Big Climate Database', product, region, use_fallback=use_fallback,
+                           catalog=catalog_for(bigclimatedata=bigclimatedata))
+    if record.get('missing') == 'product':
+        record['missing'] = f"No data available for '{product}' in BigClimateDatabase"
+    elif record.get('missing') == 'region':
+        record['missing'] = f"No data available for '{product}' for {region} in BigClimateDatabase"
+    else:
+        record.pop('dqr', None)
+    return record
+
+
+def lookup_source(source, product, region, use_fallback=True, catalog=None):
+    """Look up the per-kg footprint and phase shares of a product of any catalog source as a record.
+
+    Without data for the region, and with use_fallback, the average over the regions
+    with data is used. A missing record has 'missing' set to 'product' or 'region'."""
+    catalog = catalog or get_catalog()
+    record = {'source': source, 'product': product, 'region': region}
+    found = catalog.find(source, product, catalog.availability_kinds.get(source, FOOD))
+    if found is None:
+        record['missing'] = 'product'
+        return record
+    match = catalog.match(found, region, use_fallback=use_fallback)
+    if match is None:
+        record['missing'] = 'region'
+        return record
+
+    entry = match['entry']
+    record['per_kg'] = match['per_kg']
+    fallback_regions = match['fallback_regions']
+    record['fallback_regions'] = None if fallback_regions is None else list(dict.fromkeys(fallback_regions))
+    dqr = catalog.entry_dqr[entry]
+    if not np.isnan(dqr):
+        record['dqr'] = dqr
+    record['phases'] = catalog.phases(entry, source)
+    return record
+
+
+def format_bigclimate(record, grams=1000):
+    """Render a BigClimateDatabase record as the prose used in the analysis prompt."""
+    if 'missing' in record:
+        return record['missing']
+
+    product, region = record['product'], record['region']
+    if record['fallback_regions'] is not None:
+        region_list = record['fallback_regions']
+        region_str = ", ".join(region_list[:3])
+        if len(region_list) > 3:
+            region_str += f" and {len(region_list)-3} other regions"
             
-            # Use first region for detailed breakdown
-            result = filtered_data.iloc[0].to_dict()
-        else:
-            return f"No data available for '{product}' for {region} in BigClimateDatabase"
+        result_final = f"BigClimateDatabase results for '{product}' (AVERAGE DATA FROM MULTIPLE REGIONS: {region_str}, NOT {region}):\n"
     else:
         result_final = f"BigClimateDatabase results for '{product}' in {region}:\n"
-        result = filtered_by_region.iloc[0].to_dict()
-        avg_impact = result['Total kg CO2-eq/kg']
-        result_final += f"Impact for {grams} grams: {round_to_sig_figs(avg_impact*grams/1000)} kg co2-eq\n"
-
-    total_impact = avg_impact*grams/1000
-    phases = ['Agriculture', 'iLUC', 'Food processing', 'Packaging', 'Transport', 'Retail']
-    for phase in phases:
-        phase_name = 'Indirect Land Use Change' if phase=='iLUC' else phase
-        try:
-            phase_impact = result[phase] * (total_impact / result['Total kg CO2-eq/kg'])
-            phase_percentage = (phase_impact / total_impact) * 100
-            result_final += f"{phase_name} impact for {grams} grams: {round_to_sig_figs(phase_impact)} kq co2-eq, Percentage: {phase_percentage:.1f}%\n"
-        except:
-            continue
+    total_impact = record['per_kg']*grams/1000
+    result_final += f"Impact for {grams} grams: {round_to_sig_figs(total_impact)} kg co2-eq\n"
+
+    if total_impact == 0:
+        return result_final
+    for phase_name, share in record['phases'].items():
+        phase_impact = share * total_impact
+        result_final += f"{phase_name} impact for {grams} grams: {round_to_sig_figs(phase_impact)} kq co2-eq, Percentage: {share*100:.1f}%\n"
 
     return result_final
 
 
+def get_bigclimate_data(product, region, bigclimatedata=None, grams=1000, use_fallback=True):
+    return format_bigclimate(lookup_bigclimate(product, region, bigclimatedata=bigclimatedata, use_fallback=use_fallback), grams=grams)
+
+
 def round_to_sig_figs(x, sig_figs=3):
     if isinstance(x, (int, float)):
         if np.isnan(x) or x == 0:
@@ -236,71 +324,334 @@ def round_to_sig_figs(x, sig_figs=3):
         return x
     
 
+@timed("similar_items")
 def get_similar_items(search_top_k, ingredients_list, encoder, vector_database, target_country="Netherlands"):
-    """Get similar items for each ingredient and check availability in target country."""
-    search_query = deepcopy(ingredients_list)
+    """Get similar items for each ingredient and check availability in target country.
+
+    Near-duplicates of recent queries for the same country reuse their options (semantic_cache.py)."""
+    search_query = [tuple(cur_ingredients.values()) for cur_ingredients in ingredients_list]
+    embeddings = semantic_cache.embed(encoder, [query for query, _ in search_query]) if search_query else []
     ingredient_options = {}
     
-    for cur_ingredients in search_query:
-        query, grams = cur_ingredients.values()
-        top_k_results = search_top_k(encoder, vector_database, query, 3)
-        
-        all_options = []
-        options_with_availability = {}
-        
-        for source, items in top_k_results.items():
-            for item in items:
-                has_country_data = check_product_availability(item, target_country)
-                all_options.append(item)
-                options_with_availability[item.lower()] = has_country_data
-            
-        ingredient_options[query] = {
-            'amount': grams,
-            'options': all_options,
-            'sources': top_k_results,
-            'availability': options_with_availability
-        }
+    for (query, grams), embedding in zip(search_query, embeddings):
+        cached = semantic_cache.lookup(embedding, target_country)
+        if cached is None:
+            top_k_results = search_top_k(encoder, vector_database, query, 3, query_embedding=embedding.reshape(1, -1))
+
+            all_options = []
+            options_with_availability = {}
+
+            for source, items in top_k_results.items():
+                for item in items:
+                    has_country_data = check_product_availability(item, target_country)
+                    all_options.append(item)
+                    options_with_availability[item.lower()] = has_country_data
+
+            cached = {
+                'options': all_options,
+                'sources': top_k_results,
+                'availability': options_with_availability
+            }
+            semantic_cache.store(embedding, target_country, query, cached)
+
+        # A copy, so the caller can change its options without changing the cache
+        ingredient_options[query] = {'amount': grams, **deepcopy(cached)}
     
     return ingredient_options
 
 
-def get_results(selected_items, ingredients_options, country):
-    search_query = []
-    
-    for (ingredient, data), selections in zip(ingredients_options.items(), selected_items):
-        cur_ingredient = {
-            'query': ingredient,
-            'grams': data['amount'],
-            'results': f"Results for selected most similar items to '{ingredient}':\n\n"
+def lookup_product(source, product_name, country):
+    """Look up the per-kg records of one selected product, independent of the amount used."""
+    if source == 'BONSAI':
+        return [
+            lookup_bonsai(product_name, 'product', country, use_fallback=False),
+            lookup_bonsai(product_name, 'market', country, use_fallback=True)
+        ]
+    elif source == 'Agribalyse':
+        return [lookup_agribalyse(product_name)]
+    elif source == 'Big Climate Database':
+        return [lookup_bigclimate(product_name, country, use_fallback=True)]
+    return [lookup_source(source, product_name, country)]
+
+
+def format_product(records, grams):
+    """Render the records of one selected product as the prose used in the analysis prompt."""
+    formatters = {'BONSAI': format_bonsai, 'Agribalyse': format_agribalyse, 'Big Climate Database': format_bigclimate}
+    return "\n".join(formatters[record['source']](record, grams=grams) for record in records) + "\n"
+
+
+def impact_range(records, grams):
+    """Min, max and average impact in kg CO2-eq of `grams` of an ingredient over its records.
+
+    BONSAI production records are ignored when market data is available, as in the analysis prompt."""
+    available = [record for record in records if 'missing' not in record]
+    has_market = any(record['source'] == 'BONSAI' and record['type'] == 'market' for record in available)
+    values = [
+        record['per_kg']*grams/1000 for record in available
+        if not (has_market and record['source'] == 'BONSAI' and record['type'] == 'product')
+    ]
+    values = [value for value in values if not np.isnan(value)]
+    if not values:
+        return None
+    return min(values), max(values), (min(values) + max(values)) / 2
+
+
+def selected_products(selections, data):
+    """The (source, product) pairs of an ingredient's options that the user selected."""
+    # Clean the selections (remove asterisks if present)
+    cleaned_selections = [s.split(" *")[0].lower() for s in selections]
+    return [
+        (source, item) for source, items in data['sources'].items()
+        for item in items if item.lower() in cleaned_selections
+    ]
+
+
+def record_values(source, rows, columns, catalog=None):
+    """The records lookup_product returns, for many products and countries of the impact matrix at once.
+
+    `rows` maps a product kind to the matrix rows of the products (-1 when missing) and
+    `columns` lists the country columns (-1 for a country without data). Returns (kind, available, per_kg, estimated) per
+    record, each a products × countries array, where `estimated` marks values from other
+    regions: averages, or French data for Agribalyse."""
+    catalog = catalog or get_catalog()
+    matrix = catalog.impact_matrix()
+    columns = np.asarray(columns, dtype=np.int64)
+    is_france = np.array([column >= 0 and matrix['countries'][column] == 'France' for column in columns], dtype=bool)
+
+    def values(kind, columns, use_fallback=True):
+        found = (rows[kind] >= 0)[:, None]
+        row = np.maximum(rows[kind], 0)
+        present = matrix['present'][row][:, np.maximum(columns, 0)] & found & (columns >= 0)
+        per_kg = np.where(present, matrix['per_kg'][row][:, np.maximum(columns, 0)], np.nan)
+        if not use_fallback:
+            return kind, present, per_kg, np.zeros(present.shape, dtype=bool)
+        available = np.broadcast_to(found, present.shape)
+        return kind, available, np.where(present, per_kg, matrix['mean'][row][:, None]), available & ~present
+
+    if source == 'BONSAI':
+        return [values('product', columns, use_fallback=False), values('market', columns)]
+    if source == 'Agribalyse':
+        # French data whatever the country
+        france = matrix['countries'].index('France') if 'France' in matrix['countries'] else -1
+        kind, available, per_kg, _ = values(FOOD, np.array([france]))
+        shape = (len(rows[FOOD]), len(columns))
+        return [(kind, np.broadcast_to(available, shape), np.broadcast_to(per_kg, shape),
+                 np.broadcast_to(available, shape) & ~is_france)]
+    return [values(catalog.availability_kinds.get(source, FOOD), columns)]
+
+
+def country_columns(countries=None, catalog=None):
+    """Impact matrix columns of the given countries (-1 for a country without any data), of all countries when None."""
+    names = (catalog or get_catalog()).impact_matrix()['countries']
+    if countries is None:
+        return np.arange(len(names))
+    columns = {name: n for n, name in enumerate(names)}
+    return np.array([columns.get(country, -1) for country in countries], dtype=np.int64)
+
+
+def product_rows(source, names, catalog=None):
+    """Impact matrix rows of a source's products by name, per product kind, for record_values."""
+    catalog = catalog or get_catalog()
+    matrix_rows = catalog.impact_matrix()['rows']
+    kinds = ['product', 'market'] if source == 'BONSAI' else [catalog.availability_kinds.get(source, FOOD)]
+    rows = {}
+    for kind in kinds:
+        products = [catalog.find(source, name, kind) for name in names]
+        rows[kind] = np.array([-1 if product is None else matrix_rows[product] for product in products], dtype=np.int64)
+    return rows
+
+
+def ingredient_range(records, grams):
+    """Vectorized impact_range: min, max and whether any used value is estimated, per column.
+
+    `records` are record_values results of one ingredient's products, all for the same columns."""
+    kinds = np.array([kind for record in records for kind in [record[0]] * len(record[1])], dtype=object)
+    available = np.concatenate([record[1] for record in records])
+    values = np.concatenate([record[2] for record in records]) * grams / 1000
+    estimated = np.concatenate([record[3] for record in records])
+
+    # As in impact_range: BONSAI production data only counts without market data
+    has_market = (available & (kinds == 'market')[:, None]).any(axis=0)
+    used = available & ~((kinds == 'product')[:, None] & has_market) & ~np.isnan(values)
+    found = used.any(axis=0)
+    low = np.where(found, np.where(used, values, np.inf).min(axis=0), np.nan)
+    high = np.where(found, np.where(used, values, -np.inf).max(axis=0), np.nan)
+    return low, high, (used & estimated).any(axis=0)
+
+
+@timed("compare_countries")
+def compare_countries(selected_items, ingredients_options, countries=None):
+    """Footprint of the selected products in every country, ranked from the lowest impact.
+
+    One vectorized pass over the catalog's impact matrix gives, per country, what
+    impact_range of get_results' records would give. Countries missing data for some
+    ingredients rank after the complete ones. Each row lists the ingredients without
+    data and those estimated from other regions."""
+    catalog = get_catalog()
+    names = list(catalog.impact_matrix()['countries'] if countries is None else countries)
+    columns = country_columns(names, catalog)
+
+    ingredients = list(ingredients_options)
+    low = np.full((len(ingredients), len(columns)), np.nan)
+    high = np.full((len(ingredients), len(columns)), np.nan)
+    estimated = np.zeros((len(ingredients), len(columns)), dtype=bool)
+    for n, ((ingredient, data), selections) in enumerate(zip(ingredients_options.items(), selected_items)):
+        records = [
+            record for source, product_name in selected_products(selections or [], data)
+            for record in record_values(source, product_rows(source, [product_name], catalog), columns, catalog)
+        ]
+        if records:
+            low[n], high[n], estimated[n] = ingredient_range(records, data['amount'])
+
+    missing = np.isnan(low)
+    totals = np.nansum(low, axis=0), np.nansum(high, axis=0)
+    has_data = (~missing).any(axis=0)
+    order = np.lexsort(((totals[0] + totals[1]) / 2, ~has_data, missing.sum(axis=0)))
+    return [
+        {
+            'country': names[column],
+            'min_kg': totals[0][column] if has_data[column] else None,
+            'max_kg': totals[1][column] if has_data[column] else None,
+            'average_kg': (totals[0][column] + totals[1][column]) / 2 if has_data[column] else None,
+            'missing': [ingredients[n] for n in np.flatnonzero(missing[:, column])],
+            'estimated': [ingredients[n] for n in np.flatnonzero(estimated[:, column])],
         }
-        
-        if not selections:
-            cur_ingredient['results'] += f"No data available in all data sources for {ingredient}"
-        else:
-            # Clean the selections (remove asterisks if present)
-            cleaned_selections = [s.split(" *")[0] for s in selections]
-            
-            filtered_results = {
-                source: [item for item in items if any(s.lower() == item.lower() for s in cleaned_selections)]
-                for source, items in data['sources'].items()
-            }
-            
-            for source, name_list in filtered_results.items():
-                for product_name in name_list:
-                    if source == 'BONSAI':
-                        cur_ingredient['results'] += get_bonsai_data(product_name, 'product', country, grams=data['amount'], use_fallback=False)
-                        cur_ingredient['results'] += "\n"
-                        cur_ingredient['results'] += get_bonsai_data(product_name, 'market', country, grams=data['amount'], use_fallback=True)
-                    elif source == 'Agribalyse':
-                        cur_ingredient['results'] += get_agribalyse_data(product_name, grams=data['amount'])
-                    else:
-                        cur_ingredient['results'] += get_bigclimate_data(product_name, country, grams=data['amount'], use_fallback=True)
-                    cur_ingredient['results'] += "\n"
-        
-        search_query.append(cur_ingredient)
+        for column in order
+    ]
+
+
+@lru_cache(maxsize=None)
+def source_rows(source):
+    """product_rows of all the products of a source, in product_names order."""
+    return product_rows(source, get_catalog().product_names(source))
+
+
+@lru_cache(maxsize=IMPACT_TABLE_CACHE_SIZE)
+def impact_table(source, country):
+    """Per-kg impact in a country of every product of a source, as impact_range would give it for 1 kg.
+
+    Computed once per source and country: {'position': {name: i}, 'per_kg', 'estimated'},
+    with NaN per_kg for products without data."""
+    catalog = get_catalog()
+    names = catalog.product_names(source)
+    records = record_values(source, source_rows(source), country_columns([country], catalog), catalog)
+    # Products are the columns of ingredient_range here, with one row per record kind
+    records = [(kind, available.T, per_kg.T, estimated.T) for kind, available, per_kg, estimated in records]
+    low, high, estimated = ingredient_range(records, 1000)
+    return {
+        'position': {name: n for n, name in enumerate(names)},
+        'per_kg': (low + high) / 2,
+        'estimated': estimated,
+    }
+
+
+@timed("substitutes")
+def get_substitutes(search_top_k_batch, selected_items, ingredients_options, encoder, vector_database, country,
+                    k=SUBSTITUTE_CANDIDATES, per_ingredient=SUBSTITUTES_PER_INGREDIENT, min_similarity=SUBSTITUTE_SIMILARITY):
+    """Similar products with a lower per-kg footprint in the country than the selected ones, per ingredient.
+
+    The ingredient names are searched in one batch, and the neighbours are joined against
+    the precomputed impact tables of the country. Swaps are ranked by the kg CO2-eq saved
+    for the ingredient's amount."""
+    catalog = get_catalog()
+    columns = country_columns([country], catalog)
+    ingredients = []
+    for (ingredient, data), selections in zip(ingredients_options.items(), selected_items):
+        selected = selected_products(selections or [], data)
+        records = [
+            record for source, product_name in selected
+            for record in record_values(source, product_rows(source, [product_name], catalog), columns, catalog)
+        ]
+        if not records:
+            continue
+        low, high, _ = ingredient_range(records, 1000)
+        if not np.isnan(low[0]):
+            ingredients.append((ingredient, data['amount'], (low[0] + high[0]) / 2, {name.lower() for _, name in selected}))
+    if not ingredients:
+        return {}
+
+    substitutes = {}
+    neighbours = search_top_k_batch(encoder, vector_database, [ingredient for ingredient, _, _, _ in ingredients], k)
+    for (ingredient, grams, baseline, selected), matches in zip(ingredients, neighbours):
+        swaps = {}
+        for source, products in matches.items():
+            table = impact_table(source, country)
+            for product, similarity in products:
+                position = table['position'].get(product)
+                if similarity < min_similarity or product.lower() in selected or position is None:
+                    continue
+                per_kg = table['per_kg'][position]
+                if not per_kg < baseline or product.lower() in swaps:
+                    continue
+                swaps[product.lower()] = {
+                    'source': source,
+                    'product': product,
+                    'similarity': similarity,
+                    'per_kg': per_kg,
+                    'estimated': bool(table['estimated'][position]),
+                    'saving_kg': (baseline - per_kg) * grams / 1000,
+                    'saving_share': 1 - per_kg / baseline if baseline > 0 else None,
+                }
+        ranked = sorted(swaps.values(), key=lambda swap: -swap['saving_kg'])[:per_ingredient]
+        if ranked:
+            substitutes[ingredient] = {'grams': grams, 'per_kg': baseline, 'swaps': ranked}
+    return substitutes
+
+
+def ingredient_results(ingredient, data, selections, country, lookup=lookup_product):
+    """Records and prompt text of one ingredient's selected products, as get_results lists them."""
+    cur_ingredient = {
+        'query': ingredient,
+        'grams': data['amount'],
+        'records': [],
+        'results': f"Results for selected most similar items to '{ingredient}':\n\n"
+    }
+    
+    if not selections:
+        cur_ingredient['results'] += f"No data available in all data sources for {ingredient}"
+    else:
+        for source, product_name in selected_products(selections, data):
+            records = lookup(source, product_name, country)
+            cur_ingredient['records'].extend(records)
+            cur_ingredient['results'] += format_product(records, data['amount'])
+    
+    return cur_ingredient
+
+
+@timed("get_results")
+def get_results(selected_items, ingredients_options, country, lookup=lookup_product):
+    search_query = [
+        ingredient_results(ingredient, data, selections, country, lookup)
+        for (ingredient, data), selections in zip(ingredients_options.items(), selected_items)
+    ]
     
     results_text = ""
     for cur_dict in search_query:
         results_text += cur_dict['results']
     
-    return search_query, results_text
\ No newline at end of file
+    return search_query, results_text
+
+
+@timed("update_analysis")
+def update_analysis(analysis, selected_items, ingredients_options, country, lookup=lookup_product):
+    """Bring a session's analysis up to date with new selections, recomputing only the changed ingredients.
+
+    `analysis` keeps, per ingredient, the country, amount and selections it was computed
+    for, its get_results entry and its impact range, plus the recipe total, which is
+    updated by the deltas of the changed ingredients. Returns the changed ingredients."""
+    memo = analysis.setdefault('ingredients', {})
+    total = analysis.setdefault('total', [0.0, 0.0, 0.0])
+    changed = []
+    for (ingredient, data), selections in zip(ingredients_options.items(), selected_items):
+        key = (country, data['amount'], tuple(sorted(selections or [])))
+        previous = memo.get(ingredient)
+        if previous is not None and previous['key'] == key:
+            continue
+        cur_ingredient = ingredient_results(ingredient, data, selections, country, lookup)
+        impact = impact_range(cur_ingredient['records'], cur_ingredient['grams'])
+        old_impact = previous['impact'] if previous is not None else None
+        for n in range(3):
+            total[n] += (impact[n] if impact else 0) - (old_impact[n] if old_impact else 0)
+        memo[ingredient] = {'key': key, 'result': cur_ingredient, 'impact': impact}
+        changed.append(ingredient)
+    return changed
@@ -1,10 +1,12 @@
 import os
 import json
-import requests
-import pandas as pd
-from tqdm import tqdm
+import hashlib
+import math
+import random
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 BASE_URL = "https://lca.aau.dk"
 TOKEN = "ADD TOKEN HERE"
@@ -14,6 +16,17 @@ HEADERS = {
 }
 DATA_DIR = Path("Data")
 BONSAI_DIR = DATA_DIR / "BONSAI"
+# Downloads in progress and their checkpoints
+PARTIAL_DIR = BONSAI_DIR / "partial"
+# What was downloaded and with which filters
+MANIFEST_PATH = BONSAI_DIR / "manifest.json"
+
+# Rows kept at download time: column -> accepted values. Files downloaded with
+# other filters are downloaded again.
+BONSAI_FILTERS = {
+    'footprints': {'version': ['v1.0.0'], 'unit_reference': ['tonnes']},
+    'recipes': {'version': ['v1.0.0']},
+}
 
 def ensure_directories():
     """Create necessary directories if they don't exist."""
@@ -29,9 +42,12 @@ def check_existing_bonsai_data():
         'bonsai_activity-names.json'
     ]
     
+    manifest = load_manifest()
     missing_files = []
     for file in required_files:
-        if not (BONSAI_DIR / file).exists():
+        name = file.replace('bonsai_', '').replace('.json', '')
+        stale = file in manifest and manifest[file]['filters'] != BONSAI_FILTERS.get(name, {})
+        if not (BONSAI_DIR / file).exists() or stale:
             missing_files.append(file)
             
     return missing_files
@@ -45,65 +61,288 @@ def check_existing_bigclimate_data():
     return not (DATA_DIR / 'bigclimatedb.csv').exists()
 
 
-def get_all_pages(url):
-    all_results = []
-    counter = 0
-    total_items = 0
-    pbar = tqdm(desc="Fetching pages", unit=" pages")
+FETCH_WORKERS = 8
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 0.5  # doubled after every failed attempt
+REQUEST_TIMEOUT = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
-    while url:
-        response = requests.get(url, headers=HEADERS)
-        if response.status_code == 200:
-            data = response.json()
-            all_results.extend(data['results'])
-            url = data['next']
-            counter += 1
-            if 'count' in data:
-                total_items = data['count']
-                pbar.total = total_items
-            pbar.update(len(data['results']))
-        else:
-            print(f"\nError: {response.status_code}")
-            print(response.text)
-            break
 
-    pbar.close()
-    print(f"\nFetching complete. Total pages: {counter}, Total items: {len(all_results)}")
-    return all_results
+def create_session(workers=FETCH_WORKERS):
+    """A requests session with a connection pool large enough for the concurrent page fetches."""
+    import requests
+    from requests.adapters import HTTPAdapter
 
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
-def get_all_non_page(url):
-    all_results = []
-    page = 1
-    pbar = tqdm(desc="Fetching pages", unit="page")
 
-    start_time = time.time()
+def fetch(session, url, params=None, retries=None, backoff=None, stats=None):
+    """GET a URL, retrying connection errors and 429/5xx responses with exponential backoff.
 
-    while True:
-        response = requests.get(url, headers=HEADERS, params={'page': page})
+    Other responses, including 404, are returned to the caller. Raises after the last retry."""
+    import requests
 
-        if response.status_code == 200:
-            data = response.json()
-            if isinstance(data, list) and data:
-                all_results.extend(data)
+    retries = MAX_RETRIES if retries is None else retries
+    backoff = BACKOFF_SECONDS if backoff is None else backoff
+    for attempt in range(retries + 1):
+        try:
+            response = session.get(url, params=params, timeout=REQUEST_TIMEOUT)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            error = f"HTTP {response.status_code}"
+        except requests.RequestException as e:
+            error = str(e)
+        if attempt < retries:
+            if stats is not None:
+                stats['retries'] += 1
+            time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+    raise RuntimeError(f"Giving up on {url} {params or ''} after {retries + 1} attempts: {error}")
+
+
+def page_url(url, page):
+    """The URL of a page number, keeping the other query parameters of the URL."""
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query['page'] = page
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def new_stats():
+    return {'pages': 0, 'items': 0, 'bytes': 0, 'retries': 0, 'start': time.perf_counter()}
+
+
+def report_throughput(name, stats):
+    elapsed = max(time.perf_counter() - stats['start'], 1e-9)
+    print(f"\n{name}: {stats['pages']} pages, {stats['items']} items, {stats['bytes'] / 1e6:.1f} MB "
+          f"in {elapsed:.1f}s ({stats['pages'] / elapsed:.1f} pages/s, {stats['items'] / elapsed:.0f} items/s, "
+          f"{stats['retries']} retries)")
+
+
+def iter_numbered_pages(session, url, first_page, last_page=None, extract=None, workers=FETCH_WORKERS, stats=None):
+    """Fetch ?page=N pages concurrently and yield (page, items) in page order.
+
+    With last_page None the end of the data is the first page that is missing (404)
+    or empty. At most 2 * workers pages are requested ahead of the one being yielded."""
+    stats = stats if stats is not None else new_stats()
+
+    def fetch_page(page):
+        response = fetch(session, page_url(url, page), stats=stats)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        data = response.json()
+        items = extract(data) if extract else data
+        stats['bytes'] += len(response.content)
+        return items
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        next_page = first_page
+        page = first_page
+        try:
+            while True:
+                while len(pending) < 2 * workers and (last_page is None or next_page <= last_page):
+                    pending[next_page] = pool.submit(fetch_page, next_page)
+                    next_page += 1
+                if page not in pending:
+                    return
+                items = pending.pop(page).result()
+                if not items:
+                    return
+                stats['pages'] += 1
+                stats['items'] += len(items)
+                yield page, items
                 page += 1
-                #pbar.update(1)
-
-                elapsed_time = time.time() - start_time
-                pages_per_second = page / elapsed_time
-                pbar.set_description(f"Fetching page {page} [{elapsed_time:.0f}s, {pages_per_second:.2f}page/s]")
-            else:
-                print("\nReached the end of data or received unexpected response format")
-        elif response.status_code == 404:
-            print(response.json())
-            break
-        else:
-            page += 1
+        finally:
+            for future in pending.values():
+                future.cancel()
+
+
+def iter_pages(session, url, workers=FETCH_WORKERS, stats=None, start_page=1):
+    """Yield (page, items) of a paginated endpoint ({"count", "next", "results"}) in page order.
+
+    The first page gives the page size and the count, so the remaining pages are
+    fetched concurrently. Falls back to following the `next` links one by one if
+    they are not page-numbered. A start_page past the last page yields nothing."""
+    stats = stats if stats is not None else new_stats()
+    response = fetch(session, page_url(url, start_page) if start_page > 1 else url, stats=stats)
+    if response.status_code == 404 and start_page > 1:
+        return
+    response.raise_for_status()
+    data = response.json()
+    stats['pages'] += 1
+    stats['items'] += len(data['results'])
+    stats['bytes'] += len(response.content)
+    yield start_page, data['results']
+
+    next_url = data.get('next')
+    if not next_url:
+        return
+    if 'page' in dict(parse_qsl(urlsplit(next_url).query)) and data.get('count') and data['results']:
+        last_page = math.ceil(data['count'] / len(data['results']))
+        yield from iter_numbered_pages(session, next_url, start_page + 1, last_page,
+                                       extract=lambda page: page['results'], workers=workers, stats=stats)
+        return
+
+    page = start_page
+    while next_url:
+        response = fetch(session, next_url, stats=stats)
+        response.raise_for_status()
+        data = response.json()
+        page += 1
+        stats['pages'] += 1
+        stats['items'] += len(data['results'])
+        stats['bytes'] += len(response.content)
+        yield page, data['results']
+        next_url = data.get('next')
+
+
+def collect(name, pages, stats, total=None):
+    from tqdm import tqdm
 
-    pbar.close()
+    all_results = []
+    with tqdm(desc=f"Fetching {name}", unit=" pages", total=total) as pbar:
+        for _, items in pages:
+            all_results.extend(items)
+            pbar.update(1)
+    report_throughput(name, stats)
     return all_results
 
-def download_bonsai_data(missing_files=None):
+
+def get_all_pages(url, session=None, workers=FETCH_WORKERS):
+    """All results of an endpoint paginated with `count`/`next` links."""
+    session = session or create_session(workers)
+    stats = new_stats()
+    return collect(url, iter_pages(session, url, workers, stats), stats)
+
+
+def get_all_non_page(url, session=None, workers=FETCH_WORKERS):
+    """All results of an endpoint returning a plain list per ?page=N, ending with a 404 or an empty page."""
+    session = session or create_session(workers)
+    stats = new_stats()
+    return collect(url, iter_numbered_pages(session, url, 1, workers=workers, stats=stats), stats)
+
+
+def keep_row(item, filters):
+    return all(item.get(column) in values for column, values in filters.items())
+
+
+def filter_mask(df, filters):
+    """Boolean mask of the DataFrame rows matching the filters, as keep_row does for downloaded items."""
+    import pandas as pd
+
+    mask = pd.Series(True, index=df.index)
+    for column, values in filters.items():
+        mask &= df[column].isin(values)
+    return mask
+
+
+def load_manifest():
+    try:
+        return json.loads(MANIFEST_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def update_manifest(filename, entry):
+    manifest = load_manifest()
+    manifest[filename] = entry
+    temp_path = MANIFEST_PATH.with_suffix('.tmp')
+    temp_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(temp_path, MANIFEST_PATH)
+
+
+def load_checkpoint(checkpoint_path, url, filters):
+    """The checkpoint of an interrupted download of url with the same filters, or None."""
+    try:
+        checkpoint = json.loads(checkpoint_path.read_text())
+    except (OSError, ValueError):
+        return None
+    return checkpoint if checkpoint.get('url') == url and checkpoint.get('filters') == filters else None
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    temp_path = checkpoint_path.with_suffix('.tmp')
+    temp_path.write_text(json.dumps(checkpoint))
+    os.replace(temp_path, checkpoint_path)
+
+
+def ndjson_to_json(ndjson_path, json_path):
+    """Rewrite NDJSON as the JSON array load_data reads, line by line without parsing the items."""
+    temp_path = json_path.with_suffix('.json.tmp')
+    with open(ndjson_path, 'rb') as source, open(temp_path, 'wb') as target:
+        target.write(b"[")
+        separator = b"\n"
+        for line in source:
+            line = line.rstrip(b"\n")
+            if line:
+                target.write(separator + line)
+                separator = b",\n"
+        target.write(b"\n]\n")
+    os.replace(temp_path, json_path)
+
+
+def stream_download(name, url, pages_from, file_path, filters=None):
+    """Download an endpoint page by page into an append-only NDJSON file, then convert it to file_path.
+
+    pages_from(start_page, stats) yields (page, items). Only the items matching
+    the filters are written. A checkpoint with the last completed page and the
+    file size at that point is saved after every page, so an interrupted download
+    resumes after that page and only one window of pages is ever held in memory."""
+    filters = filters or {}
+    PARTIAL_DIR.mkdir(parents=True, exist_ok=True)
+    ndjson_path = PARTIAL_DIR / f"{name}.ndjson"
+    checkpoint_path = PARTIAL_DIR / f"{name}.checkpoint.json"
+
+    checkpoint = load_checkpoint(checkpoint_path, url, filters) if ndjson_path.exists() else None
+    if checkpoint:
+        print(f"Resuming {name} after page {checkpoint['page']} ({checkpoint['items']} items)")
+    else:
+        checkpoint = {'url': url, 'filters': filters, 'page': 0, 'downloaded': 0, 'items': 0, 'offset': 0,
+                      'complete': False}
+
+    if not checkpoint['complete']:
+        from tqdm import tqdm
+
+        stats = new_stats()
+        with open(ndjson_path, 'ab') as f, tqdm(desc=f"Fetching {name}", unit=" pages", initial=checkpoint['page']) as pbar:
+            # Drop anything written after the last checkpoint
+            f.truncate(checkpoint['offset'])
+            for page, items in pages_from(checkpoint['page'] + 1, stats):
+                kept = [item for item in items if keep_row(item, filters)]
+                f.write(b"".join(json.dumps(item).encode() + b"\n" for item in kept))
+                f.flush()
+                checkpoint.update(page=page, downloaded=checkpoint['downloaded'] + len(items),
+                                  items=checkpoint['items'] + len(kept), offset=f.tell())
+                save_checkpoint(checkpoint_path, checkpoint)
+                pbar.update(1)
+        report_throughput(name, stats)
+        checkpoint['complete'] = True
+        save_checkpoint(checkpoint_path, checkpoint)
+
+    if checkpoint['items']:
+        ndjson_to_json(ndjson_path, file_path)
+        update_manifest(file_path.name, {
+            'url': url,
+            'filters': filters,
+            'rows_downloaded': checkpoint['downloaded'],
+            'rows_kept': checkpoint['items'],
+            'bytes': file_path.stat().st_size,
+            'downloaded_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        })
+        if filters:
+            print(f"Kept {checkpoint['items']} of {checkpoint['downloaded']} {name} rows matching {filters}")
+    os.remove(ndjson_path)
+    os.remove(checkpoint_path)
+    return checkpoint['items']
+
+
+def download_bonsai_data(missing_files=None, base_url=BASE_URL, workers=FETCH_WORKERS):
     """Download specified BONSAI data files."""
     endpoints = {
         'bonsai_footprints.json': '/api/footprint/',
@@ -113,6 +352,7 @@ def download_bonsai_data(missing_files=None):
     }
     
     files_to_download = missing_files if missing_files else endpoints.keys()
+    session = create_session(workers)
     
     for filename in files_to_download:
         if filename not in endpoints:
@@ -124,27 +364,34 @@ def download_bonsai_data(missing_files=None):
         name = filename.replace('bonsai_', '').replace('.json', '')
         
         print(f"\nDownloading {name}...")
-        url = f"{BASE_URL}{endpoint}"
+        url = f"{base_url}{endpoint}"
         
         if name == 'activity-names':
-            response = requests.get(url, headers=HEADERS)
+            response = fetch(session, url)
+            response.raise_for_status()
             data = response.json()
+            if data:
+                with open(file_path, 'w') as f:
+                    json.dump(data, f)
+            items = len(data)
         elif name == 'recipes':
-            data = get_all_non_page(url)
+            items = stream_download(name, url, lambda start, stats, url=url: iter_numbered_pages(
+                session, url, start, workers=workers, stats=stats), file_path, BONSAI_FILTERS.get(name))
         else:
-            data = get_all_pages(url)
+            items = stream_download(name, url, lambda start, stats, url=url: iter_pages(
+                session, url, workers, stats, start_page=start), file_path, BONSAI_FILTERS.get(name))
         
-        if data:
-            with open(file_path, 'w') as f:
-                json.dump(data, f, indent=2)
+        if items:
             print(f"Successfully saved {file_path}")
         else:
             print(f"Failed to download {name}")
             return False
     return True
 
-def download_agribalyse_data():
-    """Download and process Agribalyse data."""
+def process_agribalyse(xlsx_path, output_file):
+    """Translate the per-stage sheet of the Agribalyse workbook into agribalyse_data.csv."""
+    import pandas as pd
+
     AGRIBALYSE_COLUMNS = [
         "Groupe d'aliment",
         "Sous-groupe d'aliment",
@@ -237,44 +484,18 @@ def download_agribalyse_data():
         'œufs': 'eggs'
     }
 
-    url = "https://entrepot.recherche.data.gouv.fr/api/access/datafile/:persistentId?persistentId=doi:10.57745/94BKZL"
-    temp_file = DATA_DIR / 'agribalyse_data.xlsx'
-    output_file = DATA_DIR / 'agribalyse_data.csv'
-
-    try:
-        print("Downloading Agribalyse data...")
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-
-        with open(temp_file, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    file.write(chunk)
-
-        print("Processing Agribalyse data...")
-        agribalyse_pd = pd.read_excel(temp_file, sheet_name="Detail etape", skiprows=3).dropna()[AGRIBALYSE_COLUMNS]
-        agribalyse_pd.columns = ['group', 'subgroup', 'product_name', 'dqr', 'agriculture', 'processing', 
-                                'packaging', 'transportation', 'retail', 'consumption', 'total']
-        
-        agribalyse_pd['group'] = agribalyse_pd['group'].apply(lambda x: FRENCH_TO_ENGLISH_GROUP[x])
-        agribalyse_pd['subgroup'] = agribalyse_pd['subgroup'].apply(lambda x: FRENCH_TO_ENGLISH_SUB[x])
-        
-        agribalyse_pd.to_csv(output_file, index=False)
-        os.remove(temp_file)
-        print(f"Successfully saved {output_file}")
-        return True
-
-    except Exception as e:
-        print(f"Error processing Agribalyse data: {e}")
-        if temp_file.exists():
-            os.remove(temp_file)
-        return False
+    agribalyse_pd = pd.read_excel(xlsx_path, sheet_name="Detail etape", skiprows=3).dropna()[AGRIBALYSE_COLUMNS]
+    agribalyse_pd.columns = ['group', 'subgroup', 'product_name', 'dqr', 'agriculture', 'processing', 
+                            'packaging', 'transportation', 'retail', 'consumption', 'total']
+    
+    agribalyse_pd['group'] = agribalyse_pd['group'].apply(lambda x: FRENCH_TO_ENGLISH_GROUP[x])
+    agribalyse_pd['subgroup'] = agribalyse_pd['subgroup'].apply(lambda x: FRENCH_TO_ENGLISH_SUB[x])
+    
+    agribalyse_pd.to_csv(output_file, index=False)
 
-def download_bigclimate_data():
-    """Download and process BigClimateDB data."""
-    url = "https://denstoreklimadatabase.dk/files/media/document/Downloadversion%201.2_ENG.xlsx"
-    temp_file = DATA_DIR / 'bigclimatedb.xlsx'
-    output_file = DATA_DIR / 'bigclimatedb.csv'
+def process_bigclimate(xlsx_path, output_file):
+    """Combine the per-country sheets of the BigClimateDB workbook into bigclimatedb.csv."""
+    import pandas as pd
 
     SHEET_MAPPING = {
         "DK": "Denmark",
@@ -296,34 +517,149 @@ def download_bigclimate_data():
         "Retail"
     ]
 
+    # One pass over the workbook for all the sheets
+    sheets = pd.read_excel(xlsx_path, sheet_name=list(SHEET_MAPPING), usecols=COLUMNS_TO_KEEP)
+    df_list = []
+    for sheet, region in SHEET_MAPPING.items():
+        df = sheets[sheet]
+        df["region"] = region
+        df_list.append(df)
+
+    bigclimatedb = pd.concat(df_list, ignore_index=True)
+    bigclimatedb.to_csv(output_file, index=False)
+
+
+# Workbook sources: where they are downloaded from, how they are processed and
+# their catalog source and vector database index
+SOURCES = {
+    'agribalyse': {
+        'label': "Agribalyse",
+        'url': "https://entrepot.recherche.data.gouv.fr/api/access/datafile/:persistentId?persistentId=doi:10.57745/94BKZL",
+        'output': DATA_DIR / 'agribalyse_data.csv',
+        'process': process_agribalyse,
+        'index': 'Agribalyse',
+    },
+    'bigclimate': {
+        'label': "BigClimateDB",
+        'url': "https://denstoreklimadatabase.dk/files/media/document/Downloadversion%201.2_ENG.xlsx",
+        'output': DATA_DIR / 'bigclimatedb.csv',
+        'process': process_bigclimate,
+        'index': 'Big Climate Database',
+    },
+}
+# Validators and content hash of the last download of each source
+SOURCE_STATE_PATH = DATA_DIR / "sources.json"
+
+
+def load_source_state():
+    try:
+        return json.loads(SOURCE_STATE_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_source_state(name, entry):
+    state = load_source_state()
+    state[name] = entry
+    temp_path = SOURCE_STATE_PATH.with_suffix('.tmp')
+    temp_path.write_text(json.dumps(state, indent=2))
+    os.replace(temp_path, SOURCE_STATE_PATH)
+
+
+def refresh_source(name, url=None, force=False):
+    """Download a workbook source and rebuild its CSV only if it changed.
+
+    Sends the ETag and Last-Modified of the previous download, so an unchanged
+    file is usually answered with a 304 and not downloaded at all. A file that
+    is downloaded again but has the same SHA-256 is not processed again.
+    Returns 'not modified', 'unchanged', 'updated' or 'failed'."""
+    import requests
+
+    source = SOURCES[name]
+    url = url or source['url']
+    output_file = source['output']
+    temp_file = output_file.with_suffix('.xlsx')
+    temp_output = output_file.with_suffix('.csv.tmp')
+
+    previous = load_source_state().get(name, {})
+    if force or not output_file.exists() or previous.get('url') != url:
+        previous = {}
+    headers = {}
+    if previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+    if previous.get('last_modified'):
+        headers['If-Modified-Since'] = previous['last_modified']
+
     try:
-        print("Downloading BigClimateDB data...")
-        response = requests.get(url, stream=True)
+        print(f"Downloading {source['label']} data...")
+        response = requests.get(url, stream=True, headers=headers, timeout=REQUEST_TIMEOUT)
+        if response.status_code == 304:
+            print(f"{source['label']} not modified")
+            return 'not modified'
         response.raise_for_status()
 
+        digest = hashlib.sha256()
         with open(temp_file, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    file.write(chunk)
-
-        print("Processing BigClimateDB data...")
-        df_list = []
-        for sheet, region in SHEET_MAPPING.items():
-            df = pd.read_excel(temp_file, sheet_name=sheet, usecols=COLUMNS_TO_KEEP)
-            df["region"] = region
-            df_list.append(df)
-
-        bigclimatedb = pd.concat(df_list, ignore_index=True)
-        bigclimatedb.to_csv(output_file, index=False)
-        os.remove(temp_file)
-        print(f"Successfully saved {output_file}")
-        return True
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                digest.update(chunk)
+                file.write(chunk)
+
+        entry = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sha256': digest.hexdigest(),
+            'checked_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        }
+        if entry['sha256'] == previous.get('sha256'):
+            print(f"{source['label']} content unchanged")
+            status = 'unchanged'
+        else:
+            print(f"Processing {source['label']} data...")
+            source['process'](temp_file, temp_output)
+            os.replace(temp_output, output_file)
+            print(f"Successfully saved {output_file}")
+            status = 'updated'
+        save_source_state(name, entry)
+        return status
 
     except Exception as e:
-        print(f"Error processing BigClimateDB data: {e}")
-        if temp_file.exists():
-            os.remove(temp_file)
-        return False
+        print(f"Error processing {source['label']} data: {e}")
+        return 'failed'
+    finally:
+        for path in (temp_file, temp_output):
+            if path.exists():
+                os.remove(path)
+
+
+def refresh_sources(names=None, urls=None, force=False):
+    """Refresh workbook sources, then recompile the catalog and rebuild the vector database index of each updated one.
+
+    Running instances keep the data they loaded and pick up the refresh on restart."""
+    from catalog import build_catalog
+    from product_search import rebuild_indexes
+
+    ensure_directories()
+    urls = urls or {}
+    statuses = {name: refresh_source(name, urls.get(name), force) for name in (names or SOURCES)}
+
+    updated = [SOURCES[name]['index'] for name, status in statuses.items() if status == 'updated']
+    if updated:
+        catalog = build_catalog()
+        rebuild_indexes({source: catalog.product_names(source) for source in updated})
+
+    print("Refresh: " + ", ".join(f"{name} {status}" for name, status in statuses.items()))
+    return statuses
+
+
+def download_agribalyse_data():
+    """Download and process Agribalyse data."""
+    return refresh_source('agribalyse', force=True) != 'failed'
+
+
+def download_bigclimate_data():
+    """Download and process BigClimateDB data."""
+    return refresh_source('bigclimate', force=True) != 'failed'
 
 def process_data():
     """Process all required data sources."""
@@ -334,7 +670,8 @@ def process_data():
     if missing_bonsai_files:
         try:
             print(f"Downloading missing BONSAI files: {', '.join(missing_bonsai_files)}")
-            download_bonsai_data(missing_bonsai_files)
+            if not download_bonsai_data(missing_bonsai_files):
+                success = False
         except Exception as e:
             print(f"Error processing BONSAI data: {e}")
             success = False
@@ -348,3 +685,21 @@ def process_data():
             success = False
     
     return success
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Prepare and refresh the data sources.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    refresh = commands.add_parser('refresh', help="refresh the Agribalyse and BigClimateDB data if they changed")
+    refresh.add_argument('--source', choices=list(SOURCES), action='append', help="only this source (repeatable)")
+    refresh.add_argument('--url', action='append', default=[], metavar='SOURCE=URL',
+                         help="download a source from another URL, e.g. a local file server")
+    refresh.add_argument('--force', action='store_true', help="download and process even if unchanged")
+    args = parser.parse_args()
+
+    if args.command == 'refresh':
+        urls = dict(item.split('=', 1) for item in args.url)
+        statuses = refresh_sources(args.source, urls, args.force)
+        raise SystemExit(1 if 'failed' in statuses.values() else 0)
@@ -0,0 +1,156 @@
+import threading
+import time
+
+from data_preprocessing import process_data
+
+engine = None
+engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Load the data store, vector database, encoder and OpenAI client once per process.
+
+    Both the Gradio app and the HTTP API use the returned dict, so the data is
+    only held in memory once. Returns None if the data could not be prepared."""
+    global engine
+    with engine_lock:
+        if engine is None:
+            timings = {}
+            start = time.perf_counter()
+            if not process_data():
+                return None
+            timings['data check'] = time.perf_counter() - start
+
+            from catalog import get_catalog
+            from product_search import create_vector_database
+            from extraction import get_openai_client
+
+            start = time.perf_counter()
+            catalog = get_catalog()
+            catalog.impact_matrix()
+            timings['catalog'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            encoder, vector_database = create_vector_database(
+                lambda: {source: catalog.product_names(source) for source in catalog.sources}
+            )
+            timings['encoder and vector database'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            client = get_openai_client()
+            timings['OpenAI client'] = time.perf_counter() - start
+
+            engine = {
+                'client': client,
+                'encoder': encoder,
+                'vector_database': vector_database,
+            }
+            print("Startup: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items()))
+    return engine
+
+
+def extract(recipe):
+    """Extract the ingredients and their grams from a recipe text."""
+    from extraction import extract_ingredients, extract_prompt, functions
+    return extract_ingredients(extract_prompt, recipe, get_engine()['client'], functions)['ingredients']
+
+
+def search(queries, k=3):
+    """Top-k matches with similarities per source for each query, in one batched pass."""
+    from product_search import search_top_k_batch
+    engine = get_engine()
+    return search_top_k_batch(engine['encoder'], engine['vector_database'], queries, k)
+
+
+def suggest(ingredients_list, country):
+    """Product options and their availability per ingredient, as shown in the Product Selection tab."""
+    from data_handler import get_similar_items
+    from product_search import search_top_k
+    engine = get_engine()
+    return get_similar_items(search_top_k, ingredients_list, engine['encoder'], engine['vector_database'], country)
+
+
+def lookup(source, product, country):
+    """Per-kg records of one product."""
+    from data_handler import lookup_product
+    return lookup_product(source, product, country)
+
+
+def selections(ingredients):
+    """get_results' ingredient options and selections for a list of {'name', 'grams', 'products'} ingredients."""
+    unmatched = [ingredient['name'] for ingredient in ingredients if not ingredient.get('products')]
+    best_matches = dict(zip(unmatched, search(unmatched, k=1))) if unmatched else {}
+
+    ingredient_options = {}
+    selected_items = []
+    for n, ingredient in enumerate(ingredients):
+        products = ingredient.get('products') or [
+            (source, matches[0][0]) for source, matches in best_matches[ingredient['name']].items() if matches
+        ]
+        sources = {}
+        for source, product in products:
+            sources.setdefault(source, []).append(product)
+        # get_results pairs options and selections by position, so names must stay unique
+        name = ingredient['name'] if ingredient['name'] not in ingredient_options else f"{ingredient['name']} ({n+1})"
+        ingredient_options[name] = {'amount': ingredient['grams'], 'sources': sources}
+        selected_items.append([product for _, product in products])
+    return ingredient_options, selected_items
+
+
+def compare(ingredients, countries=None):
+    """Footprint of a list of ingredients in every country (or the given ones), ranked from the lowest."""
+    from data_handler import compare_countries
+    ingredient_options, selected_items = selections(ingredients)
+    return compare_countries(selected_items, ingredient_options, countries=countries)
+
+
+def supply_chain(product, flow_type, country, grams=1000, depth=None, cutoff=None):
+    """Upstream contribution analysis of a BONSAI product, None without a recipe for the country."""
+    from supply_chain import analyse_supply_chain, DEFAULT_DEPTH, DEFAULT_CUTOFF
+    return analyse_supply_chain(product, flow_type, country, grams,
+                                DEFAULT_DEPTH if depth is None else depth,
+                                DEFAULT_CUTOFF if cutoff is None else cutoff)
+
+
+def analyse(ingredients, country, narrative=False, user_message=None):
+    """Footprint of a list of {'name', 'grams', 'products'} ingredients.
+
+    `products` is a list of (source, product) pairs; when it is empty the best
+    match of every source is used. The LLM narrative is only requested when
+    `narrative` is set."""
+    from data_handler import get_results, get_substitutes, impact_range
+    from product_search import search_top_k_batch
+    from context_builder import build_context
+    from llm_loop import request_analysis
+
+    ingredient_options, selected_items = selections(ingredients)
+    search_query, _ = get_results(selected_items, ingredient_options, country)
+    context = build_context(search_query, country)
+
+    engine = get_engine()
+    result = {
+        'ingredients': [],
+        'context': context,
+        'substitutes': get_substitutes(search_top_k_batch, selected_items, ingredient_options,
+                                       engine['encoder'], engine['vector_database'], country),
+        'analysis': None,
+        'visualization': None,
+    }
+    for cur_ingredient in search_query:
+        result['ingredients'].append({
+            'name': cur_ingredient['query'],
+            'grams': cur_ingredient['grams'],
+            'records': cur_ingredient['records'],
+            'impact': impact_range(cur_ingredient['records'], cur_ingredient['grams']),
+        })
+
+    if narrative:
+        function_args = request_analysis(
+            engine['client'],
+            user_message or ", ".join(f"{ingredient['grams']}g {ingredient['name']}" for ingredient in ingredients),
+            context
+        )
+        result['analysis'] = function_args['answer_user']
+        result['visualization'] = function_args.get('visualization_data')
+
+    return result
@@ -1,6 +1,6 @@
-import openai
 import json
 import os
+from metrics import timed, record_usage
 
 extract_prompt = """Extract the ingredients and their quantities from the following user message.
 
@@ -48,6 +48,8 @@ functions = [
 
 
 def get_openai_client():
+    import openai
+
     key_path = 'openai_key.txt'
     if not os.path.exists(key_path):
         with open(key_path, 'w') as f:
@@ -58,6 +60,7 @@ def get_openai_client():
     return openai.OpenAI(api_key=openai.api_key)
 
 
+@timed("extraction")
 def extract_ingredients(extract_prompt, user_message, client, functions):
     cur_prompt = [{"role": "user", "content": extract_prompt.format(user_message=user_message)}]
 
@@ -68,6 +71,7 @@ def extract_ingredients(extract_prompt, user_message, client, functions):
         functions=functions,
         function_call={"name": "process_ingredients"}
     )
+    record_usage("extraction", response.usage)
 
     function_call = response.choices[0].message.function_call
     function_args = json.loads(function_call.arguments)
@@ -1,6 +1,12 @@
-import matplotlib.pyplot as plt
-import numpy as np
 import json
+import pickle
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from context_builder import count_message_tokens
+from chat_memory import create_memory, build_messages, add_turn, compact_memory
+from metrics import timed, record_usage, cache_requests, llm_first_token_seconds, stage_seconds, stage_errors
 
 
 process_impact_results = [
@@ -42,9 +48,14 @@ final_prompt = """You will receive two inputs:
 2. results_text: Impact data from databases
 
 DATA FORMAT OVERVIEW:
+results_text is a compact table. Each "## Ingredient (amount g)" heading is followed by one row per selected product:
+source|product|type|region|kg CO2-eq|notes
+- kg CO2-eq is already scaled to the ingredient amount.
+- A region starting with "avg of" means data averaged over other regions, not the target country.
 BONSAI: Shows market/production data with country shares. Use market total impact value.
 Agribalyse: French data with lifecycle stages. Use total impact value.
 BigClimate: Country-specific data with indirect land use. Use total impact value.
+If a heading only gives a range, use that range for the ingredient.
 
 CALCULATION RULES:
 1. Per ingredient:
@@ -118,6 +129,9 @@ Here is the information from our sources:
 
 
 
+CHART_DPI = 150
+CHART_CACHE_SIZE = 128
+
 
 def create_impact_plot(data):
     if not data or 'visualization_data' not in data:
@@ -129,6 +143,30 @@ def create_impact_plot(data):
     if not ingredients or not impacts or len(ingredients) != len(impacts):
         return None, None
 
+    hits = render_impact_charts.cache_info().hits
+    with timed("plotting"):
+        # Every request gets its own figures: Gradio encodes them on worker threads,
+        # and matplotlib figures must not be drawn by two threads at once
+        figures = pickle.loads(render_impact_charts(tuple(ingredients), tuple(impacts)))
+    cache_requests.inc(cache="charts", result="hit" if render_impact_charts.cache_info().hits > hits else "miss")
+    return figures
+
+
+@lru_cache(maxsize=CHART_CACHE_SIZE)
+def render_impact_charts(ingredients, impacts):
+    """The bar and pie charts pickled, cached on the (ingredients, impacts) data."""
+    return pickle.dumps(draw_impact_charts(ingredients, impacts))
+
+
+def draw_impact_charts(ingredients, impacts):
+    """Draw the bar and pie charts.
+
+    Figures are created without pyplot so nothing keeps them alive once they
+    are no longer referenced by a session."""
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib.figure import Figure
+
     total_impact = sum(impacts)
     pairs = list(zip(ingredients, impacts))
     pairs.sort(key=lambda x: x[1], reverse=True)
@@ -149,7 +187,8 @@ def create_impact_plot(data):
     
     ingredients_sorted, impacts_sorted = zip(*main_items)
     
-    fig_bar, ax_bar = plt.subplots(figsize=(5, 3), dpi=500)
+    fig_bar = Figure(figsize=(5, 3), dpi=CHART_DPI)
+    ax_bar = fig_bar.subplots()
     
     bars = ax_bar.barh(range(len(ingredients_sorted)), impacts_sorted, color='white')
     
@@ -179,9 +218,10 @@ def create_impact_plot(data):
     ax_bar.set_facecolor("#0f0f0f")
     fig_bar.patch.set_facecolor("#0f0f0f")
     ax_bar.set_axisbelow(True)
-    plt.tight_layout()
+    fig_bar.tight_layout()
 
-    fig_pie, ax_pie = plt.subplots(figsize=(5, 3), dpi=500)
+    fig_pie = Figure(figsize=(5, 3), dpi=CHART_DPI)
+    ax_pie = fig_pie.subplots()
 
     wedges, texts, autotexts = ax_pie.pie(
         impacts_sorted, 
@@ -259,7 +299,107 @@ def extract_visualization_data(answer_text):
 
 
 
-def initialize_chat(client, user_message, results_text):
+MAX_CHAT_TURNS = 50
+
+plot_executor = ThreadPoolExecutor(max_workers=2)
+
+
+def build_plots(function_args):
+    fig_bar, fig_pie = create_impact_plot(function_args)
+
+    if fig_bar is None or fig_pie is None:
+        extracted_data = extract_visualization_data(function_args.get('answer_user', ''))
+        if extracted_data:
+            fig_bar, fig_pie = create_impact_plot(extracted_data)
+        else:
+            fig_bar, fig_pie = None, None
+
+    return fig_bar, fig_pie
+
+
+def finalize_chat(results_text, function_args):
+    chat_history = [(None, function_args['answer_user'])]
+    memory = create_memory(results_text, function_args['answer_user'])
+
+    return chat_history, memory
+
+
+def stream_completion(client, label, **kwargs):
+    """Stream a chat completion, yielding (content, function_arguments) deltas and reporting timings."""
+    print(f"[{label}] prompt size: ~{count_message_tokens(kwargs['messages'])} tokens in {len(kwargs['messages'])} messages")
+    start_time = time.perf_counter()
+    first_token_time = None
+
+    try:
+        response = client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+        for chunk in response:
+            if chunk.usage:
+                print(f"[{label}] prompt tokens: {chunk.usage.prompt_tokens}, completion tokens: {chunk.usage.completion_tokens}")
+                record_usage(label, chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            content = delta.content or ""
+            arguments = (delta.function_call.arguments or "") if delta.function_call else ""
+            if not content and not arguments:
+                continue
+            if first_token_time is None:
+                first_token_time = time.perf_counter() - start_time
+                llm_first_token_seconds.observe(first_token_time, call=label)
+            yield content, arguments
+    except Exception:
+        stage_errors.inc(stage=label)
+        raise
+
+    total_time = time.perf_counter() - start_time
+    stage_seconds.observe(total_time, stage=label)
+    if first_token_time is None:
+        first_token_time = total_time
+    print(f"[{label}] time to first token: {first_token_time:.2f}s, total time: {total_time:.2f}s")
+
+
+def partial_string_value(arguments, key):
+    """Decode the (possibly unfinished) JSON string value of `key` from streamed function arguments."""
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), arguments)
+    if not match:
+        return None, False
+
+    start = match.end() - 1
+    i = match.end()
+    while i < len(arguments):
+        char = arguments[i]
+        if char == '\\':
+            step = 6 if arguments[i+1:i+2] == 'u' else 2
+            if i + step > len(arguments):
+                break
+            i += step
+            continue
+        if char == '"':
+            return json.loads(arguments[start:i+1], strict=False), True
+        i += 1
+
+    value = json.loads(arguments[start:i] + '"', strict=False)
+    # Drop a dangling high surrogate until its pair arrives
+    if value and '\ud800' <= value[-1] <= '\udbff':
+        value = value[:-1]
+    return value, False
+
+
+def partial_object_value(arguments, key):
+    """Decode the JSON object value of `key` once it has been fully streamed."""
+    match = re.search(r'"%s"\s*:\s*' % re.escape(key), arguments)
+    if not match:
+        return None
+    try:
+        value, _ = json.JSONDecoder().raw_decode(arguments, match.end())
+    except json.JSONDecodeError:
+        return None
+    return value
+
+
+@timed("initial_analysis")
+def request_analysis(client, user_message, results_text):
+    """Ask for the initial analysis and return the process_impact_results arguments."""
 
     cur_prompt = [{"role": "user", "content": final_prompt.format(user_message=user_message, results_text=results_text)}]
 
@@ -270,52 +410,113 @@ def initialize_chat(client, user_message, results_text):
         functions=process_impact_results,
         function_call={"name": "process_impact_results"}
     )
+    record_usage("initial_analysis", response.usage)
 
     function_call = response.choices[0].message.function_call
-    function_args = json.loads(function_call.arguments)
+    return json.loads(function_call.arguments)
 
-    fig_bar, fig_pie = create_impact_plot(function_args)
 
+def initialize_chat(client, user_message, results_text):
 
+    function_args = request_analysis(client, user_message, results_text)
+
+    fig_bar, fig_pie = build_plots(function_args)
+    chat_history, memory = finalize_chat(results_text, function_args)
+
+    return chat_history, memory, fig_bar, fig_pie
+
+
+def stream_initialize_chat(client, user_message, results_text):
+    """Generator version of initialize_chat yielding (chat_history, memory, fig_bar, fig_pie) as tokens arrive.
+
+    The answer text is pushed to the chat while the plots are rendered on a worker
+    thread as soon as the visualization data has been streamed."""
+
+    cur_prompt = [{"role": "user", "content": final_prompt.format(user_message=user_message, results_text=results_text)}]
+
+    arguments = ""
+    shown_answer = ""
+    plot_future = None
+
+    for _, delta in stream_completion(
+        client,
+        "initial_analysis",
+        model="gpt-4o-mini",
+        messages=cur_prompt,
+        temperature=1e-7,
+        functions=process_impact_results,
+        function_call={"name": "process_impact_results"}
+    ):
+        arguments += delta
+
+        if plot_future is None:
+            visualization_data = partial_object_value(arguments, 'visualization_data')
+            if visualization_data is not None:
+                plot_future = plot_executor.submit(create_impact_plot, {'visualization_data': visualization_data})
+
+        answer, _ = partial_string_value(arguments, 'answer_user')
+        if answer and answer != shown_answer:
+            shown_answer = answer
+            yield [(None, answer)], None, None, None
+
+    function_args = json.loads(arguments)
+
+    fig_bar, fig_pie = plot_future.result() if plot_future is not None else (None, None)
     if fig_bar is None or fig_pie is None:
-        extracted_data = extract_visualization_data(function_args['answer_user'])
-        if extracted_data:
-            fig_bar, fig_pie = create_impact_plot(extracted_data)
-        else:
-            fig_bar, fig_pie = None, None
+        fig_bar, fig_pie = build_plots(function_args)
 
-    initial_response = function_args['answer_user']
-    
-    chat_history = []
-    chat_history.append((None, initial_response))
-    
-    messages = []
-    messages.extend(cur_prompt)
-    messages.append({
-        "role": "assistant",
-        "content": json.dumps(function_args)
-    })
-    
-    return chat_history, messages, fig_bar, fig_pie
+    chat_history, memory = finalize_chat(results_text, function_args)
+    yield chat_history, memory, fig_bar, fig_pie
 
 
-def chat_response(client, user_input, chat_history, messages):
+@timed("chat_response")
+def chat_response(client, user_input, chat_history, memory):
 
-    if len(chat_history) >= 10:
-        limit_message = "I apologize, but you've reached the maximum limit of 10 messages."
+    if len(chat_history) >= MAX_CHAT_TURNS:
+        limit_message = f"I apologize, but you've reached the maximum limit of {MAX_CHAT_TURNS} messages."
         chat_history.append((user_input, limit_message))
-        messages.append({"role": "assistant", "content": limit_message})
-        return chat_history, messages
-
-    messages.append({"role": "user", "content": user_input})
+        return chat_history, memory
 
+    memory = memory or create_memory()
     response = client.chat.completions.create(
         model="gpt-4o-mini",
-        messages=messages,
+        messages=build_messages(memory, user_input),
     )
+    record_usage("chat_response", response.usage)
 
     assistant_response = response.choices[0].message.content
-    messages.append({"role": "assistant", "content": assistant_response})
+    add_turn(memory, user_input, assistant_response)
     chat_history.append((user_input, assistant_response))
+    compact_memory(client, memory)
     
-    return chat_history, messages
+    return chat_history, memory
+
+
+def stream_chat_response(client, user_input, chat_history, memory, compact=True):
+    """Generator version of chat_response yielding (chat_history, memory) as tokens arrive.
+
+    With compact=False the caller compacts the memory itself, e.g. after giving back its chat slot."""
+
+    if len(chat_history) >= MAX_CHAT_TURNS:
+        yield chat_response(client, user_input, chat_history, memory)
+        return
+
+    memory = memory or create_memory()
+    assistant_response = ""
+    for content, _ in stream_completion(
+        client,
+        "chat_response",
+        model="gpt-4o-mini",
+        messages=build_messages(memory, user_input),
+    ):
+        assistant_response += content
+        yield chat_history + [(user_input, assistant_response)], memory
+
+    add_turn(memory, user_input, assistant_response)
+    chat_history.append((user_input, assistant_response))
+    yield chat_history, memory
+
+    if compact:
+        # Summarise older turns after the answer is shown so it does not delay this reply
+        compact_memory(client, memory)
+        yield chat_history, memory
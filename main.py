@@ -1,42 +1,85 @@
+# gradio and pandas stay top-level imports: the module is the UI, and pandas is loaded by data_handler anyway
 import gradio as gr
 import pandas as pd
-from data_preprocessing import process_data
+from engine import get_engine
 import os
 
-if not process_data():
-    print("Error in data preprocessing. Exiting...")
-    exit(1)
+from catalog import get_catalog
+from data_handler import get_similar_items, update_analysis, get_substitutes, compare_countries, round_to_sig_figs
+from product_search import search_top_k, search_top_k_batch
+from extraction import extract_ingredients, extract_prompt, functions
+from llm_loop import stream_initialize_chat, stream_chat_response, create_impact_plot
+from chat_memory import refresh_memory, compact_memory
+from context_builder import build_context
+from prefetch import start_prefetch, prefetched_lookup
+from session_store import open_session, close_session, get_session, update_session, compact_options
+from metrics import tracked, stage_errors, metrics_route, sessions
+from memory_report import memory_route, register, gradio_state
+from profiling import profiled
+from admission import admit, QueueFull, queue_message, thread_budget, BUSY_MESSAGE
+import recorder
 
-from data_handler import agribalyse, bigclimatedata, activities, locations, get_similar_items, get_results
-from product_search import create_vector_database, search_top_k
-from extraction import get_openai_client, extract_ingredients, extract_prompt, functions
-from llm_loop import initialize_chat, chat_response
+MAX_INGREDIENTS = 30
+SESSION_EXPIRED = "Your session has expired, please submit your recipe again."
 
-client = get_openai_client()
 
-encoder, vector_database = create_vector_database(
-    activities,
-    agribalyse,
-    bigclimatedata
-)
+def admitted(stage, trace, waiting_update):
+    """Take a slot of a stage for a handler, yielding waiting_update(message) while it is queued.
 
-MAX_INGREDIENTS = 30
+    Use as `admission = yield from admitted(...)` and release the admission in a finally block.
+    Raises QueueFull when the stage is saturated."""
+    admission = admit(stage)
+    try:
+        with recorder.stage(trace, 'queue'):
+            for position in admission.wait():
+                yield waiting_update(queue_message(position))
+    except BaseException:
+        admission.release()
+        raise
+    return admission
+
+
+@profiled("process_recipe")
+def process_recipe(recipe_input, target_country, session_id):
+    session_id = session_id or open_session()
+    trace = recorder.start('recipe', session_id, recipe=recipe_input, country=target_country)
+
+    def status_update(message):
+        return (gr.update(), gr.update(value=message), session_id, gr.update(),
+                *[gr.update() for _ in range(MAX_INGREDIENTS)])
+
+    try:
+        admission = yield from admitted('extraction', trace, status_update)
+    except QueueFull:
+        yield status_update(BUSY_MESSAGE)
+        return
+    try:
+        with tracked("process_recipe"):
+            yield extract_recipe(recipe_input, target_country, session_id, trace)
+    finally:
+        admission.release()
 
 
-def process_recipe(recipe_input, target_country):
+def extract_recipe(recipe_input, target_country, session_id, trace):
+    engine = get_engine()
     try:
-        ingredients_list = extract_ingredients(
-            extract_prompt,
-            recipe_input,
-            client,
-            functions
-        )['ingredients']
+        with recorder.stage(trace, 'extraction'):
+            ingredients_list = extract_ingredients(
+                extract_prompt,
+                recipe_input,
+                recorder.recording_client(engine['client'], trace),
+                functions
+            )['ingredients']
         df = pd.DataFrame(ingredients_list)
         df.columns = ['Ingredient', 'Amount (grams)']
         df['Ingredient'] = df['Ingredient'].str.capitalize()
 
-        ing_opts = get_similar_items(search_top_k, ingredients_list, encoder, vector_database, target_country)
+        with recorder.stage(trace, 'similar_items'):
+            ing_opts = get_similar_items(search_top_k, ingredients_list, engine['encoder'], engine['vector_database'], target_country)
+        prefetch_id = start_prefetch(ing_opts, target_country)
+        update_session(session_id, options=compact_options(ing_opts), prefetch_id=prefetch_id, analysis=None)
         checkbox_updates = []
+        offered = []
         for ingredient, data in ing_opts.items():
             choices = []
             for opt in sorted(set([opt.capitalize() for opt in data['options']])):
@@ -45,6 +88,7 @@ def process_recipe(recipe_input, target_country):
                     choices.append(opt)
                 else:
                     choices.append(f"{opt} *")  # Mark with asterisk if no country-specific data
+            offered.append(choices)
             
             checkbox_updates.append(
                 gr.update(
@@ -59,30 +103,65 @@ def process_recipe(recipe_input, target_country):
 
         # Add explanation for asterisk
         status_message = "✅ Ingredients successfully extracted!"
+        recorder.finish(trace, ingredients=ingredients_list, options=offered)
         
         return (
             df,
             gr.update(value=status_message),
-            ing_opts,
+            session_id,
             True,
             *checkbox_updates
         )
     
     except Exception as e:
+        stage_errors.inc(stage="process_recipe")
+        recorder.finish(trace, error=type(e).__name__)
+        update_session(session_id, options={}, prefetch_id=None, analysis=None)
         empty_updates = [gr.update(visible=False) for _ in range(MAX_INGREDIENTS)]
         return (
             pd.DataFrame(columns=['Ingredient', 'Amount (grams)']),
             gr.update(value=str(e)),
-            {},
+            session_id,
             False,
             *empty_updates
         )
     
 
+def impact_charts(analysis):
+    """Bar and pie charts of the per-ingredient average impacts of a session's analysis."""
+    impacts = [(name.capitalize(), entry['impact'][2]) for name, entry in analysis['ingredients'].items()
+               if entry['impact'] is not None and entry['impact'][2] > 0]
+    if not impacts:
+        return None, None
+    return create_impact_plot({'visualization_data': {'ingredients': [name for name, _ in impacts],
+                                                      'impacts': [impact for _, impact in impacts]}})
+
+
+def what_if_message(analysis, changed, previous_total):
+    total = analysis['total']
+    change = total[2] - previous_total[2]
+    lines = [f"Updated selection for {', '.join(name.capitalize() for name in changed)}:"]
+    for name in changed:
+        impact = analysis['ingredients'][name]['impact']
+        value = f"{round_to_sig_figs(impact[0])}-{round_to_sig_figs(impact[1])} kg CO2-eq" if impact else "no data"
+        lines.append(f"- {name.capitalize()}: {value}")
+    lines.append(f"Total recipe impact (excluding cooking): {round_to_sig_figs(total[0])}-{round_to_sig_figs(total[1])} kg CO2-eq, "
+                 f"average {round_to_sig_figs(total[2])} kg CO2-eq ({'+' if change >= 0 else ''}{round_to_sig_figs(change)} kg)")
+    lines.append("The analysis above still describes the earlier selection, use \"Regenerate Analysis\" to update it.")
+    return "\n".join(lines)
+
+
+@profiled("process_form")
 def process_form(*inputs):
-    selections = inputs[:-2]
-    ing_opts = inputs[-2]
+    selections = inputs[:-3]
+    session_id = inputs[-3]
+    chat = inputs[-2] or []
     country = inputs[-1]
+    session = get_session(session_id)
+    ing_opts = session.get('options')
+    prefetch_id = session.get('prefetch_id')
+    analysis = session.get('analysis')
+    memory = session.get('memory')
 
     selected_items = []
     for s in selections:
@@ -92,27 +171,218 @@ def process_form(*inputs):
             selected_items.append(s)
       
     if not any(selected_items):
-        return None, None, None
+        yield None, None, None
+        return
+    if not ing_opts:
+        yield chat + [(None, SESSION_EXPIRED)], None, None
+        return
     
+    trace = recorder.start('selection', session_id, country=country, selections=selected_items)
     try:
-        search_query, results_text = get_results(selected_items, ing_opts, country)
-        if not results_text:
-            return None, None, None
-        
-        chat_history, messages, fig_bar, fig_pie = initialize_chat(client, search_query[0]['query'], results_text)
-        return chat_history, messages, fig_bar, fig_pie
+        admission = yield from admitted('analysis', trace, lambda message: (chat + [(None, message)], gr.update(), gr.update()))
+    except QueueFull:
+        yield chat + [(None, BUSY_MESSAGE)], gr.update(), gr.update()
+        return
+    try:
+        with tracked("process_form"):
+            # A resubmission of the same recipe only recomputes the ingredients whose selection changed
+            what_if = analysis is not None and analysis.get('prefetch_id') == prefetch_id and analysis.get('answer')
+            if not what_if:
+                analysis = {'prefetch_id': prefetch_id}
+            previous_total = list(analysis.get('total', [0.0, 0.0, 0.0]))
+            with recorder.stage(trace, 'update_analysis'):
+                changed = update_analysis(analysis, selected_items, ing_opts, country,
+                                          lookup=prefetched_lookup(prefetch_id, country))
+            with recorder.stage(trace, 'context'):
+                search_query = [analysis['ingredients'][ingredient]['result'] for ingredient in ing_opts]
+                context = build_context(search_query, country)
+            analysis['country'] = country
+            analysis['context'] = context
+            results = {
+                'what_if': bool(what_if), 'changed': changed, 'total': analysis['total'],
+                'impacts': [analysis['ingredients'][ingredient]['impact'] for ingredient in ing_opts],
+                'context': recorder.context_digest(context),
+            }
+
+            if what_if:
+                if not changed:
+                    recorder.finish(trace, **results)
+                    yield chat, gr.update(), gr.update()
+                    return
+                # Charts and totals follow the data right away, the narrative only on request
+                with recorder.stage(trace, 'charts'):
+                    fig_bar, fig_pie = impact_charts(analysis)
+                message = what_if_message(analysis, changed, previous_total)
+                memory = refresh_memory(memory, context, f"{analysis['answer']}\n\n{message}")
+                update_session(session_id, analysis=analysis, memory=memory)
+                recorder.first_output(trace)
+                recorder.finish(trace, **results)
+                yield chat + [(None, message)], fig_bar, fig_pie
+                return
+
+            update_session(session_id, analysis=analysis)
+            chat_update = None
+            client = recorder.recording_client(get_engine()['client'], trace)
+            with recorder.stage(trace, 'analysis'):
+                for chat_update in stream_initialize_chat(client, search_query[0]['query'], context):
+                    recorder.first_output(trace)
+                    yield chat_update[0], chat_update[2], chat_update[3]
+            if chat_update is not None and chat_update[1] is not None:
+                analysis['answer'] = chat_update[0][0][1]
+                analysis['query'] = search_query[0]['query']
+                update_session(session_id, analysis=analysis, memory=chat_update[1])
+            recorder.finish(trace, **results)
     
     except Exception as e:
-        return None, None, None, None
+        stage_errors.inc(stage="process_form")
+        recorder.finish(trace, error=type(e).__name__)
+        yield None, None, None
+    finally:
+        admission.release()
+
+
+@profiled("regenerate_analysis")
+def regenerate_analysis(session_id, chat=None):
+    """Ask for a new LLM analysis of the session's current selection."""
+    analysis = get_session(session_id).get('analysis')
+    if not analysis or 'query' not in analysis:
+        yield gr.update(), gr.update(), gr.update()
+        return
+    chat = chat or []
+    try:
+        admission = yield from admitted('analysis', None, lambda message: (chat + [(None, message)], gr.update(), gr.update()))
+    except QueueFull:
+        yield chat + [(None, BUSY_MESSAGE)], gr.update(), gr.update()
+        return
+    try:
+        with tracked("regenerate_analysis"):
+            chat_update = None
+            for chat_update in stream_initialize_chat(get_engine()['client'], analysis['query'], analysis['context']):
+                yield chat_update[0], chat_update[2], chat_update[3]
+            if chat_update is not None and chat_update[1] is not None:
+                analysis['answer'] = chat_update[0][0][1]
+                update_session(session_id, analysis=analysis, memory=chat_update[1])
+    except Exception:
+        stage_errors.inc(stage="regenerate_analysis")
+        yield gr.update(), gr.update(), gr.update()
+    finally:
+        admission.release()
+
+
+def suggest_substitutes(*inputs):
+    """List similar products with a lower footprint in the target country, per ingredient."""
+    selections = [s or [] for s in inputs[:-2]]
+    ing_opts = get_session(inputs[-2]).get('options')
+    country = inputs[-1]
+    if not any(selections) or not ing_opts:
+        yield ""
+        return
+
+    try:
+        admission = yield from admitted('lookup', None, lambda message: message)
+    except QueueFull:
+        yield BUSY_MESSAGE
+        return
+    engine = get_engine()
+    try:
+        with tracked("substitutes"):
+            substitutes = get_substitutes(search_top_k_batch, selections, ing_opts, engine['encoder'], engine['vector_database'], country)
+    except Exception:
+        stage_errors.inc(stage="substitutes")
+        yield ""
+        return
+    finally:
+        admission.release()
+    if not substitutes:
+        yield "No lower-impact alternatives found for the selected products."
+        return
+
+    lines = ["### Lower-impact swaps", "*An asterisk (\\*) marks data from other countries.*", ""]
+    for ingredient, data in substitutes.items():
+        swaps = ", ".join(
+            f"{swap['product']}{' *' if swap['estimated'] else ''} ({swap['source']}, "
+            f"saves {round_to_sig_figs(swap['saving_kg'])} kg CO2-eq)"
+            for swap in data['swaps']
+        )
+        lines.append(f"- **{ingredient.capitalize()}** ({data['grams']}g): {swaps}")
+    yield "\n".join(lines)
+
+
+COMPARISON_COLUMNS = ['Rank', 'Country', 'kg CO2-eq', 'Range', 'No data', 'Estimated from other regions']
+
+
+def compare_all_countries(*inputs):
+    """Rank every country by the footprint of the selected products."""
+    selections = [s or [] for s in inputs[:-2]]
+    ing_opts = get_session(inputs[-2]).get('options')
+    country = inputs[-1]
+    if not any(selections) or not ing_opts:
+        yield pd.DataFrame(columns=COMPARISON_COLUMNS), ""
+        return
+
+    try:
+        admission = yield from admitted('lookup', None, lambda message: (gr.update(), message))
+    except QueueFull:
+        yield pd.DataFrame(columns=COMPARISON_COLUMNS), BUSY_MESSAGE
+        return
+    try:
+        with tracked("compare_countries"):
+            ranking = compare_countries(selections, ing_opts)
+    finally:
+        admission.release()
+
+    rows = []
+    for rank, row in enumerate(ranking, start=1):
+        has_data = row['average_kg'] is not None
+        rows.append([
+            rank,
+            f"{row['country']} (selected)" if row['country'] == country else row['country'],
+            round_to_sig_figs(row['average_kg']) if has_data else None,
+            f"{round_to_sig_figs(row['min_kg'])} - {round_to_sig_figs(row['max_kg'])}" if has_data else "",
+            ", ".join(row['missing']),
+            ", ".join(row['estimated']),
+        ])
+    yield pd.DataFrame(rows, columns=COMPARISON_COLUMNS), ""
+
+
+def respond(chat_history, session_id):
+    memory = get_session(session_id).get('memory')
+    message = chat_history[-1][0]
+    try:
+        admission = yield from admitted('chat', None, lambda status: chat_history[:-1] + [(message, status)])
+    except QueueFull:
+        yield chat_history[:-1] + [(message, BUSY_MESSAGE)]
+        return
+    client = get_engine()['client']
+    memory_update = memory
+    try:
+        with tracked("chat"):
+            for history_update, memory_update in stream_chat_response(client, message, chat_history[:-1], memory, compact=False):
+                yield history_update
+    finally:
+        admission.release()
+    # The answer is shown, summarising older turns does not need to hold a chat slot
+    update_session(session_id, memory=compact_memory(client, memory_update))
+
+
+def start_session(request: gr.Request):
+    sessions.inc()
+    return open_session(request.session_hash)
+
+
+def end_session(request: gr.Request):
+    sessions.dec()
+    close_session(request.session_hash)
     
 
 def create_interface():
     with gr.Blocks() as app:
         gr.Markdown("# The Carbon Footprint Wizard 🌱")
+        # The session's options, analysis and chat memory are kept in session_store
+        session_state = gr.State(None)
 
         with gr.Tabs() as tabs:
             with gr.Tab("Recipe Input"):
-                ingredient_options_state = gr.State({})
                 gr.Markdown("### 1) Enter Your Recipe")
                 with gr.Row():
                     with gr.Column(scale=6):
@@ -121,7 +391,7 @@ def create_interface():
                             placeholder="Example: Could you estimate the environmental impact of my veggie pizza? Ingredients: 200g of pizza dough, a tablespoon of tomato paste...",
                             lines=5
                         )
-                        countries = sorted(list(set(locations['name'].unique())))
+                        countries = get_catalog().countries()
                         target_country = gr.Dropdown(
                             choices=countries,
                             label="Select Target Country",
@@ -156,11 +426,16 @@ def create_interface():
                 submit_selections = gr.Button("Select Products", visible=False, variant="primary")
 
             with gr.Tab("Chat with Assistant", id="chat"):
-                messages_state = gr.State([])
                 gr.Markdown("### 3) Carbon Footprint Analysis")
                 with gr.Row():
                     impact_plot_bar = gr.Plot(container=False)
                     impact_plot_pie = gr.Plot(container=False)
+                substitutes_md = gr.Markdown()
+                regenerate_btn = gr.Button("Regenerate Analysis", size="sm")
+                with gr.Accordion("Compare all countries", open=False):
+                    compare_btn = gr.Button("Compare All Countries")
+                    comparison_status = gr.Markdown()
+                    comparison_df = gr.Dataframe(headers=COMPARISON_COLUMNS, interactive=False, wrap=True)
                 chat_history = gr.Chatbot(label="Chat with our Assistant",height=1000)
                 with gr.Row():
                     msg = gr.Textbox(placeholder="Your Message",
@@ -176,11 +451,11 @@ def create_interface():
 
         submit_btn.click(
             fn=process_recipe,
-            inputs=[recipe_input, target_country],
+            inputs=[recipe_input, target_country, session_state],
             outputs=[
                 ingredients_df,
                 status_md,
-                ingredient_options_state,
+                session_state,
                 product_selection_visible,
                 *checkbox_groups
             ]
@@ -200,19 +475,36 @@ def create_interface():
             outputs=[tabs]
         ).then(
             fn=process_form,
-            inputs=[*checkbox_groups, ingredient_options_state, target_country],
-            outputs=[chat_history, messages_state, impact_plot_bar, impact_plot_pie]
+            inputs=[*checkbox_groups, session_state, chat_history, target_country],
+            outputs=[chat_history, impact_plot_bar, impact_plot_pie]
+        )
+
+        regenerate_btn.click(
+            fn=regenerate_analysis,
+            inputs=[session_state, chat_history],
+            outputs=[chat_history, impact_plot_bar, impact_plot_pie]
+        )
+
+        submit_selections.click(
+            fn=suggest_substitutes,
+            inputs=[*checkbox_groups, session_state, target_country],
+            outputs=[substitutes_md]
         )
 
+        compare_btn.click(
+            fn=compare_all_countries,
+            inputs=[*checkbox_groups, session_state, target_country],
+            outputs=[comparison_df, comparison_status]
+        )
 
         submit_msg.click(
             fn=lambda message, history: (history + [(message, None)], ""),
             inputs=[msg, chat_history],
             outputs=[chat_history, msg]
         ).then(
-            fn=lambda chat_history, messages: chat_response(client, chat_history[-1][0], chat_history[:-1], messages),
-            inputs=[chat_history, messages_state],
-            outputs=[chat_history, messages_state]
+            fn=respond,
+            inputs=[chat_history, session_state],
+            outputs=[chat_history]
         )
 
         msg.submit(
@@ -220,16 +512,30 @@ def create_interface():
             inputs=[msg, chat_history],
             outputs=[chat_history, msg]
         ).then(
-            fn=lambda chat_history, messages: chat_response(client, chat_history[-1][0], chat_history[:-1], messages),
-            inputs=[chat_history, messages_state],
-            outputs=[chat_history, messages_state]
+            fn=respond,
+            inputs=[chat_history, session_state],
+            outputs=[chat_history]
         )
+
+        app.load(fn=start_session, outputs=[session_state])
+        app.unload(fn=end_session)
+
+    # Concurrency is limited per stage by admission.py, not per event by Gradio. The
+    # thread budget is set here too so it also applies when api.py mounts the UI
+    app.queue(default_concurrency_limit=None)
+    app.max_threads = thread_budget()
+
+    register("gradio session state", lambda: gradio_state(app))
         
     return app
 
 if __name__ == "__main__":
+    if get_engine() is None:
+        print("Error in data preprocessing. Exiting...")
+        exit(1)
+
     demo = create_interface()
-    demo.launch()
+    demo.launch(max_threads=thread_budget(), app_kwargs={"routes": [metrics_route(), memory_route()]})
 
     """
     demo.launch(
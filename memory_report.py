@@ -0,0 +1,413 @@
+"""Memory accounting of a running instance: what holds the memory, and what grows.
+
+The report splits the resident memory of the process over its components: the
+pandas tables and code dicts, the catalog, the FAISS indexes, the encoder
+weights, the supply-chain graph, the prefetches, the semantic cache, the session
+store, the Gradio session state and the live matplotlib figures. Sizes are deep: everything a
+component references is counted once, pandas tables with memory_usage(deep=True),
+numpy arrays by the data they own, FAISS indexes by their codes and torch models
+by their parameters. The rest of the RSS is reported as unaccounted.
+
+With CFW_TRACEMALLOC=<frames> set, tracemalloc traces allocations from startup and
+the report adds the top allocation sites. Reports (and tracemalloc snapshots) can
+be saved under a name and diffed later to find what grew:
+
+    python memory_report.py --url http://localhost:7860 --save before
+    python memory_report.py --url http://localhost:7860 --since before
+    python memory_report.py --diff before after
+
+With --url, the report is taken from the /diagnostics/memory route of the running
+instance and saved or diffed here. The route is off unless CFW_MEMORY_DIAGNOSTICS=1
+is set, and then only answers clients on the same host, one at a time: every
+report runs a full garbage collection and walks all the state.
+"""
+import gc
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+MEMORY_DIR = Path(os.environ.get("CFW_MEMORY_DIR", "memory_snapshots"))
+TOP_ALLOCATIONS = 20
+# Growth under this is left out of diffs
+MIN_GROWTH = 64 * 1024
+LOCAL_CLIENTS = ('127.0.0.1', '::1', 'localhost')
+
+report_lock = threading.Lock()
+
+# Components registered by the app on top of the built-in ones: name -> function
+# returning (objects to size, detail), or None when there is nothing to report
+components = {}
+
+if os.environ.get("CFW_TRACEMALLOC") and not tracemalloc.is_tracing():
+    tracemalloc.start(int(os.environ["CFW_TRACEMALLOC"]) if os.environ["CFW_TRACEMALLOC"].isdigit() else 1)
+
+
+def register(name, getter):
+    """Report the objects returned by getter as a component."""
+    components[name] = getter
+
+
+def rss_bytes():
+    """Current resident set size of the process (peak RSS where /proc is unavailable)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def special_size(obj):
+    """Size of the objects whose memory is not in Python objects, None for the others."""
+    module = type(obj).__module__ or ""
+    if module.startswith('pandas') and hasattr(obj, 'memory_usage'):
+        usage = obj.memory_usage(deep=True)
+        return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+    if module == 'numpy' or module.startswith('numpy.'):
+        if hasattr(obj, 'nbytes'):
+            # Views and memory-mapped arrays do not own their data
+            return sys.getsizeof(obj) if getattr(obj, 'base', None) is not None else obj.nbytes + sys.getsizeof(obj)
+    if module.startswith('faiss') and hasattr(obj, 'ntotal'):
+        code_size = getattr(obj, 'code_size', None) or obj.d * 4
+        return int(obj.ntotal) * int(code_size)
+    if hasattr(obj, 'parameters') and hasattr(obj, 'buffers') and module.startswith(('torch', 'sentence_transformers')):
+        tensors = list(obj.parameters()) + list(obj.buffers())
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+    return None
+
+
+def deep_sizeof(obj, seen=None):
+    """Bytes held by obj and everything it references, counting shared objects once in `seen`."""
+    seen = set() if seen is None else seen
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, type(sys), type(deep_sizeof))):
+            continue
+        seen.add(id(obj))
+        special = special_size(obj)
+        if special is not None:
+            size += special
+            continue
+        size += sys.getsizeof(obj, 0)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__') and not isinstance(obj, type):
+            stack.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if isinstance(slot, str) and hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+    return size
+
+
+def live_figures():
+    """Matplotlib figures still alive, without importing matplotlib if nothing did."""
+    figure_module = sys.modules.get('matplotlib.figure')
+    if figure_module is None:
+        return []
+    gc.collect()
+    return [obj for obj in gc.get_objects() if isinstance(obj, figure_module.Figure)]
+
+
+def builtin_components():
+    """The components of the modules loaded in this process, as name -> (objects, detail)."""
+    found = {}
+    data_handler = sys.modules.get('data_handler')
+    if data_handler is not None and data_handler.tables is not None:
+        tables = data_handler.tables
+        found['pandas tables'] = (
+            [tables[name] for name in data_handler.TABLE_NAMES[:6]],
+            ", ".join(f"{name} {len(tables[name])} rows" for name in data_handler.TABLE_NAMES[:6]),
+        )
+        found['activity_dict and region_dict'] = (
+            [tables['activity_dict'], tables['region_dict']],
+            f"{len(tables['activity_dict'])} activities, {len(tables['region_dict'])} regions",
+        )
+
+    catalog_module = sys.modules.get('catalog')
+    if catalog_module is not None and catalog_module.catalog is not None:
+        catalog = catalog_module.catalog
+        mapped = len(catalog.mapping) if catalog.mapping is not None else 0
+        found['catalog'] = ([catalog], f"{mapped / 2**20:.1f} MB file mapped, resident as it is read")
+
+    engine_module = sys.modules.get('engine')
+    engine = engine_module.engine if engine_module is not None else None
+    if engine is not None:
+        vector_database = engine['vector_database']
+        found['FAISS indexes'] = (
+            [vector_database],
+            ", ".join(f"{name} {data['index'].ntotal} vectors" for name, data in vector_database.items()),
+        )
+        found['encoder weights'] = ([engine['encoder']], type(engine['encoder']).__name__)
+
+    supply_chain = sys.modules.get('supply_chain')
+    if supply_chain is not None and supply_chain.graph is not None:
+        graph = supply_chain.graph
+        found['supply-chain graph'] = ([graph], f"{len(graph['nodes'])} nodes, {len(graph['memo'])} memoised results")
+
+    prefetch = sys.modules.get('prefetch')
+    if prefetch is not None:
+        found['prefetches'] = ([prefetch.prefetches], f"{len(prefetch.prefetches)} sessions")
+
+    semantic_cache = sys.modules.get('semantic_cache')
+    if semantic_cache is not None:
+        found['semantic cache'] = ([semantic_cache.indexes, semantic_cache.entries], f"{len(semantic_cache.entries)} queries")
+
+    session_store = sys.modules.get('session_store')
+    if session_store is not None:
+        found['session store'] = ([session_store.sessions], f"{len(session_store.sessions)} sessions")
+
+    figures = live_figures()
+    if figures:
+        llm_loop = sys.modules.get('llm_loop')
+        cached = llm_loop.render_impact_charts.cache_info().currsize if llm_loop is not None else 0
+        found['matplotlib figures'] = (figures, f"{len(figures)} live, {cached} chart pairs cached pickled")
+    return found
+
+
+def gradio_state(app):
+    """The gr.State values of the open sessions of a Gradio app, as a component."""
+    session_data = getattr(getattr(app, 'state_holder', None), 'session_data', None)
+    if session_data is None:
+        return None
+    states = [getattr(session, '_data', None) for session in list(session_data.values())]
+    return states, f"{len(states)} sessions"
+
+
+def tracemalloc_top(snapshot, top=TOP_ALLOCATIONS):
+    current, peak = tracemalloc.get_traced_memory()
+    stats = snapshot.statistics('lineno')[:top]
+    return {
+        'current': current,
+        'peak': peak,
+        'top': [{'site': str(stat.traceback[0]), 'bytes': stat.size, 'count': stat.count} for stat in stats],
+    }
+
+
+def memory_report(top=TOP_ALLOCATIONS, snapshot=None):
+    """Per-component breakdown of the process memory.
+
+    Components are sized in a fixed order with one `seen` set, so an object shared
+    by two components is counted in the first. `snapshot` receives the tracemalloc
+    snapshot when tracing."""
+    start = time.perf_counter()
+    found = builtin_components()
+    for name, getter in components.items():
+        component = getter()
+        if component is not None:
+            found[name] = component
+
+    seen = set()
+    rows = []
+    for name, (objects, detail) in found.items():
+        rows.append({'name': name, 'bytes': deep_sizeof(objects, seen), 'detail': detail})
+    rss = rss_bytes()
+    accounted = sum(row['bytes'] for row in rows)
+    report = {
+        'time': time.time(),
+        'pid': os.getpid(),
+        'rss': rss,
+        'components': rows,
+        'accounted': accounted,
+        'unaccounted': rss - accounted,
+        'tracemalloc': None,
+    }
+    if tracemalloc.is_tracing():
+        traced = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        report['tracemalloc'] = tracemalloc_top(traced, top)
+        if snapshot is not None:
+            snapshot.append(traced)
+    report['seconds'] = time.perf_counter() - start
+    return report
+
+
+def snapshot_path(name, suffix):
+    if not re.fullmatch(r"[\w.-]+", name):
+        raise ValueError(f"Invalid snapshot name: {name!r}")
+    return MEMORY_DIR / f"{name}{suffix}"
+
+
+def save_report(name, report, traced=None):
+    """Write a report, and its tracemalloc snapshot if any, under a name."""
+    MEMORY_DIR.mkdir(parents=True, exist_ok=True)
+    with open(snapshot_path(name, ".json"), 'w') as f:
+        json.dump(report, f)
+    if traced is not None:
+        traced.dump(str(snapshot_path(name, ".tracemalloc")))
+
+
+def load_report(name):
+    with open(snapshot_path(name, ".json")) as f:
+        return json.load(f)
+
+
+def load_snapshot(name):
+    """The tracemalloc snapshot saved with a report, None if it was not traced."""
+    path = snapshot_path(name, ".tracemalloc")
+    return tracemalloc.Snapshot.load(str(path)) if path.exists() else None
+
+
+def diff_reports(old, new, old_traced=None, new_traced=None, top=TOP_ALLOCATIONS):
+    """Growth per component and in RSS between two reports, plus the allocation sites
+    that grew most when both have a tracemalloc snapshot."""
+    old_sizes = {row['name']: row['bytes'] for row in old['components']}
+    new_sizes = {row['name']: row['bytes'] for row in new['components']}
+    changes = [
+        {'name': name, 'before': old_sizes.get(name, 0), 'after': new_sizes.get(name, 0),
+         'growth': new_sizes.get(name, 0) - old_sizes.get(name, 0)}
+        for name in list(new_sizes) + [name for name in old_sizes if name not in new_sizes]
+    ]
+    diff = {
+        'seconds': new['time'] - old['time'],
+        'rss_growth': new['rss'] - old['rss'],
+        'unaccounted_growth': new['unaccounted'] - old['unaccounted'],
+        'components': sorted(changes, key=lambda change: -abs(change['growth'])),
+        'allocations': None,
+    }
+    if old_traced is not None and new_traced is not None:
+        stats = new_traced.compare_to(old_traced, 'lineno')
+        diff['allocations'] = [
+            {'site': str(stat.traceback[0]), 'growth': stat.size_diff, 'count_growth': stat.count_diff}
+            for stat in stats[:top] if abs(stat.size_diff) >= MIN_GROWTH
+        ]
+    elif old.get('tracemalloc') and new.get('tracemalloc'):
+        # Reports fetched with --url have no snapshot, only their top sites can be compared
+        old_sites = {site['site']: site for site in old['tracemalloc']['top']}
+        changes = [
+            {'site': site['site'], 'growth': site['bytes'] - old_sites.get(site['site'], {}).get('bytes', 0),
+             'count_growth': site['count'] - old_sites.get(site['site'], {}).get('count', 0)}
+            for site in new['tracemalloc']['top']
+        ]
+        diff['allocations'] = sorted([change for change in changes if abs(change['growth']) >= MIN_GROWTH],
+                                     key=lambda change: -abs(change['growth']))[:top]
+    return diff
+
+
+def diagnostics(save=None, since=None, top=TOP_ALLOCATIONS):
+    """The report, saved under `save` and diffed against the report saved as `since` when given."""
+    traced = []
+    report = memory_report(top, snapshot=traced)
+    result = {'report': report}
+    if save:
+        save_report(save, report, traced[0] if traced else None)
+        result['saved'] = save
+    if since:
+        result['diff'] = diff_reports(load_report(since), report, load_snapshot(since),
+                                      traced[0] if traced else None, top)
+    return result
+
+
+def mb(size):
+    return f"{size / 2**20:9.1f} MB"
+
+
+def format_report(report):
+    lines = [f"RSS {mb(report['rss']).strip()} (pid {report['pid']}, measured in {report['seconds']:.2f}s)", ""]
+    for row in sorted(report['components'], key=lambda row: -row['bytes']):
+        lines.append(f"{mb(row['bytes'])}  {row['name']}" + (f" ({row['detail']})" if row['detail'] else ""))
+    lines.append(f"{mb(report['unaccounted'])}  unaccounted (interpreter, libraries, allocator, untouched mappings)")
+    traced = report.get('tracemalloc')
+    if traced:
+        lines += ["", f"tracemalloc: {mb(traced['current']).strip()} traced, peak {mb(traced['peak']).strip()}"]
+        lines += [f"{mb(site['bytes'])}  {site['count']:8d} blocks  {site['site']}" for site in traced['top']]
+    return "\n".join(lines)
+
+
+def format_diff(diff):
+    lines = [f"Over {diff['seconds']:.0f}s: RSS {diff['rss_growth'] / 2**20:+.1f} MB, "
+             f"unaccounted {diff['unaccounted_growth'] / 2**20:+.1f} MB", ""]
+    for change in diff['components']:
+        lines.append(f"{change['growth'] / 2**20:+9.1f} MB  {change['name']} "
+                     f"({change['before'] / 2**20:.1f} -> {change['after'] / 2**20:.1f} MB)")
+    if diff['allocations']:
+        lines += ["", "Allocation sites that grew most:"]
+        lines += [f"{site['growth'] / 2**20:+9.1f} MB  {site['count_growth']:+8d} blocks  {site['site']}"
+                  for site in diff['allocations']]
+    return "\n".join(lines)
+
+
+def memory_route(path="/diagnostics/memory"):
+    """Starlette route serving memory_report() as JSON, for the Gradio app and the HTTP API.
+
+    Off unless CFW_MEMORY_DIAGNOSTICS=1, local clients only, one report at a time.
+    Nothing is written to disk: saving and diffing are done by the CLI."""
+    from starlette.concurrency import run_in_threadpool
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+
+    def report(top):
+        if not report_lock.acquire(blocking=False):
+            return None
+        try:
+            return memory_report(top)
+        finally:
+            report_lock.release()
+
+    async def endpoint(request):
+        if os.environ.get("CFW_MEMORY_DIAGNOSTICS", "") not in ('1', 'true', 'yes'):
+            return JSONResponse({'detail': "Not Found"}, status_code=404)
+        if request.client is None or request.client.host not in LOCAL_CLIENTS:
+            return JSONResponse({'detail': "Memory diagnostics are only served to local clients"}, status_code=403)
+        try:
+            top = min(int(request.query_params.get('top', TOP_ALLOCATIONS)), 200)
+        except ValueError as e:
+            return JSONResponse({'detail': str(e)}, status_code=400)
+        result = await run_in_threadpool(report, top)
+        if result is None:
+            return JSONResponse({'detail': "A memory report is already running"}, status_code=429)
+        return JSONResponse({'report': result})
+
+    return Route(path, endpoint)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Memory report of a running instance, or of a fresh one.")
+    parser.add_argument('--url', help="base URL of a running app or API; loads the data in this process if unset")
+    parser.add_argument('--save', help="save the report under this name")
+    parser.add_argument('--since', help="diff against the report saved under this name")
+    parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'), help="diff two saved reports and exit")
+    parser.add_argument('--top', type=int, default=TOP_ALLOCATIONS)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    if args.diff:
+        old, new = args.diff
+        result = {'diff': diff_reports(load_report(old), load_report(new), load_snapshot(old), load_snapshot(new),
+                                       args.top)}
+    elif args.url:
+        import urllib.request
+        with urllib.request.urlopen(f"{args.url.rstrip('/')}/diagnostics/memory?top={args.top}") as response:
+            report = json.load(response)['report']
+        result = {'report': report}
+        if args.save:
+            save_report(args.save, report)
+            result['saved'] = args.save
+        if args.since:
+            result['diff'] = diff_reports(load_report(args.since), report, top=args.top)
+    else:
+        from engine import get_engine
+        from data_handler import get_tables
+        if get_engine() is None:
+            sys.exit("Error in data preprocessing")
+        get_tables()
+        result = diagnostics(args.save, args.since, args.top)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        if 'report' in result:
+            print(format_report(result['report']))
+        if 'diff' in result:
+            print(("\n" if 'report' in result else "") + format_diff(result['diff']))
@@ -0,0 +1,187 @@
+import threading
+import time
+from contextlib import ContextDecorator
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labelnames)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (f'{name}="{escape(value)}"' for name, value in pairs)
+        return "{" + ",".join(escaped) + "}"
+
+    def samples(self):
+        with self.lock:
+            return [(f"{self.name}{self.format_labels(key)}", value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{sample} {value:g}" for sample, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][n] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket{self.format_labels(key, [('le', f'{bound:g}')])}", bucket_count))
+                samples.append((f"{self.name}_bucket{self.format_labels(key, [('le', '+Inf')])}", count))
+                samples.append((f"{self.name}_sum{self.format_labels(key)}", total))
+                samples.append((f"{self.name}_count{self.format_labels(key)}", count))
+        return samples
+
+
+stage_seconds = Histogram("cfw_stage_seconds", "Time spent per pipeline stage", ["stage"])
+stage_errors = Counter("cfw_stage_errors_total", "Exceptions raised per pipeline stage", ["stage"])
+cache_requests = Counter("cfw_cache_requests_total", "Cache lookups by cache and result", ["cache", "result"])
+llm_tokens = Counter("cfw_llm_tokens_total", "LLM tokens used by call and kind", ["call", "kind"])
+llm_first_token_seconds = Histogram("cfw_llm_first_token_seconds", "Time to the first streamed LLM token", ["call"])
+inflight = Gauge("cfw_inflight_requests", "Requests currently being processed by handler", ["handler"])
+sessions = Gauge("cfw_sessions", "Open Gradio sessions")
+session_store_entries = Gauge("cfw_session_store_entries", "Sessions held in the server-side session store")
+session_store_bytes = Gauge("cfw_session_store_bytes", "Approximate deep size of the server-side session store")
+session_store_evictions = Counter("cfw_session_store_evictions_total", "Sessions evicted from the store by reason", ["reason"])
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 16000)
+context_tokens = Histogram("cfw_context_tokens", "Estimated tokens of the data context sent to the LLM",
+                           buckets=TOKEN_BUCKETS)
+context_detail_levels = Counter("cfw_context_detail_levels_total", "Data contexts by detail level (0 is the most detailed)",
+                                ["level"])
+chat_memory_compactions = Counter("cfw_chat_memory_compactions_total", "Chat memory compactions by trigger", ["trigger"])
+chat_memory_folded_turns = Counter("cfw_chat_memory_folded_turns_total", "User/assistant pairs folded into chat summaries")
+chat_memory_tokens = Histogram("cfw_chat_memory_tokens", "Estimated request size of the chat memory after compaction",
+                               buckets=TOKEN_BUCKETS)
+admission_active = Gauge("cfw_admission_active", "Gradio requests running per stage", ["stage"])
+admission_queue_depth = Gauge("cfw_admission_queue_depth", "Gradio requests waiting for a slot per stage", ["stage"])
+admission_wait_seconds = Histogram("cfw_admission_wait_seconds", "Time Gradio requests waited for a slot", ["stage"])
+admission_rejections = Counter("cfw_admission_rejections_total", "Gradio requests rejected by stage and reason", ["stage", "reason"])
+semantic_cache_similarity = Histogram("cfw_semantic_cache_similarity", "Similarity of similar-items queries to the nearest cached query",
+                                      buckets=(0.5, 0.7, 0.8, 0.85, 0.9, 0.925, 0.95, 0.975, 0.99, 1.0))
+http_requests = Counter("cfw_http_requests_total", "HTTP API requests by path and status", ["path", "status"])
+
+
+class timed(ContextDecorator):
+    """Record the duration of a stage, and count it as an error if it raises.
+
+    Works as a decorator and as a `with` block."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = None
+
+    def _recreate_cm(self):
+        # A fresh instance per decorated call, so concurrent calls do not share the start time
+        return timed(self.stage)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        stage_seconds.observe(time.perf_counter() - self.start, stage=self.stage)
+        if exc_type is not None:
+            stage_errors.inc(stage=self.stage)
+        return False
+
+
+class tracked(ContextDecorator):
+    """Count a handler as in flight while the block runs."""
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __enter__(self):
+        inflight.inc(handler=self.handler)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        inflight.dec(handler=self.handler)
+        return False
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+def metrics_route(path="/metrics"):
+    """Starlette route serving render(), for the Gradio app and the HTTP API."""
+    from starlette.responses import PlainTextResponse
+    from starlette.routing import Route
+
+    def endpoint(request):
+        return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+    return Route(path, endpoint)
+
+
+def record_usage(call, usage):
+    """Count the tokens reported by an OpenAI response."""
+    if usage is None:
+        return
+    llm_tokens.inc(usage.prompt_tokens, call=call, kind="prompt")
+    llm_tokens.inc(usage.completion_tokens, call=call, kind="completion")
@@ -0,0 +1,63 @@
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+from data_handler import lookup_product
+from metrics import cache_requests
+
+PREFETCH_WORKERS = 4
+MAX_PREFETCH_SESSIONS = 256
+
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+prefetches = OrderedDict()
+prefetch_lock = threading.Lock()
+
+
+def start_prefetch(ingredient_options, country):
+    """Look up every suggested option in the background while the user picks products.
+
+    The per-kg records are independent of the amounts, so the submit step only
+    has to scale and format them. Returns the id under which they are stored."""
+    futures = {}
+    for data in ingredient_options.values():
+        for source, items in data['sources'].items():
+            for item in items:
+                if (source, item) not in futures:
+                    futures[(source, item)] = prefetch_executor.submit(lookup_product, source, item, country)
+
+    prefetch_id = uuid.uuid4().hex
+    with prefetch_lock:
+        prefetches[prefetch_id] = {'country': country, 'futures': futures}
+        while len(prefetches) > MAX_PREFETCH_SESSIONS:
+            _, evicted = prefetches.popitem(last=False)
+            for future in evicted['futures'].values():
+                future.cancel()
+    return prefetch_id
+
+
+def prefetched_lookup(prefetch_id, country):
+    """Return a lookup_product replacement that serves prefetched records when available."""
+    with prefetch_lock:
+        prefetch = prefetches.get(prefetch_id)
+        if prefetch is not None:
+            prefetches.move_to_end(prefetch_id)
+
+    if prefetch is None or prefetch['country'] != country:
+        cache_requests.inc(cache="prefetch", result="expired")
+        return lookup_product
+
+    def lookup(source, product_name, country):
+        future = prefetch['futures'].get((source, product_name))
+        if future is not None:
+            try:
+                # The prefetch can be evicted, and its queued lookups cancelled, while this waits
+                records = future.result()
+                cache_requests.inc(cache="prefetch", result="hit")
+                return records
+            except CancelledError:
+                pass
+        cache_requests.inc(cache="prefetch", result="miss")
+        return lookup_product(source, product_name, country)
+
+    return lookup
@@ -1,10 +1,16 @@
-from sentence_transformers import SentenceTransformer
+import os
 import pickle
-import faiss
 from pathlib import Path
+from metrics import timed
 
+VECTOR_DB_PATH = Path("vector_database.pkl")
+
+@timed("startup_encoder")
 def initialize_encoder():
     """Initialize or download the sentence transformer model."""
+    # Imported here because sentence_transformers pulls in torch, which dominates import time
+    from sentence_transformers import SentenceTransformer
+
     model_path = Path("encoder_model")
     
     if not model_path.exists():
@@ -18,54 +24,81 @@ def initialize_encoder():
     
     return encoder
 
-def create_vector_database(activities, agribalyse, bigclimatedata, update=False):
-    """Create or load vector database for product searching."""
-    vector_db_path = Path("vector_database.pkl")
-    
-    if update or not vector_db_path.exists():
-        print("Creating new vector database...")
-        bonsai_names = activities['description'].dropna().unique()
-        agribalyse_names = agribalyse['product_name'].dropna().unique()
-        bigclimatedata_names = bigclimatedata['Name'].dropna().unique()
+def build_index(encoder, products):
+    """Inner-product FAISS index over the normalized embeddings of the product names."""
+    import faiss
+
+    product_embeddings = encoder.encode(products)
+    faiss.normalize_L2(product_embeddings)
+    dimension = product_embeddings.shape[1]
+    index = faiss.IndexFlatIP(dimension)
+    index.add(product_embeddings)
+    return index
 
+def save_vector_database(vector_database):
+    temp_path = VECTOR_DB_PATH.with_suffix('.tmp')
+    with open(temp_path, 'wb') as file:
+        pickle.dump(vector_database, file)
+    os.replace(temp_path, VECTOR_DB_PATH)
+
+def rebuild_indexes(products_by_source):
+    """Re-embed only the given sources in the saved vector database, keeping the other indexes."""
+    if not VECTOR_DB_PATH.exists():
+        print("No vector database yet, it is created on the next start")
+        return
+    with open(VECTOR_DB_PATH, 'rb') as file:
+        vector_database = pickle.load(file)
+    encoder = initialize_encoder()
+    for name, products in products_by_source.items():
+        print(f"Rebuilding the {name} index ({len(products)} products)...")
+        vector_database[name] = {'index': build_index(encoder, products), 'products': products}
+    save_vector_database(vector_database)
+    print("Vector database updated")
+
+def create_vector_database(product_names, update=False):
+    """Create or load vector database for product searching.
+
+    product_names returns the product names of every source as {source: names}. It
+    is only called when the database has to be created."""
+    if update or not VECTOR_DB_PATH.exists():
+        print("Creating new vector database...")
         encoder = initialize_encoder()
 
         vector_database = {
-            'BONSAI': {'index': None, 'products': bonsai_names},
-            'Agribalyse': {'index': None, 'products': agribalyse_names},
-            'Big Climate Database': {'index': None, 'products': bigclimatedata_names}
+            source: {'index': None, 'products': names}
+            for source, names in product_names().items()
         }
 
         for name, data in vector_database.items():
             print(f"Processing {name} products...")
-            products = data['products']
-            product_embeddings = encoder.encode(products)
-            faiss.normalize_L2(product_embeddings)
-            dimension = product_embeddings.shape[1]
-            index = faiss.IndexFlatIP(dimension)
-            index.add(product_embeddings)
-            vector_database[name]['index'] = index
-
-        with open(vector_db_path, 'wb') as file:
-            pickle.dump(vector_database, file)
+            vector_database[name]['index'] = build_index(encoder, data['products'])
+
+        save_vector_database(vector_database)
         print("Vector database created and saved successfully")
     else:
         print("Loading existing vector database...")
         encoder = initialize_encoder()
-        with open(vector_db_path, 'rb') as file:
+        with timed("startup_vector_database"), open(VECTOR_DB_PATH, 'rb') as file:
             vector_database = pickle.load(file)
 
     return encoder, vector_database
 
-def search_top_k(encoder, vector_database, query, k=5, similarity=False, verbose=False):
-    """Search for similar products in the vector database."""
-    query_embedding = encoder.encode([query])
-    faiss.normalize_L2(query_embedding)
+def search_top_k(encoder, vector_database, query, k=5, similarity=False, verbose=False, query_embedding=None):
+    """Search for similar products in the vector database.
+
+    query_embedding is the normalized embedding of the query, as a 1 x d array, when it is already known."""
+    import faiss
+
+    if query_embedding is None:
+        with timed("encoding"):
+            query_embedding = encoder.encode([query])
+            faiss.normalize_L2(query_embedding)
     
     results = {}
     
     for name, data in vector_database.items():
-        distances, idx = data['index'].search(query_embedding, k)
+        with timed("faiss_search"):
+            distances, idx = data['index'].search(query_embedding, k)
         if similarity:
             results[name] = [(data['products'][j], distances[0][n]) for n, j in enumerate(idx[0])]
         else:
@@ -78,4 +111,23 @@ def search_top_k(encoder, vector_database, query, k=5, similarity=False, verbose
             for product, similarity in matches:
                 print(f"- {product} (Similarity: {similarity:.4f})")
         
-    return results
\ No newline at end of file
+    return results
+
+def search_top_k_batch(encoder, vector_database, queries, k=5):
+    """Search several queries with one encoder pass and one FAISS search per source.
+
+    Returns one {source: [(product, similarity), ...]} dict per query."""
+    import faiss
+
+    with timed("encoding"):
+        query_embeddings = encoder.encode(list(queries))
+        faiss.normalize_L2(query_embeddings)
+
+    results = [{} for _ in queries]
+    for name, data in vector_database.items():
+        with timed("faiss_search"):
+            distances, idx = data['index'].search(query_embeddings, k)
+        for n in range(len(queries)):
+            results[n][name] = [(data['products'][j], float(distances[n][m])) for m, j in enumerate(idx[n]) if j >= 0]
+
+    return results
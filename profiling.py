@@ -0,0 +1,178 @@
+import cProfile
+import functools
+import hmac
+import inspect
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+
+PROFILE_MODES = ('cprofile', 'sample')
+PROFILE_DIR = Path(os.environ.get("CFW_PROFILE_DIR", "profiles"))
+# Writing a mode into this file turns profiling on for the following requests without a restart
+PROFILE_TRIGGER = PROFILE_DIR / "enable"
+SAMPLE_INTERVAL = 0.005
+TOP_FUNCTIONS = 30
+
+
+def profile_mode(requested=None):
+    """The profiler to use for a request: the requested one, else CFW_PROFILE, else the trigger file."""
+    mode = requested or os.environ.get("CFW_PROFILE", "")
+    if not mode and PROFILE_TRIGGER.exists():
+        mode = PROFILE_TRIGGER.read_text().strip() or 'cprofile'
+    if mode.lower() in ('1', 'true', 'yes'):
+        mode = 'cprofile'
+    return mode if mode in PROFILE_MODES else None
+
+
+def header_mode(mode, token):
+    """The profiler a request asks for in its headers, honoured only with the shared CFW_PROFILE_TOKEN.
+
+    Without the token set, requests cannot turn profiling on, so anonymous callers
+    cannot make the server write profiles."""
+    expected = os.environ.get("CFW_PROFILE_TOKEN", "")
+    if not mode or not expected or not hmac.compare_digest((token or "").encode(), expected.encode()):
+        return None
+    return mode
+
+
+class SamplingProfiler:
+    """Samples the stack of the profiled thread at a fixed interval and keeps collapsed stacks.
+
+    The profiled thread can change between enable() calls, as when Gradio resumes
+    a generator handler on another worker thread."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.thread_id = None
+        self.running = True
+        self.sampler = threading.Thread(target=self.run, daemon=True, name="sampling-profiler")
+        self.sampler.start()
+
+    def run(self):
+        while self.running:
+            thread_id = self.thread_id
+            frame = sys._current_frames().get(thread_id) if thread_id is not None else None
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{Path(code.co_filename).name}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def enable(self):
+        self.thread_id = threading.get_ident()
+
+    def disable(self):
+        self.thread_id = None
+
+    def stop(self):
+        self.running = False
+        self.sampler.join()
+
+    def summary(self):
+        self_samples = Counter()
+        total_samples = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            self_samples[frames[-1]] += count
+            for frame in set(frames):
+                total_samples[frame] += count
+        samples = sum(self.stacks.values())
+        lines = [f"{samples} samples every {self.interval * 1000:g} ms", "", "self%   total%  function"]
+        for frame, count in self_samples.most_common(TOP_FUNCTIONS):
+            lines.append(f"{count / samples * 100:5.1f}  {total_samples[frame] / samples * 100:6.1f}  {frame}")
+        return "\n".join(lines) + "\n"
+
+
+class RequestProfile:
+    """Profile of one request, written to PROFILE_DIR when finished."""
+
+    def __init__(self, name, mode):
+        self.name = name
+        self.mode = mode
+        self.profiler = cProfile.Profile() if mode == 'cprofile' else SamplingProfiler()
+
+    def enable(self):
+        self.profiler.enable()
+
+    def disable(self):
+        self.profiler.disable()
+
+    def write(self):
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        stem = PROFILE_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{self.name}-{uuid.uuid4().hex[:8]}"
+
+        if self.mode == 'cprofile':
+            self.profiler.dump_stats(f"{stem}.pstats")
+            summary = io.StringIO()
+            pstats.Stats(self.profiler, stream=summary).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+            summary = summary.getvalue()
+        else:
+            self.profiler.stop()
+            with open(f"{stem}.collapsed", 'w') as f:
+                for stack, count in self.profiler.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            summary = self.profiler.summary()
+
+        with open(f"{stem}.txt", 'w') as f:
+            f.write(summary)
+        print(f"[profile] {self.name} profile written to {stem}.*")
+
+
+def run_profiled(name, mode, fn, *args, **kwargs):
+    """Call fn, profiled with the given mode (see profile_mode) if profiling is on."""
+    mode = profile_mode(mode)
+    if mode is None:
+        return fn(*args, **kwargs)
+    profile = RequestProfile(name, mode)
+    profile.enable()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        profile.disable()
+        profile.write()
+
+
+def iterate_profiled(name, mode, generator):
+    """Iterate a generator, profiling only the time spent inside it and not in the consumer."""
+    mode = profile_mode(mode)
+    if mode is None:
+        yield from generator
+        return
+    profile = RequestProfile(name, mode)
+    try:
+        while True:
+            profile.enable()
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            finally:
+                profile.disable()
+            yield item
+    finally:
+        profile.write()
+
+
+def profiled(name):
+    """Decorator profiling a Gradio handler when profiling is on. Keeps generator handlers generators."""
+    def decorator(fn):
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                yield from iterate_profiled(name, None, fn(*args, **kwargs))
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                return run_profiled(name, None, fn, *args, **kwargs)
+        return wrapper
+    return decorator
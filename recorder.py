@@ -0,0 +1,168 @@
+"""Opt-in recording of the Gradio pipeline requests, for replaying real traffic offline.
+
+With CFW_RECORD=<path> set, every recipe submission and product selection is
+appended to a JSONL trace: the sanitised recipe text, the country, the extracted
+ingredients, the options offered, the selections, the resulting impacts, the
+LLM outputs and the stage timings. Emails, URLs and long digit sequences are
+masked in the recipe, the ingredients, the selections and the LLM outputs (only
+in the string values of function-call arguments, which stay valid JSON), the
+recipe text is truncated and session ids are hashed. Chat messages are
+not recorded. benchmarks/replay.py drives the pipeline from a trace with the LLM
+outputs served from it:
+
+    CFW_RECORD=traces/requests.jsonl python main.py
+    python -m benchmarks.replay traces/requests.jsonl
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+MAX_TEXT = 4000
+SANITIZE_PATTERNS = [
+    (re.compile(r"[\w.+-]+@[\w-]+(\.[\w-]+)+"), "<email>"),
+    (re.compile(r"https?://\S+|www\.\S+"), "<url>"),
+    # Phone, card and account numbers; quantities are much shorter and end with a unit
+    (re.compile(r"\+?\d(?:[\s().-]?\d){7,}(?!\w)"), "<number>"),
+]
+
+trace_lock = threading.Lock()
+
+
+def trace_path():
+    """Where to record, None when recording is off. Read per request so it can be set at runtime."""
+    path = os.environ.get("CFW_RECORD", "")
+    return Path(path) if path else None
+
+
+def sanitize(text, limit=MAX_TEXT):
+    if text is None:
+        return None
+    for pattern, replacement in SANITIZE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text[:limit] if limit else text
+
+
+def sanitize_values(value):
+    """Sanitise every string in nested lists and dicts, leaving the structure and other values as they are."""
+    if isinstance(value, str):
+        return sanitize(value, None)
+    if isinstance(value, dict):
+        return {key: sanitize_values(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [sanitize_values(item) for item in value]
+    return value
+
+
+def sanitize_arguments(arguments):
+    """Sanitise the string values of function-call arguments, which have to stay valid JSON to be replayed.
+
+    Numbers are left as they are, an LLM float such as 333.333333 is not a phone number."""
+    if arguments is None:
+        return None
+    try:
+        parsed = json.loads(arguments)
+    except ValueError:
+        # Not replayable anyway, mask it as text
+        return sanitize(arguments, None)
+    return json.dumps(sanitize_values(parsed), ensure_ascii=False)
+
+
+def session_key(session_id):
+    return hashlib.sha256(str(session_id).encode()).hexdigest()[:12] if session_id else None
+
+
+def start(event, session_id, **fields):
+    """A new trace record, or None when recording is off."""
+    if trace_path() is None:
+        return None
+    if 'selections' in fields:
+        fields['selections'] = sanitize_values(fields['selections'])
+    return {'event': event, 'time': time.time(), 'session': session_key(session_id), **fields,
+            'llm': [], 'stages': {}, 'started': time.perf_counter()}
+
+
+@contextmanager
+def stage(trace, name):
+    """Add the time spent in the block to a stage of the trace."""
+    if trace is None:
+        yield
+        return
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace['stages'][name] = trace['stages'].get(name, 0.0) + time.perf_counter() - start_time
+
+
+def first_output(trace):
+    """Note the time of the first output shown to the user."""
+    if trace is not None and 'first_output_seconds' not in trace:
+        trace['first_output_seconds'] = time.perf_counter() - trace['started']
+
+
+def finish(trace, **fields):
+    """Complete a trace record and append it to the trace file."""
+    if trace is None:
+        return
+    trace.update(fields)
+    trace['seconds'] = time.perf_counter() - trace.pop('started')
+    if 'recipe' in trace:
+        trace['recipe'] = sanitize(trace['recipe'])
+    if 'ingredients' in trace:
+        trace['ingredients'] = sanitize_values(trace['ingredients'])
+    path = trace_path()
+    if path is None:
+        return
+    line = json.dumps(trace, default=float)
+    with trace_lock:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(line + "\n")
+
+
+class RecordingClient:
+    """OpenAI client wrapper that keeps the output of every chat completion in a trace."""
+
+    def __init__(self, client, trace):
+        self.client = client
+        self.trace = trace
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def record(self, content, arguments, start_time):
+        # Not truncated, the function arguments have to stay valid JSON to be replayed
+        self.trace['llm'].append({'content': sanitize(content, None), 'arguments': sanitize_arguments(arguments),
+                                  'seconds': time.perf_counter() - start_time})
+
+    def create(self, **kwargs):
+        start_time = time.perf_counter()
+        response = self.client.chat.completions.create(**kwargs)
+        if kwargs.get('stream'):
+            return self.stream(response, start_time)
+        message = response.choices[0].message
+        self.record(message.content, message.function_call.arguments if message.function_call else None, start_time)
+        return response
+
+    def stream(self, response, start_time):
+        content, arguments = [], []
+        for chunk in response:
+            if chunk.choices:
+                delta = chunk.choices[0].delta
+                content.append(delta.content or "")
+                arguments.append((delta.function_call.arguments or "") if delta.function_call else "")
+            yield chunk
+        self.record("".join(content) or None, "".join(arguments) or None, start_time)
+
+
+def recording_client(client, trace):
+    """The client to use for a request: recording its outputs when the request is recorded."""
+    return client if trace is None else RecordingClient(client, trace)
+
+
+def context_digest(context):
+    return hashlib.sha256(context.encode()).hexdigest()[:16] if context is not None else None
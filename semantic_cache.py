@@ -0,0 +1,88 @@
+"""Result cache of get_similar_items keyed by query embedding.
+
+Queries such as "red onion", "red onions" and "onion, red" have nearly the same
+embedding, and so the same product options. Recent queries are kept in a small
+FAISS inner-product index per country. A query whose nearest cached query is at
+least SIMILARITY_THRESHOLD similar reuses its options and availability instead
+of searching the three indexes and checking the availability of every option.
+
+The cache is set with CFW_SEMANTIC_CACHE_THRESHOLD (cosine similarity, default
+0.95) and CFW_SEMANTIC_CACHE_SIZE (queries kept over all countries, default
+2048, 0 turns it off). The data is read once per process, so entries never go
+stale; restart after refreshing the data as for the rest of the app.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import cache_requests, semantic_cache_similarity, timed
+
+SIMILARITY_THRESHOLD = float(os.environ.get("CFW_SEMANTIC_CACHE_THRESHOLD", 0.95))
+MAX_ENTRIES = int(os.environ.get("CFW_SEMANTIC_CACHE_SIZE", 2048))
+# A query's similarity to itself can come out just under 1.0 in float32
+TOLERANCE = 1e-5
+
+indexes = {}
+entries = OrderedDict()
+next_id = 0
+cache_lock = threading.Lock()
+
+
+def embed(encoder, queries):
+    """Normalized embeddings of the queries, in one encoder pass."""
+    import faiss
+
+    with timed("encoding"):
+        embeddings = np.ascontiguousarray(encoder.encode(list(queries)), dtype=np.float32)
+        faiss.normalize_L2(embeddings)
+    return embeddings
+
+
+def lookup(embedding, country, threshold=None):
+    """The cached result of the nearest query for the country, None below the threshold."""
+    threshold = SIMILARITY_THRESHOLD if threshold is None else threshold
+    if MAX_ENTRIES <= 0:
+        return None
+    with cache_lock:
+        index = indexes.get(country)
+        if index is None or index.ntotal == 0:
+            cache_requests.inc(cache="similar_items", result="miss")
+            return None
+        similarities, ids = index.search(embedding.reshape(1, -1), 1)
+        similarity, entry_id = float(similarities[0][0]), int(ids[0][0])
+        semantic_cache_similarity.observe(similarity)
+        if entry_id < 0 or similarity < threshold - TOLERANCE:
+            cache_requests.inc(cache="similar_items", result="miss")
+            return None
+        entries.move_to_end(entry_id)
+        cache_requests.inc(cache="similar_items", result="hit")
+        return entries[entry_id]['result']
+
+
+def store(embedding, country, query, result):
+    """Cache a query's result, evicting the least recently used queries over MAX_ENTRIES."""
+    global next_id
+    import faiss
+
+    if MAX_ENTRIES <= 0:
+        return
+    with cache_lock:
+        index = indexes.get(country)
+        if index is None:
+            index = indexes[country] = faiss.IndexIDMap2(faiss.IndexFlatIP(embedding.shape[-1]))
+        index.add_with_ids(embedding.reshape(1, -1), np.array([next_id], dtype=np.int64))
+        entries[next_id] = {'country': country, 'query': query, 'result': result}
+        next_id += 1
+        while len(entries) > MAX_ENTRIES:
+            entry_id, entry = entries.popitem(last=False)
+            indexes[entry['country']].remove_ids(np.array([entry_id], dtype=np.int64))
+
+
+def clear():
+    global next_id
+    with cache_lock:
+        indexes.clear()
+        entries.clear()
+        next_id = 0
@@ -0,0 +1,125 @@
+"""Pre-fork multi-worker server for the HTTP API.
+
+The parent process loads the data, encoder and FAISS indexes once, freezes the
+garbage collector and forks the workers, so the read-only data is shared
+copy-on-write instead of being loaded again by every worker.
+
+    python serve.py --workers 4
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+from api import API_HOST, API_PORT, KEEP_ALIVE_SECONDS, create_app
+
+BACKLOG = 2048
+# A worker that exits sooner than this after its start failed to start. It is
+# restarted after a doubling delay, and the server gives up after MAX_FAST_FAILURES in a row
+MIN_WORKER_UPTIME = 10
+RESTART_BACKOFF = 0.5
+MAX_RESTART_BACKOFF = 30
+MAX_FAST_FAILURES = 5
+
+
+def run_worker(app, sock):
+    # Each worker serves requests on its own, extra intra-op threads would only compete
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(1)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    config = uvicorn.Config(app, timeout_keep_alive=KEEP_ALIVE_SECONDS, log_level="warning")
+    uvicorn.Server(config).run(sockets=[sock])
+    os._exit(0)
+
+
+def spawn_worker(app, sock):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(app, sock)
+        finally:
+            # A worker that failed must not go on running the parent's loop
+            os._exit(1)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--host', default=API_HOST)
+    parser.add_argument('--port', type=int, default=API_PORT)
+    args = parser.parse_args()
+
+    # The Gradio UI keeps its sessions in process memory, so it is not mounted in multi-worker mode
+    app = create_app(with_ui=False)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(BACKLOG)
+    sock.set_inheritable(True)
+
+    # Move everything loaded so far out of the collector's reach, so collections
+    # in the workers do not write to (and thereby copy) the shared pages
+    gc.collect()
+    gc.freeze()
+
+    workers = {spawn_worker(app, sock): time.monotonic() for _ in range(args.workers)}
+    print(f"Serving on http://{args.host}:{args.port} with {len(workers)} workers (parent pid {os.getpid()})")
+
+    stopping = False
+    fast_failures = 0
+    exit_code = 0
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = workers.pop(pid, None)
+        if stopping or started is None:
+            continue
+        if time.monotonic() - started < MIN_WORKER_UPTIME:
+            fast_failures += 1
+        else:
+            fast_failures = 0
+        if fast_failures >= MAX_FAST_FAILURES:
+            print(f"Worker {pid} exited with status {status}, {fast_failures} workers in a row "
+                  f"failed within {MIN_WORKER_UPTIME}s of starting, stopping")
+            stop(None, None)
+            exit_code = 1
+            continue
+        delay = min(RESTART_BACKOFF * 2 ** (fast_failures - 1), MAX_RESTART_BACKOFF) if fast_failures else 0
+        print(f"Worker {pid} exited with status {status}, restarting" + (f" in {delay:g}s" if delay else ""))
+        time.sleep(delay)
+        if not stopping:
+            workers[spawn_worker(app, sock)] = time.monotonic()
+
+    sock.close()
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
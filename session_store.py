@@ -0,0 +1,115 @@
+"""Server-side state of the Gradio sessions.
+
+The UI only keeps the session id. The ingredient options, the prefetch id, the
+analysis and the chat memory of a session are kept here instead of in gr.State,
+so they are not sent back and forth with every event. Sessions idle for longer
+than SESSION_TTL are dropped, and the least recently used ones are evicted when
+there are more than MAX_SESSIONS or they take more than MAX_STORE_BYTES.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from memory_report import deep_sizeof
+from metrics import cache_requests, session_store_bytes, session_store_entries, session_store_evictions
+
+SESSION_TTL = 2 * 60 * 60
+MAX_SESSIONS = 1000
+MAX_STORE_BYTES = 256 * 2**20
+
+sessions = OrderedDict()
+store_bytes = 0
+session_lock = threading.Lock()
+
+
+def compact_options(ingredient_options):
+    """Only what the later steps read of get_similar_items' options: the amount and the options per source.
+
+    The flat option list and the availability map are only used to build the checkboxes."""
+    return {
+        ingredient: {'amount': data['amount'], 'sources': data['sources']}
+        for ingredient, data in ingredient_options.items()
+    }
+
+
+def drop(session_id, reason):
+    """Remove a session, with session_lock held."""
+    global store_bytes
+    entry = sessions.pop(session_id)
+    store_bytes -= entry['bytes']
+    if reason is not None:
+        session_store_evictions.inc(reason=reason)
+
+
+def evict(keep=None):
+    """Drop the expired sessions, then the least recently used ones over the caps, with session_lock held."""
+    cutoff = time.monotonic() - SESSION_TTL
+    while sessions:
+        session_id, entry = next(iter(sessions.items()))
+        if entry['used'] >= cutoff:
+            break
+        drop(session_id, "ttl")
+    while len(sessions) > MAX_SESSIONS or (store_bytes > MAX_STORE_BYTES and len(sessions) > 1):
+        session_id = next(iter(sessions))
+        if session_id == keep:
+            sessions.move_to_end(session_id)
+            session_id = next(iter(sessions))
+        drop(session_id, "lru" if len(sessions) > MAX_SESSIONS else "size")
+    session_store_entries.set(len(sessions))
+    session_store_bytes.set(store_bytes)
+
+
+def open_session(session_id=None):
+    """Start an empty session and return its id."""
+    session_id = session_id or uuid.uuid4().hex
+    with session_lock:
+        if session_id in sessions:
+            drop(session_id, None)
+        sessions[session_id] = {'data': {}, 'sizes': {}, 'bytes': 0, 'used': time.monotonic()}
+        evict(keep=session_id)
+    return session_id
+
+
+def close_session(session_id):
+    with session_lock:
+        if session_id in sessions:
+            drop(session_id, None)
+        evict()
+
+
+def get_session(session_id):
+    """The values stored for a session, empty if it expired or was evicted.
+
+    The dict is shared: store changes with update_session so their size is counted."""
+    with session_lock:
+        entry = sessions.get(session_id)
+        if entry is None:
+            cache_requests.inc(cache="sessions", result="expired")
+            return {}
+        cache_requests.inc(cache="sessions", result="hit")
+        entry['used'] = time.monotonic()
+        sessions.move_to_end(session_id)
+        return entry['data']
+
+
+def update_session(session_id, **values):
+    """Store values for a session, reopening it if it expired, and enforce the caps."""
+    global store_bytes
+    if session_id is None:
+        return
+    # Only the updated values are sized, and outside the lock, so other sessions do not wait on the walk
+    sizes = {key: deep_sizeof(value) for key, value in values.items()}
+    with session_lock:
+        entry = sessions.get(session_id)
+        if entry is None:
+            entry = sessions[session_id] = {'data': {}, 'sizes': {}, 'bytes': 0, 'used': time.monotonic()}
+        entry['data'].update(values)
+        for key, size in sizes.items():
+            difference = size - entry['sizes'].get(key, 0)
+            entry['sizes'][key] = size
+            entry['bytes'] += difference
+            store_bytes += difference
+        entry['used'] = time.monotonic()
+        sessions.move_to_end(session_id)
+        evict(keep=session_id)
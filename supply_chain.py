@@ -0,0 +1,229 @@
+"""Multi-tier contribution analysis over the BONSAI recipes.
+
+get_bonsai_data shows the first tier of a product's recipe. This module follows
+the recipe inputs further upstream: every (flow, region) with a recipe is a node,
+and the emission of an input is split over the inputs of its own recipe, in
+proportion to their emissions. Expansion stops at a depth, and inputs below
+`cutoff` of their parent's footprint are kept whole.
+
+The graph is expanded one tier at a time as a weight per node, so all the paths
+reaching a shared upstream node (electricity, transport, fertiliser...) are
+merged and its recipe is expanded once per tier, however many products use it.
+Results are memoised per (node, depth, cutoff):
+
+    python supply_chain.py "Tomatoes" --country Netherlands --depth 3 --cutoff 0.01
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from metrics import timed
+
+DEFAULT_DEPTH = 3
+DEFAULT_CUTOFF = 0.01
+MAX_DEPTH = 8
+TOP_CONTRIBUTORS = 10
+# Memoised (node, depth, cutoff) results, least recently used evicted first
+MEMO_SIZE = 1024
+
+# Kinds of contribution: the direct emissions of a process, an input kept whole
+# (including its own upstream) and the 'other' remainder of a recipe
+DIRECT, UPSTREAM, OTHER = 0, 1, 2
+KIND_NAMES = {DIRECT: 'direct', UPSTREAM: 'upstream', OTHER: 'other'}
+
+graph = None
+graph_lock = threading.Lock()
+
+
+def build_graph(recipes):
+    """Compile the recipes table into CSR arrays over (flow, region) nodes."""
+
+    rows = recipes.dropna(subset=['flow_reference', 'region_reference'])
+    references = pd.MultiIndex.from_arrays([rows['flow_reference'], rows['region_reference']])
+    node_of_row, nodes = references.factorize()
+    order = np.argsort(node_of_row, kind='stable')
+    node_of_row = node_of_row[order]
+    rows = rows.iloc[order]
+
+    flow_input = rows['flow_input'].to_numpy(dtype=object)
+    region_inflow = rows['region_inflow'].to_numpy(dtype=object)
+    kind = np.where(flow_input == 'direct', DIRECT, np.where(flow_input == 'other', OTHER, UPSTREAM))
+    child = nodes.get_indexer(pd.MultiIndex.from_arrays([flow_input, region_inflow]))
+    emission = rows['value_emission'].to_numpy(dtype=float)
+    emission = np.where(np.isnan(emission), 0.0, emission)
+
+    # A contribution is keyed by what it is attributed to: the process itself for
+    # direct emissions, the input otherwise
+    leaf_flow = np.where(kind == DIRECT, rows['flow_reference'].to_numpy(dtype=object), flow_input)
+    leaf_region = np.where(kind == DIRECT, rows['region_reference'].to_numpy(dtype=object), region_inflow)
+    leaf_of_edge, leaves = pd.MultiIndex.from_arrays([leaf_flow, leaf_region, kind]).factorize()
+
+    return {
+        'nodes': nodes,
+        'offsets': np.searchsorted(node_of_row, np.arange(len(nodes) + 1)),
+        'node': node_of_row,
+        'child': child,
+        'emission': emission,
+        'leaf': leaf_of_edge,
+        'leaves': leaves,
+        'total': np.bincount(node_of_row, weights=emission, minlength=len(nodes)),
+        'memo': OrderedDict(),
+        'memo_lock': threading.Lock(),
+    }
+
+
+def get_graph():
+    """The recipe graph of this process, built from the loaded BONSAI recipes on first use."""
+    global graph
+    with graph_lock:
+        if graph is None:
+            from data_handler import get_tables
+            with timed("supply_chain_graph"):
+                graph = build_graph(get_tables()['recipes'])
+    return graph
+
+
+def node_edges(graph, nodes):
+    """Indices of the recipe rows of the given nodes."""
+    starts, stops = graph['offsets'][nodes], graph['offsets'][nodes + 1]
+    counts = stops - starts
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+
+def contributions(graph, node, depth, cutoff):
+    """Emissions per unit of a node as (leaf ids, values), expanded `depth` tiers upstream."""
+    key = (node, depth, cutoff)
+    with graph['memo_lock']:
+        if key in graph['memo']:
+            graph['memo'].move_to_end(key)
+            return graph['memo'][key]
+
+    leaves = np.zeros(len(graph['leaves']))
+    weights = np.zeros(len(graph['nodes']))
+    weights[node] = 1.0
+    for tier in range(depth + 1):
+        active = np.flatnonzero(weights)
+        if not active.size:
+            break
+        edges = node_edges(graph, active)
+        parent, child, emission = graph['node'][edges], graph['child'][edges], graph['emission'][edges]
+        weighted = weights[parent] * emission
+        if tier < depth:
+            # Inputs with a recipe of their own and at least `cutoff` of their parent's footprint
+            expand = (child >= 0) & (emission != 0) & (np.abs(emission) >= cutoff * np.abs(graph['total'][parent]))
+            expand[expand] = graph['total'][child[expand]] != 0
+        else:
+            expand = np.zeros(len(edges), dtype=bool)
+        leaves += np.bincount(graph['leaf'][edges[~expand]], weights=weighted[~expand], minlength=len(leaves))
+        weights = np.bincount(child[expand], weights=weighted[expand] / graph['total'][child[expand]],
+                              minlength=len(weights))
+
+    ids = np.flatnonzero(leaves)
+    result = ids, leaves[ids]
+    with graph['memo_lock']:
+        graph['memo'][key] = result
+        while len(graph['memo']) > MEMO_SIZE:
+            graph['memo'].popitem(last=False)
+    return result
+
+
+def ranked(keys, values, total, top):
+    """The `top` keys by absolute contribution as (key, kg, share of the total) rows."""
+    labels, inverse = np.unique(np.asarray(keys, dtype=object).astype(str), return_inverse=True)
+    sums = np.bincount(inverse, weights=values, minlength=len(labels))
+    order = np.argsort(-np.abs(sums), kind='stable')[:top]
+    return [(labels[n], sums[n], sums[n] / total if total else None) for n in order]
+
+
+@timed("supply_chain")
+def analyse_supply_chain(product, flow_type, country, grams=1000, depth=DEFAULT_DEPTH, cutoff=DEFAULT_CUTOFF,
+                         top=TOP_CONTRIBUTORS):
+    """Top upstream flows, regions and (flow, region) contributors of a BONSAI product in a country.
+
+    Returns None when the product has no recipe for the country."""
+    from catalog import get_catalog
+    from data_handler import get_tables
+
+    catalog = get_catalog()
+    found = catalog.find('BONSAI', product, flow_type)
+    region = catalog.region_codes['BONSAI'].get(country)
+    if found is None or region is None:
+        return None
+    graph = get_graph()
+    node = graph['nodes'].get_indexer([(catalog.strings[catalog.product_code[found]], region)])[0]
+    if node < 0:
+        return None
+
+    depth = min(depth, MAX_DEPTH)
+    ids, values = contributions(graph, node, depth, cutoff)
+    values = values * grams / 1000
+    total = values.sum()
+
+    tables = get_tables()
+    activity_dict, region_dict = tables['activity_dict'], tables['region_dict']
+    leaves = graph['leaves'][ids]
+    flows = [
+        'Other' if kind == OTHER else activity_dict[flow].capitalize() if flow in activity_dict
+        else str(flow) if pd.notna(flow) else "Unknown"
+        for flow, _, kind in leaves
+    ]
+    regions = [region_dict.get(region, region) if pd.notna(region) else "Unknown" for _, region, _ in leaves]
+    kinds = [KIND_NAMES[kind] for _, _, kind in leaves]
+
+    order = np.argsort(-np.abs(values), kind='stable')[:top]
+    return {
+        'product': product,
+        'type': flow_type,
+        'region': country,
+        'grams': grams,
+        'depth': depth,
+        'cutoff': cutoff,
+        'total_kg': total,
+        'flows': [{'flow': flow, 'kg': kg, 'share': share} for flow, kg, share in ranked(flows, values, total, top)],
+        'regions': [{'region': name, 'kg': kg, 'share': share} for name, kg, share in ranked(regions, values, total, top)],
+        'contributors': [
+            {'flow': flows[n], 'region': regions[n], 'kind': kinds[n], 'kg': values[n],
+             'share': values[n] / total if total else None}
+            for n in order
+        ],
+    }
+
+
+def format_supply_chain(result):
+    """Render an analyse_supply_chain result as plain text."""
+    from data_handler import round_to_sig_figs
+
+    if result is None:
+        return "No BONSAI recipe available for this product and country"
+    lines = [f"{result['type'].capitalize()} '{result['product']}' in {result['region']}, {result['grams']} grams: "
+             f"{round_to_sig_figs(result['total_kg'])} kg co2-eq, {result['depth']} tiers, "
+             f"inputs under {result['cutoff']:.0%} of their parent not expanded"]
+    for title, key, rows in (("Flows", 'flow', result['flows']), ("Regions", 'region', result['regions'])):
+        lines.append(f"\n{title}:")
+        for row in rows:
+            share = f"{row['share']*100:5.1f}%" if row['share'] is not None else "     "
+            lines.append(f"  {share}  {round_to_sig_figs(row['kg'])} kg  {row[key]}")
+    lines.append("\nContributors:")
+    for row in result['contributors']:
+        share = f"{row['share']*100:5.1f}%" if row['share'] is not None else "     "
+        lines.append(f"  {share}  {round_to_sig_figs(row['kg'])} kg  {row['flow']} ({row['region']}, {row['kind']})")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Upstream contribution analysis of a BONSAI product.")
+    parser.add_argument('product')
+    parser.add_argument('--type', choices=['market', 'product'], default='market')
+    parser.add_argument('--country', default="Netherlands")
+    parser.add_argument('--grams', type=float, default=1000)
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH)
+    parser.add_argument('--cutoff', type=float, default=DEFAULT_CUTOFF)
+    parser.add_argument('--top', type=int, default=TOP_CONTRIBUTORS)
+    args = parser.parse_args()
+
+    print(format_supply_chain(analyse_supply_chain(args.product, args.type, args.country, args.grams,
+                                                   args.depth, args.cutoff, args.top)))